@@ -1,6 +1,11 @@
+import os
 import numpy as np
 import torch
-import wandb
+from functools import partial
+
+from sac.batch import Batch
+from sac.prefetch import BatchPrefetcher
+from utils import make_env
 
 
 def exploration_before_start(args, env_sampler, env_pool, agent, init_exploration_steps=5000):
@@ -29,41 +34,133 @@ def evaluate_policy(args, env_sampler, agent, epoch_length=1000):
     return sum_reward
 
 
-def train_policy_repeats(args, total_step, train_step, cur_step, env_pool, model_pool, agent):
+def evaluate_policy_batch(args, envs, agent, epoch_length=1000):
+    """
+    Run one evaluation episode in every env of `envs` in lockstep. The policy
+    is queried once per step on the stacked states of the unfinished episodes.
+    Returns the per-episode returns.
+    """
+    states = np.stack([env.reset() for env in envs])
+    returns = np.zeros(len(envs))
+    active = np.ones(len(envs), dtype=bool)
+    for t in range(epoch_length):
+        idxes = np.flatnonzero(active)
+        actions = agent.select_action(states[idxes], True)
+        for i, action in zip(idxes, actions):
+            next_state, reward, done, info = envs[i].step(action)
+            returns[i] += reward
+            states[i] = next_state
+            if done:
+                active[i] = False
+        if not active.any():
+            break
+    return returns
+
+
+def evaluate_policy_episodes(args, envs, agent, n_episodes, epoch_length=1000):
+    """Evaluate n_episodes, len(envs) at a time."""
+    rewards = []
+    while len(rewards) < n_episodes:
+        n = min(len(envs), n_episodes - len(rewards))
+        rewards.extend(evaluate_policy_batch(args, envs[:n], agent, epoch_length))
+    return np.array(rewards)
+
+
+def summarize_returns(rewards, cvar_alpha=0.1):
+    """Mean, std and lower-tail CVaR of a set of episode returns."""
+    rewards = np.asarray(rewards)
+    sorted_rewards = np.sort(rewards)
+    cvar = sorted_rewards[:int(cvar_alpha * sorted_rewards.shape[0])].mean()
+    return np.mean(rewards), np.std(rewards), cvar
+
+
+def make_eval_envs(args, n_episodes):
+    n = min(args.eval_envs if args.eval_envs > 0 else os.cpu_count() or 1, n_episodes)
+    envs = [make_env(args.env, args.risk_prob, args.risk_penalty) for _ in range(n)]
+    for i, env in enumerate(envs):
+        env.seed(args.seed + 1 + i)
+    return envs
+
+
+def sample_batch(args, env_pool, model_pool):
+    env_batch_size = int(args.policy_train_batch_size * args.real_ratio)
+    model_batch_size = args.policy_train_batch_size - env_batch_size
+    model_reward = np.array([0.])
+    env_state, env_action, env_reward, env_next_state, env_done = env_pool.sample(int(env_batch_size))
+
+    if model_batch_size > 0 and len(model_pool) > 0:
+        model_state, model_action, model_reward, model_next_state, model_done = model_pool.sample_all_batch(int(model_batch_size))
+
+        batch_state, batch_action, batch_reward, batch_next_state, batch_done = np.concatenate((env_state, model_state), axis=0), \
+            np.concatenate((env_action, model_action), axis=0), np.concatenate((np.reshape(env_reward, (env_reward.shape[0], -1)), model_reward), axis=0), \
+            np.concatenate((env_next_state, model_next_state), axis=0), np.concatenate((np.reshape(env_done, (env_done.shape[0], -1)), model_done), axis=0)
+    else:
+        batch_state, batch_action, batch_reward, batch_next_state, batch_done = env_state, env_action, env_reward, env_next_state, env_done
+
+    batch_reward, batch_done = np.squeeze(batch_reward), np.squeeze(batch_done)
+
+    batch_mask = 1 - batch_done
+    return batch_state, batch_action, batch_reward, batch_next_state, batch_mask
+
+
+def sample_batch_into(args, env_pool, model_pool, batch):
+    env_batch_size = int(args.policy_train_batch_size * args.real_ratio)
+    model_batch_size = args.policy_train_batch_size - env_batch_size
+    env_batch_size = env_pool.sample_into(batch, env_batch_size)
+
+    if model_batch_size > 0 and len(model_pool) > 0:
+        model_pool.sample_into(batch, model_batch_size, start=env_batch_size, replace=True)
+        return batch.narrow(env_batch_size + model_batch_size)
+    return batch.narrow(env_batch_size)
+
+
+def make_batch_prefetcher(args, env_pool, model_pool, agent, state_size, action_size, num_batches=0):
+    make_batch = partial(Batch, args.policy_train_batch_size, int(state_size), int(action_size),
+                         prioritized=env_pool.tree is not None)
+    fill_fn = partial(sample_batch_into, args, env_pool, model_pool)
+    if num_batches > 0:
+        # the worker thread samples the pools while the learner draws from the global RNGs
+        env_pool.set_rng([args.seed, 0])
+        model_pool.set_rng([args.seed, 1])
+    return BatchPrefetcher(fill_fn, make_batch, device=agent.device, num_batches=num_batches)
+
+
+def update_priorities(env_pool, batch, priorities):
+    """Queue the new priorities of a trained batch on the device; flush_priorities writes them."""
+    indices = getattr(batch, 'indices', None)
+    if indices is not None:
+        # the prefetcher reuses the device batch, so keep a copy of its indices
+        env_pool.pending_priorities.append((indices.clone(), priorities))
+
+
+def flush_priorities(env_pool):
+    """Write the queued priorities to the sum-tree with one device-to-host copy per field."""
+    if not env_pool.pending_priorities:
+        return
+    indices, priorities = (torch.cat(values).cpu().numpy() for values in zip(*env_pool.pending_priorities))
+    env_pool.pending_priorities = []
+    env_pool.update_priorities(indices, priorities)
+
+
+def train_policy_repeats(args, total_step, train_step, cur_step, env_pool, model_pool, agent, prefetcher=None, metrics=None):
     if total_step % args.train_every_n_steps > 0:
         return 0
     if train_step > args.max_train_repeat_per_step * cur_step:
         return 0
 
     # num_train_repeat: 20
-    for i in range(args.num_train_repeat):
-       
-        env_batch_size = int(args.policy_train_batch_size * args.real_ratio)
-        model_batch_size = args.policy_train_batch_size - env_batch_size
-        model_reward = np.array([0.])
-        env_state, env_action, env_reward, env_next_state, env_done = env_pool.sample(int(env_batch_size))
-
-        if model_batch_size > 0 and len(model_pool) > 0:
-            model_state, model_action, model_reward, model_next_state, model_done = model_pool.sample_all_batch(int(model_batch_size))
-
-            batch_state, batch_action, batch_reward, batch_next_state, batch_done = np.concatenate((env_state, model_state), axis=0), \
-                np.concatenate((env_action, model_action), axis=0), np.concatenate((np.reshape(env_reward, (env_reward.shape[0], -1)), model_reward), axis=0), \
-                np.concatenate((env_next_state, model_next_state), axis=0), np.concatenate((np.reshape(env_done, (env_done.shape[0], -1)), model_done), axis=0)
-        else:
-            batch_state, batch_action, batch_reward, batch_next_state, batch_done = env_state, env_action, env_reward, env_next_state, env_done
-
-        batch_reward, batch_done = np.squeeze(batch_reward), np.squeeze(batch_done)
-
-        batch_mask = 1 - batch_done
-
-        critic_1_loss, critic_2_loss, policy_loss, ent_loss, alpha = agent.update_parameters(
-            (batch_state, batch_action, batch_reward, batch_next_state, batch_mask), args.policy_train_batch_size, i)
-
-        if args.wandb:
-            wandb.log({'Training/critic1_loss': critic_1_loss,
-                        'Training/critic2_loss': critic_2_loss,
-                        'Training/policy_loss': policy_loss,
-                        'Training/entropy_loss': ent_loss,
-                        'Training/alpha': alpha})
+    if prefetcher is None:
+        prefetcher = (sample_batch(args, env_pool, model_pool) for _ in range(args.num_train_repeat))
+    # prioritized replay queues the per-sample losses on the device
+    priority_fn = partial(update_priorities, env_pool) if env_pool.tree is not None else None
+    agent.update_many(prefetcher, args.num_train_repeat, priority_fn=priority_fn)
+
+    # losses and priorities stay on the device until the logging interval is reached, so sampling
+    # sees priorities up to log_interval steps old (plus the batches prefetched ahead of the learner)
+    if total_step % args.log_interval == 0:
+        flush_priorities(env_pool)
+    if metrics is not None and total_step % args.log_interval == 0:
+        losses = agent.read_losses()
+        metrics.log({f'Training/{name}': value for name, value in losses.items()}, step=total_step)
 
     return args.num_train_repeat
@@ -0,0 +1,70 @@
+"""
+Wall time of training S seeds stacked in one process (--num_seeds S) against
+S single-seed processes running at the same time on the same machine:
+python bench_stacked_seeds.py --algo codac --num_seeds 2
+"""
+import argparse
+import subprocess
+import sys
+import time
+import numpy as np
+import torch
+
+from sac.batch import Batch
+from utils import setup_device
+
+
+class Box(object):
+    def __init__(self, n):
+        self.shape = (n,)
+        self.high = np.ones(n, dtype=np.float32)
+        self.low = -np.ones(n, dtype=np.float32)
+
+
+def train_steps(algo, num_seeds, state_size, action_size, steps, batch_size=256):
+    if algo == 'codac':
+        from distributional.codac import CODAC as cls
+    elif algo == 'cql':
+        from sac.cql import CQL as cls
+    else:
+        from sac import SAC as cls
+    agent = cls(state_size, Box(action_size), device='cpu', num_seeds=num_seeds if num_seeds > 1 else None)
+    n = batch_size * num_seeds
+    batch = Batch.from_tensors(torch.randn(n, state_size), torch.rand(n, action_size) * 2 - 1,
+                               torch.randn(n, 1), torch.randn(n, state_size), torch.ones(n, 1))
+    agent.update_many([batch] * steps, steps)
+    agent.read_losses()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--algo', default='codac', choices=['sac', 'cql', 'codac'])
+    parser.add_argument('--num_seeds', type=int, default=2)
+    parser.add_argument('--state_size', type=int, default=2)
+    parser.add_argument('--action_size', type=int, default=2)
+    parser.add_argument('--steps', type=int, default=30)
+    parser.add_argument('--num_threads', type=int, default=0)
+    parser.add_argument('--worker', type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        setup_device('cpu', args.num_threads)
+        train_steps(args.algo, args.worker, args.state_size, args.action_size, args.steps)
+        return
+
+    def run(num_seeds, copies):
+        command = [sys.executable, __file__, '--algo', args.algo, '--worker', str(num_seeds),
+                   '--state_size', str(args.state_size), '--action_size', str(args.action_size),
+                   '--steps', str(args.steps), '--num_threads', str(args.num_threads)]
+        start = time.time()
+        for process in [subprocess.Popen(command) for _ in range(copies)]:
+            process.wait()
+        return time.time() - start
+
+    stacked = run(args.num_seeds, 1)
+    separate = run(1, args.num_seeds)
+    print(f'{args.algo}, {args.num_seeds} seeds, {args.steps} steps: stacked {stacked:.1f}s, '
+          f'separate processes {separate:.1f}s, speedup {separate / stacked:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
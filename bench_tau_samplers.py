@@ -0,0 +1,51 @@
+"""
+Compare the quantile-fraction samplers of distributional/tau_samplers.py:
+python bench_tau_samplers.py
+"""
+import time
+import numpy as np
+import torch
+
+import distributional.rlkit_pytorch_utils as ptu
+from distributional.risks import distortion_de, normal_icdf
+from distributional.tau_samplers import TAU_SAMPLERS, sample_taus
+
+
+def iqn_taus(n, num_quantiles, device):
+    """The i.i.d. fractions of tau_type='iqn': midpoints of random bin widths."""
+    presum_tau = torch.rand(n, num_quantiles, device=device) + 0.1
+    presum_tau /= presum_tau.sum(dim=-1, keepdims=True)
+    tau = torch.cumsum(presum_tau, dim=1)
+    tau_hat = torch.cat([tau[:, :1] / 2., (tau[:, 1:] + tau[:, :-1]) / 2.], dim=1)
+    return tau_hat, presum_tau
+
+
+def benchmark(n=4096):
+    """
+    Bias and spread of the distorted-mean estimate of a lognormal return
+    distribution for every sampler and quantile count. Critic compute scales
+    with the number of quantiles T, so mse * T compares samplers at equal cost.
+    """
+    quantile_fn = lambda tau: torch.exp(0.5 * normal_icdf(tau.clamp(1e-6, 1 - 1e-6)))
+    grid = (torch.arange(2 ** 20, dtype=torch.float64) + 0.5) / 2 ** 20
+    for risk_type, risk_param in (('neutral', 0.), ('cvar', 0.25), ('wang', -0.75)):
+        exact = (distortion_de(grid, risk_type, risk_param) * quantile_fn(grid)).mean().item()
+        print(f'{risk_type} ({risk_param}), exact {exact:.5f}')
+        print(f'{"sampler":>12} {"T":>4} {"bias":>9} {"std":>9} {"mse * T":>9} {"ms/draw":>8}')
+        for name in ('iqn',) + tuple(TAU_SAMPLERS):
+            for T in (4, 8, 16, 32):
+                start = time.time()
+                if name == 'iqn':
+                    tau_hat, presum_tau = iqn_taus(n, T, 'cpu')
+                else:
+                    _, tau_hat, presum_tau = sample_taus(name, n, T, 'cpu')
+                elapsed = (time.time() - start) * 1000
+                weights = distortion_de(tau_hat, risk_type, risk_param) * presum_tau
+                estimates = (weights * quantile_fn(tau_hat)).sum(dim=1).double()
+                bias, var = estimates.mean().item() - exact, estimates.var().item()
+                print(f'{name:>12} {T:>4} {bias:>9.5f} {np.sqrt(var):>9.5f} {(bias ** 2 + var) * T:>9.5f} {elapsed:>8.2f}')
+
+
+if __name__ == '__main__':
+    ptu.set_gpu_mode(False)
+    benchmark()
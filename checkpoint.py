@@ -0,0 +1,144 @@
+import os
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+from distributional.tau_samplers import sobol_state, load_sobol_state
+
+
+def rng_state():
+    state = {'python': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state(),
+             'sobol': sobol_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    load_sobol_state(state.get('sobol', []))
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def checkpoint_path(args):
+    return os.path.join(args.checkpoint_dir, args.env, f'{args.run_name}.pt')
+
+
+def training_state(agent, epoch, total_step, pools=None, samplers=None):
+    """
+    Everything needed to continue a run from the start of `epoch`: the full
+    agent state (see MultiStepUpdater.state_dict), the RNG streams including
+    the Sobol tau sequences, the given replay pools, the sampling state
+    (replay priorities and per-seed RNGs) of the `samplers` pools, whose
+    transitions are rebuilt from the dataset, and the epoch/step counters.
+    """
+    pools = pools or {}
+    samplers = samplers or {}
+    return {'agent': agent.state_dict(),
+            'rng': rng_state(),
+            'pools': {name: pool.state_dict() for name, pool in pools.items()},
+            'samplers': {name: pool.sampler_state_dict() for name, pool in samplers.items()},
+            'epoch': epoch,
+            'total_step': total_step}
+
+
+def atomic_save(path, obj, save_fn=torch.save):
+    """
+    save_fn(obj, f) into a temporary file that is fsynced and then renamed
+    over `path`, so readers only ever see the old or the new complete file.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        save_fn(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def snapshot(obj):
+    """Copy the tensors and arrays of a nested state so training can keep mutating the originals."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().clone()
+    if isinstance(obj, np.ndarray):
+        return np.array(obj)
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+class CheckpointWriter(object):
+    """
+    Serializes and writes files on a background thread.
+
+    submit() takes a snapshot of the state in the calling thread, which only
+    costs a device/host memcpy, and queues it; the worker then runs save_fn
+    through atomic_save. run() queues other writes, such as dataset segments,
+    in the same order. At most max_pending snapshots are held in memory,
+    submit() blocks when the writer falls behind. Write errors are raised
+    on the next submit() or on close().
+    """
+    def __init__(self, max_pending=8):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            fn, fn_args = item
+            try:
+                fn(*fn_args)
+            except BaseException as e:
+                self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, path, obj, save_fn=torch.save):
+        self._check()
+        self.queue.put((atomic_save, (path, snapshot(obj), save_fn)))
+
+    def run(self, fn, *args):
+        """Queue fn(*args) on the writer thread, with snapshots of args."""
+        self._check()
+        self.queue.put((fn, snapshot(args)))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+
+def save_checkpoint(path, agent, epoch, total_step, pools=None, writer=None, samplers=None):
+    state = training_state(agent, epoch, total_step, pools, samplers)
+    if writer is not None:
+        writer.submit(path, state)
+    else:
+        atomic_save(path, state)
+
+
+def load_checkpoint(path, agent, pools=None, samplers=None):
+    """Restore a checkpoint written by save_checkpoint. Returns (epoch, total_step)."""
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    agent.load_state_dict(state['agent'])
+    for name, pool in (pools or {}).items():
+        pool.load_state_dict(state['pools'][name])
+    for name, pool in (samplers or {}).items():
+        pool.load_sampler_state_dict(state.get('samplers', {}).get(name, {}))
+    set_rng_state(state['rng'])
+    return state['epoch'], state['total_step']
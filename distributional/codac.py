@@ -6,13 +6,18 @@ import os
 import wandb
 
 from distributional.risks import *
-from distributional.networks import QuantileMlp
-from distributional.dsac import quantile_regression_loss
+from distributional.networks import QuantileMlpEnsemble, FixedQuantileMlpEnsemble, pessimistic_value, actor_value
+from distributional.dsac import quantile_regression_loss, weighted_mean
+from distributional.tau_samplers import TAU_SAMPLERS, sample_taus
 from distributional.util import LinearSchedule
 from sac.model import GaussianPolicy
+from sac.batch import as_batch
+from sac.utils import MultiStepUpdater, ENSEMBLE_LOSS_NAMES, stack_losses, seed_mean, fused_adam_kwargs, resolve_device
 
 
-class CODAC(object):
+class CODAC(MultiStepUpdater):
+    loss_names = ENSEMBLE_LOSS_NAMES
+
     def __init__(self, num_inputs, action_space,
                  ## SAC params
                  gamma=0.99,
@@ -40,12 +45,17 @@ class CODAC(object):
                  policy_eval_start=40000,
                  num_total_steps=1000000,
                  version=2,
-                 device='cuda'):
+                 num_critics=2,
+                 num_target_critics=2,
+                 multi_head_critic=False,
+                 device='auto',
+                 num_seeds=None):
 
         self.gamma = gamma
 
         self.version = version
-        self.device = device
+        self.device = resolve_device(device)
+        self.num_seeds = num_seeds
         self.dist_penalty_type = dist_penalty_type
         self.risk_type = risk_type
         self.risk_param = risk_param
@@ -64,32 +74,32 @@ class CODAC(object):
         self.num_random = num_random
         self.min_z_weight = min_z_weight
 
-        self.zf1 = QuantileMlp(input_size=num_inputs+action_space.shape[0],
-                          output_size=1,
-                          num_quantiles=num_quantiles,
-                          hidden_sizes=[hidden_size, hidden_size]).to(self.device)
-        self.zf2 = QuantileMlp(input_size=num_inputs+action_space.shape[0],
-                          output_size=1,
-                          num_quantiles=num_quantiles,
-                          hidden_sizes=[hidden_size, hidden_size]).to(self.device)
-        self.target_zf1 = QuantileMlp(input_size=num_inputs+action_space.shape[0],
+        # num_critics quantile critics with stacked weights; targets take the min over
+        # a random subset of num_target_critics of them (all of them by default), the policy uses actor_value
+        self.num_critics = num_critics
+        self.num_target_critics = num_target_critics
+        # with fixed taus, a multi-head critic outputs all quantiles from one forward
+        if multi_head_critic and tau_type != 'fix':
+            raise ValueError("multi_head_critic requires tau_type='fix'")
+        critic_cls = FixedQuantileMlpEnsemble if multi_head_critic else QuantileMlpEnsemble
+        self.zf = critic_cls(num_critics,
+                          input_size=num_inputs+action_space.shape[0],
                           output_size=1,
                           num_quantiles=num_quantiles,
-                          hidden_sizes=[hidden_size, hidden_size]).to(self.device)
-        self.target_zf2 = QuantileMlp(input_size=num_inputs+action_space.shape[0],
+                          hidden_sizes=[hidden_size, hidden_size],
+                          num_seeds=num_seeds).to(self.device)
+        self.target_zf = critic_cls(num_critics,
+                          input_size=num_inputs+action_space.shape[0],
                           output_size=1,
                           num_quantiles=num_quantiles,
-                          hidden_sizes=[hidden_size, hidden_size]).to(self.device)
+                          hidden_sizes=[hidden_size, hidden_size],
+                          num_seeds=num_seeds).to(self.device)
 
         self.zf_criterion = quantile_regression_loss
-        self.zf1_optimizer = Adam(
-            self.zf1.parameters(),
+        self.zf_optimizer = Adam(
+            self.zf.parameters(),
             lr=critic_lr,
         )
-        self.zf2_optimizer = Adam(
-            self.zf2.parameters(),
-            lr=critic_lr
-        )
 
         self.use_automatic_entropy_tuning = use_automatic_entropy_tuning
         self.use_bc = use_bc
@@ -101,13 +111,16 @@ class CODAC(object):
             self.target_entropy = -torch.prod(torch.Tensor(action_space.shape).to(self.device)).item()
             if self.target_entropy != 'auto':
                 self.target_entropy = target_entropy
-            self.log_alpha = torch.zeros(1, requires_grad=True, device=self.device)
+            alpha_shape = (1,) if num_seeds is None else (num_seeds, 1, 1)
+            self.log_alpha = torch.zeros(alpha_shape, requires_grad=True, device=self.device)
             self.alpha_optimizer = Adam([self.log_alpha], lr=actor_lr)
         else:
             self.alpha = alpha
 
-        self.policy = GaussianPolicy(num_inputs, action_space.shape[0], hidden_size, action_space).to(self.device)
-        self.target_policy = GaussianPolicy(num_inputs, action_space.shape[0], hidden_size, action_space).to(self.device)
+        self.policy = GaussianPolicy(num_inputs, action_space.shape[0], hidden_size, action_space,
+                                     num_seeds).to(self.device)
+        self.target_policy = GaussianPolicy(num_inputs, action_space.shape[0], hidden_size, action_space,
+                                            num_seeds).to(self.device)
 
         self.optimizer_actor = Adam(self.policy.parameters(), lr=actor_lr)
  
@@ -116,26 +129,21 @@ class CODAC(object):
             self.with_lagrange = False
         if self.with_lagrange:
             self.target_action_gap = lagrange_thresh
-            self.log_alpha_prime = torch.zeros(1, device=self.device, requires_grad=True)
-            self.alpha_prime_optimizer = Adam([self.log_alpha_prime], lr=lr)
-
-    def _get_tensor_values(self, obs, actions, tau):
-        action_shape = actions.shape[0]
-        obs_shape = obs.shape[0]
-        num_repeat = int(action_shape / obs_shape)
-        obs_temp = obs.unsqueeze(1).repeat(1, num_repeat, 1).view(obs.shape[0] * num_repeat, obs.shape[1])
-        tau_temp = tau.unsqueeze(1).repeat(1, num_repeat, 1).view(tau.shape[0] * num_repeat, tau.shape[1])
-
-        pred1 = self.zf1(obs_temp, actions, tau_temp)
-        pred2 = self.zf2(obs_temp, actions, tau_temp)
-        pred1 = pred1.view(obs.shape[0], num_repeat, -1)
-        pred2 = pred2.view(obs.shape[0], num_repeat, -1)
-        return pred1, pred2
+            self.log_alpha_prime = torch.zeros(num_seeds or 1, device=self.device, requires_grad=True)
+            if self.version != 3:
+                self.alpha_prime_optimizer = Adam([self.log_alpha_prime], lr=lr)
+
+        if self.version == 3:
+            # one optimizer for the critics and the Lagrange multiplier
+            param_groups = [{'params': self.zf.parameters(), 'lr': critic_lr}]
+            if self.with_lagrange:
+                param_groups.append({'params': [self.log_alpha_prime], 'lr': lr})
+            self.zf_optimizer = Adam(param_groups, **fused_adam_kwargs(self.device))
 
     def _get_policy_actions(self, obs, num_actions, network=None):
-        obs_temp = obs.unsqueeze(1).repeat(1, num_actions, 1).view(obs.shape[0] * num_actions, obs.shape[1])
+        obs_temp = obs.unsqueeze(-2).expand(*obs.shape[:-1], num_actions, obs.shape[-1])
         new_obs_actions, new_obs_log_pi, _ = network.sample(obs_temp)
-        return new_obs_actions.detach(), new_obs_log_pi.view(obs.shape[0], num_actions, 1).detach()
+        return new_obs_actions.detach(), new_obs_log_pi.detach()  # (..., N, R, A), (..., N, R, 1)
 
     def select_action(self, state, eval=False, tau=0.1):
         state = torch.FloatTensor(state).to(self.device).unsqueeze(0)
@@ -146,49 +154,50 @@ class CODAC(object):
         return action.detach().cpu().numpy()[0]
 
     def get_tau(self, obs, actions, fp=None):
+        rows = actions.shape[:-1]  # (N,), or (S, N) for stacked seeds
         if self.tau_type == 'fix':
-            presum_tau = ptu.zeros(len(actions), self.num_quantiles) + 1. / self.num_quantiles
+            presum_tau = ptu.zeros(*rows, self.num_quantiles, torch_device=self.device) + 1. / self.num_quantiles
         elif self.tau_type == 'iqn':  # add 0.1 to prevent tau getting too close
-            presum_tau = ptu.rand(len(actions), self.num_quantiles) + 0.1
+            presum_tau = ptu.rand(*rows, self.num_quantiles, torch_device=self.device) + 0.1
             presum_tau /= presum_tau.sum(dim=-1, keepdims=True)
         elif self.tau_type == 'fqf':
             if fp is None:
                 fp = self.fp
             presum_tau = fp(obs, actions)
-        tau = torch.cumsum(presum_tau, dim=1)  # (N, T), note that they are tau1...tauN in the paper
+        elif self.tau_type in TAU_SAMPLERS:
+            return sample_taus(self.tau_type, rows, self.num_quantiles, self.device)
+        tau = torch.cumsum(presum_tau, dim=-1)  # (N, T), note that they are tau1...tauN in the paper
         with torch.no_grad():
-            tau_hat = ptu.zeros_like(tau)
-            tau_hat[:, 0:1] = tau[:, 0:1] / 2.
-            tau_hat[:, 1:] = (tau[:, 1:] + tau[:, :-1]) / 2.
+            tau_hat = torch.zeros_like(tau)
+            tau_hat[..., 0:1] = tau[..., 0:1] / 2.
+            tau_hat[..., 1:] = (tau[..., 1:] + tau[..., :-1]) / 2.
         return tau, tau_hat, presum_tau
 
     def update_parameters(self, memory, batch_size, updates):
+        return tuple(stack_losses(self._update(memory, updates), self.num_seeds).tolist())
+
+    def _update(self, memory, updates):
         self._n_train_steps_total += 1
         self.updates += 1
 
-        state_batch, action_batch, reward_batch, next_state_batch, mask_batch = memory
-
-        state = torch.FloatTensor(state_batch).to(self.device)
-        next_state = torch.FloatTensor(next_state_batch).to(self.device)
-        action = torch.FloatTensor(action_batch).to(self.device)
-        reward = torch.FloatTensor(reward_batch).to(self.device).unsqueeze(1)
-        done = 1 - torch.FloatTensor(mask_batch).to(self.device).unsqueeze(1)
+        batch = as_batch(memory, self.device, self.num_seeds)
+        state, action, reward, next_state, mask = batch
 
         new_actions, log_pi, _ = self.policy.sample(state)
 
         # Alpha Training
         if self.use_automatic_entropy_tuning:
-            self.alpha_loss = -(self.log_alpha * (log_pi + self.target_entropy).detach()).mean()
+            self.alpha_loss = -seed_mean(self.log_alpha * (log_pi + self.target_entropy).detach(), self.num_seeds)
             self.alpha_optimizer.zero_grad()
-            self.alpha_loss.backward()
+            self.alpha_loss.sum().backward()
             self.alpha_optimizer.step()
             self.alpha = self.log_alpha.exp()
             alpha_tlogs = self.alpha.clone()
 
         else:
-            self.alpha_loss = torch.tensor(0.)
+            self.alpha_loss = torch.tensor(0., device=self.device)
             alpha = self.alpha
-            alpha_tlogs = torch.tensor(self.alpha)
+            alpha_tlogs = torch.tensor(self.alpha, device=self.device)
 
         # version 1 is deprecated (with Pytorch >1.6, version 2 should work fine)
         if self.version == 1:
@@ -199,23 +208,21 @@ class CODAC(object):
 
             with torch.no_grad():
                 new_tau, new_tau_hat, new_presum_tau = self.get_tau(state, new_actions, fp=self.fp)
-            z1_new_actions = self.zf1(state, new_actions, new_tau_hat)
-            z2_new_actions = self.zf2(state, new_actions, new_tau_hat)
+            z_new_actions = self.zf(state, new_actions, new_tau_hat)
 
             with torch.no_grad():
                 risk_weights = distortion_de(new_tau_hat, self.risk_type, risk_param)
-            q1_new_actions = torch.sum(risk_weights * new_presum_tau * z1_new_actions, dim=1, keepdims=True)
-            q2_new_actions = torch.sum(risk_weights * new_presum_tau * z2_new_actions, dim=1, keepdims=True)
-            q_new_actions = torch.min(q1_new_actions, q2_new_actions)
-            self.actor_loss = (self.alpha * log_pi - q_new_actions).mean()
+            q_new_actions = torch.sum(risk_weights * new_presum_tau * z_new_actions, dim=-1, keepdims=True)
+            q_new_actions = actor_value(q_new_actions, self.num_target_critics)
+            self.actor_loss = seed_mean(self.alpha * log_pi - q_new_actions, self.num_seeds)
 
             # Optinally use BC for first few epochs
             if self.updates < self.policy_eval_start and self.use_bc:
                 policy_log_prob = self.policy.log_prob(state, action)
-                self.actor_loss = (self.alpha * log_pi - policy_log_prob).mean()
+                self.actor_loss = seed_mean(self.alpha * log_pi - policy_log_prob, self.num_seeds)
 
             self.optimizer_actor.zero_grad()
-            self.actor_loss.backward()
+            self.actor_loss.sum().backward()
             self.optimizer_actor.step()
 
         """
@@ -224,71 +231,74 @@ class CODAC(object):
         with torch.no_grad():
             new_next_actions, next_log_pi, _ = self.target_policy.sample(next_state)
             next_tau, next_tau_hat, next_presum_tau = self.get_tau(next_state, new_next_actions, fp=self.target_fp)
-            target_z1_values = self.target_zf1(next_state, new_next_actions, next_tau_hat)
-            target_z2_values = self.target_zf2(next_state, new_next_actions, next_tau_hat)
-            target_z_values = torch.min(target_z1_values, target_z2_values) - self.alpha * next_log_pi
-            z_target = reward + (1. - done) * self.gamma * target_z_values
+            target_z_values = self.target_zf(next_state, new_next_actions, next_tau_hat)
+            target_z_values = pessimistic_value(target_z_values, self.num_target_critics) - self.alpha * next_log_pi
+            z_target = reward + mask * self.gamma * target_z_values
 
         tau, tau_hat, presum_tau = self.get_tau(state, action, fp=self.fp)
-        z1_pred = self.zf1(state, action, tau_hat)
-        z2_pred = self.zf2(state, action, tau_hat)
-        self.zf1_loss = self.zf_criterion(z1_pred, z_target, tau_hat, next_presum_tau)
-        self.zf2_loss = self.zf_criterion(z2_pred, z_target, tau_hat, next_presum_tau)
+        # the tau features are shared by the prediction and the penalty below
+        tau_features = self.zf.tau_embedding(tau_hat)
+        z_pred = self.zf.merge(self.zf.trunk(state, action), tau_features)  # (E, [S,] N, T)
+        zf_losses = self.zf_criterion(z_pred, z_target, tau_hat, next_presum_tau, reduction='none')  # (E, [S,] N)
+        # per-sample quantile losses, used as replay priorities
+        self.priorities = zf_losses.mean(dim=0).detach()
+        self.zf_loss = weighted_mean(zf_losses, batch.weights)  # (E, [S])
+        alpha_prime_loss = None
 
         # perform CODAC penalty
         if self.dist_penalty_type != 'none':
-            random_actions_tensor = torch.FloatTensor(z2_pred.shape[0] * self.num_random, action.shape[-1]).uniform_(-1,1).to(self.device)
-            curr_actions_tensor, curr_log_pis = self._get_policy_actions(state, num_actions=self.num_random,
-                                                                         network=self.policy)
-            new_curr_actions_tensor, new_log_pis = self._get_policy_actions(next_state, num_actions=self.num_random,
-                                                                            network=self.policy)
+            *rows, N, A = action.shape
+            random_actions_tensor = torch.empty(*rows, N, self.num_random, A, device=self.device).uniform_(-1, 1)
+            # one policy sample gives the current-policy actions at both state and next_state
+            policy_actions, policy_log_pis = self._get_policy_actions(torch.cat([state, next_state], dim=-2),
+                                                                      num_actions=self.num_random,
+                                                                      network=self.policy)
+            curr_actions_tensor, new_curr_actions_tensor = policy_actions.view(*rows, 2, N, self.num_random, A).unbind(-4)
+            curr_log_pis, new_log_pis = policy_log_pis.view(*rows, 2, N, self.num_random, 1).unbind(-4)
 
             penalty_index = np.random.randint(0, self.num_quantiles)
-            truncated_tau_hat = tau_hat[:, penalty_index: penalty_index+1]
-
-            z1_rand, z2_rand = self._get_tensor_values(state, random_actions_tensor, truncated_tau_hat)
-            z1_curr_actions, z2_curr_actions = self._get_tensor_values(state, curr_actions_tensor, truncated_tau_hat)
-            z1_next_actions, z2_next_actions = self._get_tensor_values(state, new_curr_actions_tensor, truncated_tau_hat)
+            truncated_tau_features = tau_features[..., penalty_index: penalty_index+1, :]
 
-            random_density = np.log(0.5 ** curr_actions_tensor.shape[-1])
-            cat_z1 = torch.cat(
-                [z1_rand - random_density, z1_next_actions - new_log_pis.detach(),
-                 z1_curr_actions - curr_log_pis.detach()], 1
-            )
-            cat_z2 = torch.cat(
-                [z2_rand - random_density, z2_next_actions - new_log_pis.detach(),
-                 z2_curr_actions - curr_log_pis.detach()], 1
-            )
+            # the three action sets go through the critics in a single pass
+            random_density = np.log(0.5 ** A)
+            penalty_actions = torch.cat([random_actions_tensor, new_curr_actions_tensor, curr_actions_tensor], -2)
+            penalty_log_pis = torch.cat([torch.full_like(curr_log_pis, random_density), new_log_pis, curr_log_pis], -2)
+            z_penalty = self.zf.merge(self.zf.trunk(state, penalty_actions), truncated_tau_features)
+            cat_z = z_penalty - penalty_log_pis  # (E, [S,] N, 3R, 1)
 
-            min_zf1_loss = torch.logsumexp(cat_z1, dim=1, ).mean()
-            min_zf2_loss = torch.logsumexp(cat_z2, dim=1, ).mean()
+            min_zf_loss = torch.logsumexp(cat_z, dim=-2, ).mean(dim=(-2, -1))
 
-            min_zf1_loss = (min_zf1_loss - z1_pred.mean()) * self.min_z_weight
-            min_zf2_loss = (min_zf2_loss - z2_pred.mean()) * self.min_z_weight
+            min_zf_loss = (min_zf_loss - z_pred.mean(dim=(-2, -1))) * self.min_z_weight
 
             if self.with_lagrange:
                 alpha_prime = torch.clamp(self.log_alpha_prime.exp(), min=0.0, max=1000000.0)
-                min_zf1_loss = alpha_prime * (min_zf1_loss - self.target_action_gap)
-                min_zf2_loss = alpha_prime * (min_zf2_loss - self.target_action_gap)
-
-                self.alpha_prime_optimizer.zero_grad()
-                alpha_prime_loss = (-min_zf1_loss - min_zf2_loss) * 0.5
-                alpha_prime_loss.backward(retain_graph=True)
-                self.alpha_prime_optimizer.step()
-
-            self.zf1_loss = self.zf1_loss + min_zf1_loss
-            self.zf2_loss = self.zf2_loss + min_zf2_loss
-
-        self.zf1_optimizer.zero_grad()
-        self.zf1_loss.backward(retain_graph=True)
-        self.zf1_optimizer.step()
+                if self.version == 3:
+                    # the critics treat alpha_prime as a constant and the multiplier treats the
+                    # gap as one, so both losses can share the graph and a single backward
+                    action_gap = min_zf_loss - self.target_action_gap
+                    alpha_prime_loss = -(alpha_prime * action_gap.detach()).mean(dim=0).sum()
+                    min_zf_loss = alpha_prime.detach() * action_gap
+                else:
+                    min_zf_loss = alpha_prime * (min_zf_loss - self.target_action_gap)
+
+                    self.alpha_prime_optimizer.zero_grad()
+                    alpha_prime_loss = -min_zf_loss.mean(dim=0)
+                    alpha_prime_loss.sum().backward(retain_graph=True)
+                    self.alpha_prime_optimizer.step()
+
+            self.zf_loss = self.zf_loss + min_zf_loss
+
+        # members and seeds are independent, so the summed loss trains each on its own
+        critic_loss = self.zf_loss.sum()
+        if self.version == 3 and alpha_prime_loss is not None:
+            critic_loss = critic_loss + alpha_prime_loss
+        self.zf_optimizer.zero_grad()
+        critic_loss.backward()
+        self.zf_optimizer.step()
+
+        # version 3 updates the actor as version 2 does, on the updated critics
+        if self.version >= 2:
 
-        self.zf2_optimizer.zero_grad()
-        self.zf2_loss.backward(retain_graph=True)
-        self.zf2_optimizer.step()
-
-        if self.version == 2:
-            
             risk_param = self.risk_param
             if self.risk_type == 'cvar':
                 if self.risk_linear == "true":
@@ -297,51 +307,50 @@ class CODAC(object):
             with torch.no_grad():
                 new_tau, new_tau_hat, new_presum_tau = self.get_tau(state, new_actions, fp=self.fp)
 
-            z1_new_actions = self.zf1(state, new_actions, new_tau_hat)
-            z2_new_actions = self.zf2(state, new_actions, new_tau_hat)
+            z_new_actions = self.zf(state, new_actions, new_tau_hat)
             with torch.no_grad():
                 risk_weights = distortion_de(new_tau_hat, self.risk_type, risk_param)
 
-            q1_new_actions = torch.sum(risk_weights * new_presum_tau * z1_new_actions, dim=1, keepdims=True)
-            q2_new_actions = torch.sum(risk_weights * new_presum_tau * z2_new_actions, dim=1, keepdims=True)
-            q_new_actions = torch.min(q1_new_actions, q2_new_actions)
-            self.actor_loss = (self.alpha * log_pi - q_new_actions).mean()
+            q_new_actions = torch.sum(risk_weights * new_presum_tau * z_new_actions, dim=-1, keepdims=True)
+            q_new_actions = actor_value(q_new_actions, self.num_target_critics)
+            self.actor_loss = seed_mean(self.alpha * log_pi - q_new_actions, self.num_seeds)
 
             # Optinally use BC for first few epochs
             if self.updates < self.policy_eval_start and self.use_bc:
                 policy_log_prob = self.policy.log_prob(state, action)
-                self.actor_loss = (self.alpha * log_pi - policy_log_prob).mean()
+                self.actor_loss = seed_mean(self.alpha * log_pi - policy_log_prob, self.num_seeds)
 
             self.optimizer_actor.zero_grad()
-            self.actor_loss.backward()
+            self.actor_loss.sum().backward()
             self.optimizer_actor.step()
 
         # soft target update
         if self.updates % self.target_update_period == 0:
             ptu.soft_update_from_to(self.policy, self.target_policy, self.soft_target_tau)
-            ptu.soft_update_from_to(self.zf1, self.target_zf1, self.soft_target_tau)
-            ptu.soft_update_from_to(self.zf2, self.target_zf2, self.soft_target_tau)
+            ptu.soft_update_from_to(self.zf, self.target_zf, self.soft_target_tau)
 
-        return self.zf1_loss.item(), self.zf2_loss.item(), self.actor_loss.item(), self.alpha_loss.item(), alpha_tlogs.item()
+        return self.zf_loss.mean(dim=0), self.actor_loss, self.alpha_loss, alpha_tlogs
 
     # Save model parameters
+    def model_state_dicts(self, path):
+        return {path + '-actor.pt': self.policy.state_dict(),
+                path + '-critic.pt': self.zf.state_dict()}
+
     def save_model(self, path):
         if not os.path.exists('saved_policies/'):
             os.makedirs('saved_policies/')
 
-        actor_path = path+'-actor.pt'
-        critic1_path = path + '-critic1.pt'
-        critic2_path = path + '-critic2.pt'
-        torch.save(self.policy.state_dict(), actor_path)
-        torch.save(self.zf1.state_dict(), critic1_path)
-        torch.save(self.zf2.state_dict(), critic2_path)
+        for model_path, state_dict in self.model_state_dicts(path).items():
+            torch.save(state_dict, model_path)
 
 
     # Load model parameters
     def load_model(self, path):
         actor_path = path+'-actor.pt'
-        critic1_path = path + '-critic1.pt'
-        critic2_path = path + '-critic2.pt'
+        critic_path = path + '-critic.pt'
         self.policy.load_state_dict(torch.load(actor_path))
-        self.zf1.load_state_dict(torch.load(critic1_path))
-        self.zf2.load_state_dict(torch.load(critic2_path))
\ No newline at end of file
+        if os.path.exists(critic_path):
+            self.zf.load_state_dict(torch.load(critic_path))
+        else:
+            # policies saved before the critic ensemble: one file per critic
+            self.zf.load_member_state_dicts([torch.load(f'{path}-critic{i + 1}.pt') for i in range(self.zf.ensemble_size)])
\ No newline at end of file
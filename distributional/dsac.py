@@ -6,29 +6,77 @@ import os
 import wandb
 
 from distributional.risks import *
-from distributional.networks import QuantileMlp
+from distributional.networks import QuantileMlpEnsemble, pessimistic_value, actor_value
+from distributional.tau_samplers import TAU_SAMPLERS, sample_taus
 from distributional.util import LinearSchedule
 from sac.model import GaussianPolicy
+from sac.batch import as_batch
+from sac.utils import MultiStepUpdater, ENSEMBLE_LOSS_NAMES, stack_losses, resolve_device
 
 
-def quantile_regression_loss(input, target, tau, weight):
+def _quantile_huber_block(input, target, tau, weight):
+    """Pairwise terms of quantile inputs (..., N, c) against all targets (N, T): (..., N, c, T)"""
+    diff = input.unsqueeze(-1) - target.unsqueeze(-2)
+    sign = torch.sign(diff) / 2. + 0.5
+    return diff, torch.abs(tau.unsqueeze(-1) - sign) * weight.unsqueeze(-2)
+
+
+class QuantileHuberLoss(torch.autograd.Function):
+    """
+    Per-sample quantile Huber loss, computed block by block over the input
+    quantiles. Only the inputs are kept for backward, which recomputes the
+    pairwise terms one block at a time, so memory grows as N * chunk_size * T
+    instead of N * T * T.
+    """
+    @staticmethod
+    def forward(ctx, input, target, tau, weight, chunk_size):
+        ctx.save_for_backward(input, target, tau, weight)
+        ctx.chunk_size = chunk_size
+        T = input.shape[-1]
+        loss = 0.
+        for start in range(0, T, chunk_size):
+            end = start + chunk_size
+            diff, coef = _quantile_huber_block(input[..., start:end], target, tau[..., start:end], weight)
+            L = F.smooth_l1_loss(diff, torch.zeros_like(diff), reduction='none')
+            loss = loss + (coef * L).sum(dim=(-2, -1))
+        return loss / T  # (..., N)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, target, tau, weight = ctx.saved_tensors
+        T = input.shape[-1]
+        grad_input = torch.empty_like(input)
+        for start in range(0, T, ctx.chunk_size):
+            end = start + ctx.chunk_size
+            diff, coef = _quantile_huber_block(input[..., start:end], target, tau[..., start:end], weight)
+            grad_input[..., start:end] = (coef * diff.clamp(-1., 1.)).sum(dim=-1)
+        return grad_input * (grad_output.unsqueeze(-1) / T), None, None, None, None
+
+
+def quantile_regression_loss(input, target, tau, weight, reduction='mean', chunk_size=8):
     """
     input: (N, T)
     target: (N, T)
     tau: (N, T)
+    reduction: 'mean', or 'none' for the (N,) per-sample losses
+    chunk_size: input quantiles per block, see QuantileHuberLoss
     """
-    input = input.unsqueeze(-1)
-    target = target.detach().unsqueeze(-2)
-    tau = tau.detach().unsqueeze(-1)
-    weight = weight.detach().unsqueeze(-2)
-    expanded_input, expanded_target = torch.broadcast_tensors(input, target)
-    L = F.smooth_l1_loss(expanded_input, expanded_target, reduction="none")  # (N, T, T)
-    sign = torch.sign(expanded_input - expanded_target) / 2. + 0.5
-    rho = torch.abs(tau - sign) * L * weight
-    return rho.sum(dim=-1).mean()
-
-
-class DSAC(object):
+    losses = QuantileHuberLoss.apply(input, target.detach(), tau.detach(), weight.detach(), chunk_size)
+    if reduction == 'none':
+        return losses
+    return losses.mean()
+
+
+def weighted_mean(losses, weights=None):
+    """Mean of per-sample losses, scaled by the importance weights of a prioritized batch."""
+    if weights is None:
+        return losses.mean(dim=-1)
+    return (weights.view(-1) * losses).mean(dim=-1)
+
+
+class DSAC(MultiStepUpdater):
+    loss_names = ENSEMBLE_LOSS_NAMES
+
     def __init__(self, num_inputs, action_space,
                  ## SAC params
                  gamma=0.99,
@@ -48,17 +96,19 @@ class DSAC(object):
                  risk_type='cvar',
                  risk_param=0.1,
                  tau_type='iqn',
-                 device='cuda'):
+                 num_critics=2,
+                 num_target_critics=2,
+                 device='auto'):
 
         self.gamma = gamma
 
-        self.device = device
+        self.device = resolve_device(device)
         self.risk_type = risk_type
         self.risk_param = risk_param
         self.risk_schedule = LinearSchedule(1, risk_param, risk_param)
 
         self.tau_type = tau_type
-        assert(self.tau_type=='iqn')
+        assert(self.tau_type=='iqn' or self.tau_type in TAU_SAMPLERS)
         self.fp = None
         self.target_fp = None
 
@@ -68,32 +118,24 @@ class DSAC(object):
         self.num_random = num_random
         self.min_z_weight = min_z_weight
 
-        self.zf1 = QuantileMlp(input_size=num_inputs+action_space.shape[0],
-                          output_size=1,
-                          num_quantiles=num_quantiles,
-                          hidden_sizes=[hidden_size, hidden_size]).to(self.device)
-        self.zf2 = QuantileMlp(input_size=num_inputs+action_space.shape[0],
-                          output_size=1,
-                          num_quantiles=num_quantiles,
-                          hidden_sizes=[hidden_size, hidden_size]).to(self.device)
-        self.target_zf1 = QuantileMlp(input_size=num_inputs+action_space.shape[0],
+        self.num_critics = num_critics
+        self.num_target_critics = num_target_critics
+        self.zf = QuantileMlpEnsemble(num_critics,
+                          input_size=num_inputs+action_space.shape[0],
                           output_size=1,
                           num_quantiles=num_quantiles,
                           hidden_sizes=[hidden_size, hidden_size]).to(self.device)
-        self.target_zf2 = QuantileMlp(input_size=num_inputs+action_space.shape[0],
+        self.target_zf = QuantileMlpEnsemble(num_critics,
+                          input_size=num_inputs+action_space.shape[0],
                           output_size=1,
                           num_quantiles=num_quantiles,
                           hidden_sizes=[hidden_size, hidden_size]).to(self.device)
 
         self.zf_criterion = quantile_regression_loss
-        self.zf1_optimizer = Adam(
-            self.zf1.parameters(),
+        self.zf_optimizer = Adam(
+            self.zf.parameters(),
             lr=critic_lr,
         )
-        self.zf2_optimizer = Adam(
-            self.zf2.parameters(),
-            lr=critic_lr
-        )
 
         self.use_automatic_entropy_tuning = use_automatic_entropy_tuning
         # Target Entropy = −dim(A) (e.g. , -6 for HalfCheetah-v2) as given in the paper
@@ -110,44 +152,31 @@ class DSAC(object):
 
         self.optimizer_actor = Adam(self.policy.parameters(), lr=actor_lr)
 
-    def _get_tensor_values(self, obs, actions, tau):
-        action_shape = actions.shape[0]
-        obs_shape = obs.shape[0]
-        num_repeat = int(action_shape / obs_shape)
-        obs_temp = obs.unsqueeze(1).repeat(1, num_repeat, 1).view(obs.shape[0] * num_repeat, obs.shape[1])
-        tau_temp = tau.unsqueeze(1).repeat(1, num_repeat, 1).view(tau.shape[0] * num_repeat, tau.shape[1])
-
-        pred1 = self.zf1(obs_temp, actions, tau_temp)
-        pred2 = self.zf2(obs_temp, actions, tau_temp)
-        pred1 = pred1.view(obs.shape[0], num_repeat, -1)
-        pred2 = pred2.view(obs.shape[0], num_repeat, -1)
-        return pred1, pred2
-
     def get_tau(self, obs, actions, fp=None):
         if self.tau_type == 'fix':
-            presum_tau = ptu.zeros(len(actions), self.num_quantiles) + 1. / self.num_quantiles
+            presum_tau = ptu.zeros(len(actions), self.num_quantiles, torch_device=self.device) + 1. / self.num_quantiles
         elif self.tau_type == 'iqn':  # add 0.1 to prevent tau getting too close
-            presum_tau = ptu.rand(len(actions), self.num_quantiles) + 0.1
+            presum_tau = ptu.rand(len(actions), self.num_quantiles, torch_device=self.device) + 0.1
             presum_tau /= presum_tau.sum(dim=-1, keepdims=True)
         elif self.tau_type == 'fqf':
             if fp is None:
                 fp = self.fp
             presum_tau = fp(obs, actions)
+        elif self.tau_type in TAU_SAMPLERS:
+            return sample_taus(self.tau_type, len(actions), self.num_quantiles, self.device)
         tau = torch.cumsum(presum_tau, dim=1)  # (N, T), note that they are tau1...tauN in the paper
         with torch.no_grad():
-            tau_hat = ptu.zeros_like(tau)
+            tau_hat = torch.zeros_like(tau)
             tau_hat[:, 0:1] = tau[:, 0:1] / 2.
             tau_hat[:, 1:] = (tau[:, 1:] + tau[:, :-1]) / 2.
         return tau, tau_hat, presum_tau
 
     def update_parameters(self, memory, batch_size, updates):
-        state_batch, action_batch, reward_batch, next_state_batch, mask_batch = memory
+        return tuple(stack_losses(self._update(memory, updates)).tolist())
 
-        state = torch.FloatTensor(state_batch).to(self.device)
-        next_state = torch.FloatTensor(next_state_batch).to(self.device)
-        action = torch.FloatTensor(action_batch).to(self.device)
-        reward = torch.FloatTensor(reward_batch).to(self.device).unsqueeze(1)
-        done = 1 - torch.FloatTensor(mask_batch).to(self.device).unsqueeze(1)
+    def _update(self, memory, updates):
+        batch = as_batch(memory, self.device)
+        state, action, reward, next_state, mask = batch
 
         new_actions, log_pi, _ = self.policy.sample(state)
         # Alpha Training
@@ -160,9 +189,9 @@ class DSAC(object):
             alpha_tlogs = self.alpha.clone()
 
         else:
-            self.alpha_loss = torch.tensor(0.)
+            self.alpha_loss = torch.tensor(0., device=self.device)
             alpha = self.alpha
-            alpha_tlogs = torch.tensor(self.alpha)
+            alpha_tlogs = torch.tensor(self.alpha, device=self.device)
 
         """
         Update ZF 
@@ -170,26 +199,22 @@ class DSAC(object):
         with torch.no_grad():
             new_next_actions, next_log_pi, _ = self.target_policy.sample(next_state)
             next_tau, next_tau_hat, next_presum_tau = self.get_tau(next_state, new_next_actions, fp=self.target_fp)
-            target_z1_values = self.target_zf1(next_state, new_next_actions, next_tau_hat)
-            target_z2_values = self.target_zf2(next_state, new_next_actions, next_tau_hat)
-            target_z_values = torch.min(target_z1_values, target_z2_values) - self.alpha * next_log_pi
-            z_target = reward + (1. - done) * self.gamma * target_z_values
+            target_z_values = self.target_zf(next_state, new_next_actions, next_tau_hat)
+            target_z_values = pessimistic_value(target_z_values, self.num_target_critics) - self.alpha * next_log_pi
+            z_target = reward + mask * self.gamma * target_z_values
 
         tau, tau_hat, presum_tau = self.get_tau(state, action, fp=self.fp)
         # shouldn't next_tau_hat be used in the next few lines?
-        z1_pred = self.zf1(state, action, tau_hat)
-        z2_pred = self.zf2(state, action, tau_hat)
+        z_pred = self.zf(state, action, tau_hat)  # (E, N, T)
         # presum_tau is the tau_{i+1}-tau_i in the paper
-        self.zf1_loss = self.zf_criterion(z1_pred, z_target, tau_hat, next_presum_tau)
-        self.zf2_loss = self.zf_criterion(z2_pred, z_target, tau_hat, next_presum_tau)
-
-        self.zf1_optimizer.zero_grad()
-        self.zf1_loss.backward(retain_graph=True)
-        self.zf1_optimizer.step()
+        zf_losses = self.zf_criterion(z_pred, z_target, tau_hat, next_presum_tau, reduction='none')  # (E, N)
+        # per-sample quantile losses, used as replay priorities
+        self.priorities = zf_losses.mean(dim=0).detach()
+        self.zf_loss = weighted_mean(zf_losses, batch.weights)  # (E,)
 
-        self.zf2_optimizer.zero_grad()
-        self.zf2_loss.backward(retain_graph=True)
-        self.zf2_optimizer.step()
+        self.zf_optimizer.zero_grad()
+        self.zf_loss.sum().backward()
+        self.zf_optimizer.step()
 
         """
         Update Policy
@@ -198,13 +223,11 @@ class DSAC(object):
 
         with torch.no_grad():
             new_tau, new_tau_hat, new_presum_tau = self.get_tau(state, new_actions, fp=self.fp)
-        z1_new_actions = self.zf1(state, new_actions, new_tau_hat)
-        z2_new_actions = self.zf2(state, new_actions, new_tau_hat)
+        z_new_actions = self.zf(state, new_actions, new_tau_hat)
         with torch.no_grad():
             risk_weights = distortion_de(new_tau_hat, self.risk_type, risk_param)
-        q1_new_actions = torch.sum(risk_weights * new_presum_tau * z1_new_actions, dim=1, keepdims=True)
-        q2_new_actions = torch.sum(risk_weights * new_presum_tau * z2_new_actions, dim=1, keepdims=True)
-        q_new_actions = torch.min(q1_new_actions, q2_new_actions)
+        q_new_actions = torch.sum(risk_weights * new_presum_tau * z_new_actions, dim=2, keepdims=True)
+        q_new_actions = actor_value(q_new_actions, self.num_target_critics)
 
         self.actor_loss = (self.alpha * log_pi - q_new_actions).mean()
         self.optimizer_actor.zero_grad()
@@ -214,29 +237,30 @@ class DSAC(object):
         # soft target update
         if updates % self.target_update_period == 0:
             ptu.soft_update_from_to(self.policy, self.target_policy, self.soft_target_tau)
-            ptu.soft_update_from_to(self.zf1, self.target_zf1, self.soft_target_tau)
-            ptu.soft_update_from_to(self.zf2, self.target_zf2, self.soft_target_tau)
+            ptu.soft_update_from_to(self.zf, self.target_zf, self.soft_target_tau)
 
-        return self.zf1_loss.item(), self.zf2_loss.item(), self.actor_loss.item(), self.alpha_loss.item(), alpha_tlogs.item()
+        return self.zf_loss.mean(dim=0), self.actor_loss, self.alpha_loss, alpha_tlogs
 
     # Save model parameters
+    def model_state_dicts(self, path):
+        return {path + '-actor.pt': self.policy.state_dict(),
+                path + '-critic.pt': self.zf.state_dict()}
+
     def save_model(self, path):
         if not os.path.exists('saved_policies/'):
             os.makedirs('saved_policies/')
 
-        actor_path = path+'-actor.pt'
-        critic1_path = path + '-critic1.pt'
-        critic2_path = path + '-critic2.pt'
-        torch.save(self.policy.state_dict(), actor_path)
-        torch.save(self.zf1.state_dict(), critic1_path)
-        torch.save(self.zf2.state_dict(), critic2_path)
+        for model_path, state_dict in self.model_state_dicts(path).items():
+            torch.save(state_dict, model_path)
 
 
     # Load model parameters
     def load_model(self, path):
         actor_path = path+'-actor.pt'
-        critic1_path = path + '-critic1.pt'
-        critic2_path = path + '-critic2.pt'
+        critic_path = path + '-critic.pt'
         self.policy.load_state_dict(torch.load(actor_path))
-        self.zf1.load_state_dict(torch.load(critic1_path))
-        self.zf2.load_state_dict(torch.load(critic2_path))
\ No newline at end of file
+        if os.path.exists(critic_path):
+            self.zf.load_state_dict(torch.load(critic_path))
+        else:
+            # policies saved before the critic ensemble: one file per critic
+            self.zf.load_member_state_dicts([torch.load(f'{path}-critic{i + 1}.pt') for i in range(self.zf.ensemble_size)])
\ No newline at end of file
@@ -1,86 +1,258 @@
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
-class QuantileMlp(nn.Module):
+def pessimistic_value(z, subset_size):
+    """
+    Elementwise min over the leading ensemble dimension of z, taken over a
+    random subset of subset_size members as in REDQ when that is smaller
+    than the ensemble.
+    """
+    if subset_size < z.shape[0]:
+        z = z[torch.randperm(z.shape[0], device=z.device)[:subset_size]]
+    return z.min(dim=0)[0]
 
+
+def actor_value(q, subset_size):
+    """
+    Value the policy maximizes given the (E, ...) member values q: the min
+    over all members, as in the two-critic CODAC/DSAC policy loss, or the
+    mean over all members as in REDQ when the targets use a random subset
+    (subset_size smaller than the ensemble, see pessimistic_value).
+    """
+    if subset_size < q.shape[0]:
+        return q.mean(dim=0)
+    return q.min(dim=0)[0]
+
+
+def ensemble_linear_params(ensemble_size, in_features, out_features):
+    """
+    Stacked weights (E, in, out) and biases (E, 1, out) with the nn.Linear
+    default init. ensemble_size may also be a tuple of leading dims.
+    """
+    shape = tuple(np.atleast_1d(ensemble_size))
+    bound = 1. / np.sqrt(in_features)
+    w = nn.Parameter(torch.empty(*shape, in_features, out_features).uniform_(-bound, bound))
+    b = nn.Parameter(torch.empty(*shape, 1, out_features).uniform_(-bound, bound))
+    return w, b
+
+
+def ensemble_layer_norm_params(ensemble_size, size):
+    shape = tuple(np.atleast_1d(ensemble_size))
+    return nn.Parameter(torch.ones(*shape, 1, size)), nn.Parameter(torch.zeros(*shape, 1, size))
+
+
+def _flat(p):
+    # (E, [S,] ..., x, y) stacked parameters as (E * [S *] ..., x, y) for bmm
+    return None if p is None else p.view(-1, *p.shape[-2:])
+
+
+def stack_quantile_mlp_state_dicts(state_dicts):
+    """
+    QuantileMlpEnsemble state dict from the state dicts of separate
+    nn.Sequential-based critics (base_fc, tau_fc, merge_fc, last_fc), the
+    format of the older -critic1.pt/-critic2.pt files, one per member.
+    """
+    def stack(key, linear):
+        values = [state_dict[key] for state_dict in state_dicts]
+        if linear and key.endswith('.weight'):
+            values = [value.t() for value in values]
+        return torch.stack([value.unsqueeze(0) if value.dim() == 1 else value for value in values])
+
+    first = state_dicts[0]
+    base = sorted({int(key.split('.')[1]) for key in first if key.startswith('base_fc.')})
+    linear_idx = [i for i in base if first[f'base_fc.{i}.weight'].dim() == 2]
+    state = {}
+    for k, i in enumerate(linear_idx):
+        state[f'base_w.{k}'], state[f'base_b.{k}'] = stack(f'base_fc.{i}.weight', True), stack(f'base_fc.{i}.bias', True)
+        if f'base_fc.{i + 1}.weight' in first:
+            state[f'base_ln_w.{k}'] = stack(f'base_fc.{i + 1}.weight', False)
+            state[f'base_ln_b.{k}'] = stack(f'base_fc.{i + 1}.bias', False)
+    for name, prefix in (('tau', 'tau_fc'), ('merge', 'merge_fc')):
+        state[f'{name}_w'], state[f'{name}_b'] = stack(f'{prefix}.0.weight', True), stack(f'{prefix}.0.bias', True)
+        if f'{prefix}.1.weight' in first:
+            state[f'{name}_ln_w'], state[f'{name}_ln_b'] = stack(f'{prefix}.1.weight', False), stack(f'{prefix}.1.bias', False)
+    state['last_w'], state['last_b'] = stack('last_fc.weight', True), stack('last_fc.bias', True)
+    return state
+
+
+class QuantileMlpEnsemble(nn.Module):
+    """
+    E independent IQN-style quantile critics evaluated together.
+
+    Like models/ensemble.py::ProbEnsemble, every layer keeps the weights of all
+    members stacked as (E, in, out), so each layer is one batched matmul for
+    the whole ensemble. Inputs are shared by all members and forward returns
+    (E, N, T) quantile values. forward is merge(trunk(s, a), tau_embedding(tau));
+    callers can compute the tau features once and merge them with the trunk
+    features of several action sets.
+
+    With num_seeds, the ensemble holds S independent replicas of itself for a
+    stacked multi-seed agent: parameters are (E, S, in, out), inputs carry a
+    leading seed dim (S, N, ...) and outputs are (E, S, N, T). LayerNorm
+    parameters only exist with layer_norm=True; otherwise they are None.
+    """
     def __init__(
             self,
+            ensemble_size,
             hidden_sizes,
             output_size,
             input_size,
             embedding_size=64,
             num_quantiles=32,
             layer_norm=True,
+            num_seeds=None,
             **kwargs,
     ):
         super().__init__()
+        self.ensemble_size = ensemble_size
         self.layer_norm = layer_norm
-        # hidden_sizes[:-2] MLP base
-        # hidden_sizes[-2] before merge
-        # hidden_sizes[-1] before output
+        self.num_quantiles = num_quantiles
+        self.embedding_size = embedding_size
+
+        last_size = self._init_base(input_size, hidden_sizes[:-1], num_seeds)
+        self.tau_w, self.tau_b = ensemble_linear_params(self.shape, embedding_size, last_size)
+        self.tau_ln_w, self.tau_ln_b = self._layer_norm_params(last_size)
+        self.merge_w, self.merge_b = ensemble_linear_params(self.shape, last_size, hidden_sizes[-1])
+        self.merge_ln_w, self.merge_ln_b = self._layer_norm_params(hidden_sizes[-1])
+        self.last_w, self.last_b = ensemble_linear_params(self.shape, hidden_sizes[-1], 1)
+        self.register_buffer('const_vec', torch.arange(1, 1 + embedding_size, dtype=torch.float32))
 
-        self.base_fc = []
+    def _init_base(self, input_size, hidden_sizes, num_seeds=None):
+        if not hidden_sizes:
+            raise ValueError('QuantileMlpEnsemble needs at least two hidden layers')
+        # leading dims of every stacked parameter
+        self.shape = (self.ensemble_size,) if num_seeds is None else (self.ensemble_size, num_seeds)
+        self.base_w, self.base_b = nn.ParameterList(), nn.ParameterList()
+        self.base_ln_w, self.base_ln_b = nn.ParameterList(), nn.ParameterList()
         last_size = input_size
-        for next_size in hidden_sizes[:-1]:
-            self.base_fc += [
-                nn.Linear(last_size, next_size),
-                nn.LayerNorm(next_size) if layer_norm else nn.Identity(),
-                nn.ReLU(inplace=True),
-            ]
+        for next_size in hidden_sizes:
+            w, b = ensemble_linear_params(self.shape, last_size, next_size)
+            self.base_w.append(w)
+            self.base_b.append(b)
+            if self.layer_norm:
+                ln_w, ln_b = ensemble_layer_norm_params(self.shape, next_size)
+                self.base_ln_w.append(ln_w)
+                self.base_ln_b.append(ln_b)
             last_size = next_size
-        self.base_fc = nn.Sequential(*self.base_fc)
-        self.num_quantiles = num_quantiles
-        self.embedding_size = embedding_size
-        self.tau_fc = nn.Sequential(
-            nn.Linear(embedding_size, last_size),
-            nn.LayerNorm(last_size) if layer_norm else nn.Identity(),
-            nn.Sigmoid(),
-        )
-        self.merge_fc = nn.Sequential(
-            nn.Linear(last_size, hidden_sizes[-1]),
-            nn.LayerNorm(hidden_sizes[-1]) if layer_norm else nn.Identity(),
-            nn.ReLU(inplace=True),
-        )
-        self.last_fc = nn.Linear(hidden_sizes[-1], 1)
-        self.const_vec = torch.from_numpy(np.arange(1, 1 + self.embedding_size)).float().to('cuda')
+        return last_size
 
-    def forward(self, state, action, tau):
+    def _layer_norm_params(self, size):
+        if not self.layer_norm:
+            return None, None
+        return ensemble_layer_norm_params(self.shape, size)
+
+    def _base_layers(self):
+        if self.layer_norm:
+            return list(zip(self.base_w, self.base_b, self.base_ln_w, self.base_ln_b))
+        return [(w, b, None, None) for w, b in zip(self.base_w, self.base_b)]
+
+    def load_member_state_dicts(self, state_dicts):
+        """Load one state dict per member in the older separate-critic format."""
+        state = self.state_dict()
+        state.update(stack_quantile_mlp_state_dicts(state_dicts))
+        self.load_state_dict(state)
+
+    def _norm(self, h, w, b):
+        if not self.layer_norm:
+            return h
+        return F.layer_norm(h, h.shape[-1:]) * w + b
+
+    def _base(self, h, layers):
+        for w, b, ln_w, ln_b in layers:
+            h = F.relu(self._norm(torch.matmul(h, w) + b, ln_w, ln_b))
+        return h
+
+    def _head(self, h):
+        """Features (E, [S,] ..., C) -> merge and last layer outputs (E * [S], -1, out)"""
+        h = h.reshape(int(np.prod(self.shape)), -1, h.shape[-1])
+        h = F.relu(self._norm(torch.baddbmm(_flat(self.merge_b), h, _flat(self.merge_w)),
+                              _flat(self.merge_ln_w), _flat(self.merge_ln_b)))
+        return torch.baddbmm(_flat(self.last_b), h, _flat(self.last_w))
+
+    def tau_embedding(self, tau):
+        """tau: quantile fractions ([S,] N, T) -> (E, [S,] N, T, C), reusable across action sets."""
+        x = torch.cos(tau.unsqueeze(-1) * self.const_vec * np.pi)  # ([S,] N, T, emb)
+        x = x.view(*tau.shape[:-2], -1, x.shape[-1])  # ([S,] N * T, emb)
+        x = torch.sigmoid(self._norm(torch.matmul(x, self.tau_w) + self.tau_b, self.tau_ln_w, self.tau_ln_b))
+        return x.view(self.ensemble_size, *tau.shape, -1)
+
+    def trunk(self, state, action):
         """
-        Calculate Quantile Value in Batch
-        tau: quantile fractions, (N, T)
+        State-action features, (E, [S,] N, C) for action ([S,] N, A) or
+        (E, [S,] N, R, C) for R actions per state, ([S,] N, R, A), without
+        repeating the states.
         """
-        h = torch.cat([state, action], dim=1)
-        h = self.base_fc(h)  # (N, C)
-
-        x = torch.cos(tau.unsqueeze(-1) * self.const_vec * np.pi)  # (N, T, E)
-        x = self.tau_fc(x)  # (N, T, C)
+        layers = self._base_layers()
+        if action.dim() == state.dim():
+            return self._base(torch.cat([state, action], dim=-1), layers)  # (E, [S,] N, C)
+        R, A = action.shape[-2:]
+        # the first layer is W_s s + W_a a + b, so the state term is computed once per state
+        w, b, ln_w, ln_b = layers.pop(0)
+        h = torch.matmul(state, w[..., :-A, :]).unsqueeze(-2) + torch.matmul(action, w[..., -A:, :].unsqueeze(-3))
+        h = (h + b.unsqueeze(-2)).flatten(-3, -2)
+        h = self._base(F.relu(self._norm(h, ln_w, ln_b)), layers)
+        return h.view(*h.shape[:-2], -1, R, h.shape[-1])  # (E, [S,] N, R, C)
 
-        h = torch.mul(x, h.unsqueeze(-2))  # (N, T, C)
-        h = self.merge_fc(h)  # (N, T, C)
-        output = self.last_fc(h).squeeze(-1)  # (N, T)
-        return output
+    def merge(self, h, x):
+        """Trunk features (E, [S,] N, [R,] C) and tau features (E, [S,] N, T, C) -> quantile values (E, [S,] N, [R,] T)"""
+        T, C = x.shape[-2:]
+        x = x.view(*x.shape[:-2], *([1] * (h.dim() - x.dim() + 1)), T, C)
+        h = x * h.unsqueeze(-2)  # (E, [S,] N, [R,] T, C)
+        return self._head(h).view(h.shape[:-1])
 
-    def penultimate_layer(self, state, action):
+    def forward(self, state, action, tau):
         """
-        Calculate Quantile Value in Batch
-        tau: quantile fractions, (N, T)
+        state: ([S,] N, D), action: ([S,] N, A), tau: quantile fractions ([S,] N, T)
+        returns: (E, [S,] N, T)
         """
-        presum_tau = torch.zeros(len(action), self.num_quantiles) + 1. / self.num_quantiles
-        tau = torch.cumsum(presum_tau, dim=1)  # (N, T), note that they are tau1...tauN in the paper
-        with torch.no_grad():
-            tau_hat = torch.zeros_like(tau)
-            tau_hat[:, 0:1] = tau[:, 0:1] / 2.
-            tau_hat[:, 1:] = (tau[:, 1:] + tau[:, :-1]) / 2.
-            tau_hat = tau_hat.to(state.device)
-
-        h = torch.cat([state, action], dim=1)
-        h = self.base_fc(h)  # (N, C)
-
-        x = torch.cos(tau_hat.unsqueeze(-1) * self.const_vec * np.pi)  # (N, T, E)
-        x = self.tau_fc(x)  # (N, T, C)
-
-        h = torch.mul(x, h.unsqueeze(-2))  # (N, T, C)
-        h = self.merge_fc(h)  # (N, T, C)
-        return h
+        return self.merge(self.trunk(state, action), self.tau_embedding(tau))
+
+
+class FixedQuantileMlpEnsemble(QuantileMlpEnsemble):
+    """
+    QR-DQN-style variant of QuantileMlpEnsemble for tau_type='fix'.
+
+    The quantile fractions are always the midpoints of num_quantiles equal
+    bins, so instead of embedding tau the output layer has one head per
+    quantile and a forward costs one MLP pass rather than T. tau_embedding
+    maps every fraction to the index of its head, (1, [S,] N, T, 1), and
+    merge gathers those heads, so callers use the same API, and the same
+    slicing, as the tau-conditioned ensemble.
+    """
+    def __init__(
+            self,
+            ensemble_size,
+            hidden_sizes,
+            output_size,
+            input_size,
+            num_quantiles=32,
+            layer_norm=True,
+            num_seeds=None,
+            **kwargs,
+    ):
+        nn.Module.__init__(self)
+        self.ensemble_size = ensemble_size
+        self.layer_norm = layer_norm
+        self.num_quantiles = num_quantiles
+
+        last_size = self._init_base(input_size, hidden_sizes[:-1], num_seeds)
+        self.merge_w, self.merge_b = ensemble_linear_params(self.shape, last_size, hidden_sizes[-1])
+        self.merge_ln_w, self.merge_ln_b = self._layer_norm_params(hidden_sizes[-1])
+        self.last_w, self.last_b = ensemble_linear_params(self.shape, hidden_sizes[-1], num_quantiles)
+
+    def tau_embedding(self, tau):
+        """tau: quantile fractions ([S,] N, T) -> head indices (1, [S,] N, T, 1)"""
+        index = (tau * self.num_quantiles).long().clamp(0, self.num_quantiles - 1)
+        return index.view(1, *index.shape, 1)
+
+    def merge(self, h, index):
+        """Trunk features (E, [S,] N, [R,] C) and head indices (1, [S,] N, T, 1) -> quantile values (E, [S,] N, [R,] T)"""
+        index = index.squeeze(-1)
+        T = index.shape[-1]
+        shape = h.shape[:-1]
+        output = self._head(h).view(*shape, self.num_quantiles)
+        index = index.view(*index.shape[:-1], *([1] * (len(shape) - index.dim() + 1)), T).expand(*shape, T)
+        return torch.gather(output, -1, index)
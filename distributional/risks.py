@@ -38,7 +38,7 @@ def distortion_de(tau, mode="neutral", param=0., eps=1e-8):
     tau = tau.clamp(0., 1.)
     if param >= 0:
         if mode == "neutral":
-            tau_ = ptu.ones_like(tau)
+            tau_ = torch.ones_like(tau)
         elif mode == "wang":
             tau_ = normal_pdf(normal_icdf(tau) + param) / (normal_pdf(normal_icdf(tau)) + eps)
         elif mode == "cvar":
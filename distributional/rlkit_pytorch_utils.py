@@ -2,6 +2,8 @@ import torch
 import numpy as np
 from torch import nn
 
+from sac.utils import soft_update
+
 
 def identity(x):
     return x
@@ -23,10 +25,7 @@ def activation_from_string(string):
 
 
 def soft_update_from_to(source, target, tau):
-    for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(
-            target_param.data * (1.0 - tau) + param.data * tau
-        )
+    soft_update(target, source, tau)
 
 
 def copy_model_params_from_to(source, target):
@@ -222,8 +221,8 @@ def compute_deconv_layer_sizes(h_in, w_in, kernel_sizes, strides,
 GPU wrappers
 """
 
-_use_gpu = False
-device = 'cuda'
+_use_gpu = torch.cuda.is_available()
+device = torch.device('cuda' if _use_gpu else 'cpu')
 
 
 def set_gpu_mode(mode, gpu_id=0):
@@ -0,0 +1,84 @@
+import numpy as np
+import torch
+from torch.quasirandom import SobolEngine
+
+import distributional.rlkit_pytorch_utils as ptu
+
+
+def _rows(n):
+    # samplers draw (n, T) fractions, or (*n, T) for a tuple of leading dims
+    return tuple(int(d) for d in np.atleast_1d(n))
+
+
+def stratified_taus(n, num_quantiles, device):
+    """One uniform fraction in each of the num_quantiles equal bins of [0, 1]."""
+    offsets = torch.arange(num_quantiles, device=device, dtype=torch.float32)
+    return (offsets + torch.rand(*_rows(n), num_quantiles, device=device)) / num_quantiles
+
+
+# one scrambled sequence per (num_quantiles, torch seed), continued across calls
+_sobol_engines = {}
+
+
+def sobol_taus(n, num_quantiles, device):
+    """
+    Consecutive blocks of a scrambled 1-D Sobol sequence. For a power-of-two
+    num_quantiles every row is stratified, and the rows are also spread evenly
+    against each other and against the rows of earlier calls, since every
+    call continues the sequence of its (num_quantiles, torch.initial_seed()).
+    A sequence that runs out of points is replaced by one with a new
+    scrambling seed from the torch RNG.
+    """
+    rows = _rows(n)
+    count = int(np.prod(rows)) * num_quantiles
+    key = (num_quantiles, torch.initial_seed())
+    engine = _sobol_engines.get(key)
+    if engine is None or engine.num_generated + count > 2 ** SobolEngine.MAXBIT:
+        seed = torch.initial_seed() % (2 ** 31 - 1) if engine is None else int(torch.randint(2 ** 31 - 1, (1,)).item())
+        engine = _sobol_engines[key] = SobolEngine(1, scramble=True, seed=seed)
+    taus = engine.draw(count).view(*rows, num_quantiles)
+    return taus.to(device).sort(dim=-1)[0]
+
+
+def sobol_state():
+    """Scrambling seed and position of every Sobol sequence, for checkpoints."""
+    return [(key, engine.seed, engine.num_generated) for key, engine in _sobol_engines.items()]
+
+
+def load_sobol_state(state):
+    """Recreate the sequences of a sobol_state() and fast-forward them to where they were."""
+    _sobol_engines.clear()
+    for key, seed, num_generated in state:
+        engine = _sobol_engines[tuple(key)] = SobolEngine(1, scramble=True, seed=seed)
+        engine.fast_forward(num_generated)
+
+
+def antithetic_taus(n, num_quantiles, device):
+    """Stratified fractions in the lower half of the bins, mirrored as 1 - u into the upper half."""
+    half = num_quantiles // 2
+    lower = stratified_taus(n, num_quantiles, device)[..., :half]
+    middle = stratified_taus(n, num_quantiles, device)[..., half:num_quantiles - half]
+    return torch.cat([lower, middle, 1. - lower.flip(-1)], dim=-1)
+
+
+TAU_SAMPLERS = {
+    'stratified': stratified_taus,
+    'sobol': sobol_taus,
+    'antithetic': antithetic_taus,
+}
+
+
+def sample_taus(sampler, n, num_quantiles, device=None):
+    """
+    Equally weighted quantile fractions in the (tau, tau_hat, presum_tau)
+    layout of get_tau. tau_hat holds the sampled fractions, each with weight
+    presum_tau = 1 / num_quantiles, so sum(distortion_de(tau_hat) * presum_tau * z)
+    is a Monte Carlo estimate of the distorted expectation. tau holds the
+    cumulative weights.
+    """
+    if device is None:
+        device = ptu.device
+    tau_hat = TAU_SAMPLERS[sampler](n, num_quantiles, device)
+    presum_tau = torch.full_like(tau_hat, 1. / num_quantiles)
+    tau = torch.cumsum(presum_tau, dim=-1)
+    return tau, tau_hat, presum_tau
@@ -0,0 +1,133 @@
+import copy
+import queue
+import torch
+import torch.multiprocessing as mp
+
+from batch_utils import make_eval_envs, evaluate_policy_episodes
+
+
+class PolicyActor(object):
+    """Minimal agent interface around a policy network, as used by evaluate_policy_batch."""
+    def __init__(self, policy):
+        self.policy = policy
+
+    def select_action(self, state, eval=False):
+        with torch.no_grad():
+            state = torch.FloatTensor(state).unsqueeze(0)
+            if eval == False:
+                action, _, _ = self.policy.sample(state)
+            else:
+                _, _, action = self.policy.sample(state)
+        return action.numpy()[0]
+
+
+def _eval_worker(args, worker_id, n_envs, policies, tasks, results):
+    torch.set_num_threads(1)
+    args.seed = args.seed + 1000 * worker_id
+    envs = make_eval_envs(args, n_envs)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        tag, slot, n_episodes = task
+        try:
+            rewards = evaluate_policy_episodes(args, envs, PolicyActor(policies[slot]), n_episodes, args.epoch_length)
+        except BaseException as e:
+            results.put((tag, slot, e))
+            return
+        results.put((tag, slot, rewards))
+
+
+class EvalPool(object):
+    """
+    Evaluates policy snapshots in worker processes while training continues.
+
+    submit(tag, agent) copies agent.policy into a free snapshot slot whose
+    tensors live in shared memory and splits n_episodes across the workers.
+    poll() returns the (tag, returns) of every finished evaluation without
+    blocking, drain() waits for all of them. The number of in-flight
+    evaluations is bounded by the number of slots; submit() blocks on the
+    oldest one when all slots are taken. With num_workers=0 evaluation runs
+    inline in submit() with the batched evaluator.
+    """
+    def __init__(self, args, agent, n_episodes, num_workers=0, num_slots=2):
+        self.args = args
+        self.n_episodes = n_episodes
+        self.num_workers = num_workers
+        self.finished = []
+        if num_workers == 0:
+            self.envs = make_eval_envs(args, n_episodes)
+            return
+
+        ctx = mp.get_context('spawn')
+        policies = []
+        for _ in range(num_slots):
+            policy = copy.deepcopy(agent.policy).to('cpu')
+            policy.share_memory()
+            policies.append(policy)
+        self.policies = policies
+        self.free_slots = list(range(num_slots))
+        self.pending = {}
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        chunk = -(-n_episodes // num_workers)
+        self.chunks = [min(chunk, n_episodes - start) for start in range(0, n_episodes, chunk)]
+        worker_args = copy.copy(args)
+        self.workers = [ctx.Process(target=_eval_worker,
+                                    args=(worker_args, i, chunk, policies, self.tasks, self.results),
+                                    daemon=True)
+                        for i in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, tag, agent):
+        if self.num_workers == 0:
+            rewards = evaluate_policy_episodes(self.args, self.envs, agent, self.n_episodes, self.args.epoch_length)
+            self.finished.append((tag, rewards))
+            return
+        while not self.free_slots:
+            self._collect(block=True)
+        slot = self.free_slots.pop(0)
+        with torch.no_grad():
+            for target, param in zip(self.policies[slot].parameters(), agent.policy.parameters()):
+                target.copy_(param)
+        self.pending[tag] = [slot, len(self.chunks), []]
+        for n in self.chunks:
+            self.tasks.put((tag, slot, n))
+
+    def _collect(self, block):
+        try:
+            tag, slot, rewards = self.results.get(block=block)
+        except queue.Empty:
+            return False
+        if isinstance(rewards, BaseException):
+            raise rewards
+        entry = self.pending[tag]
+        entry[1] -= 1
+        entry[2].extend(rewards)
+        if entry[1] == 0:
+            del self.pending[tag]
+            self.free_slots.append(slot)
+            self.finished.append((tag, entry[2]))
+        return True
+
+    def poll(self):
+        if self.num_workers > 0:
+            while self._collect(block=False):
+                pass
+        finished, self.finished = self.finished, []
+        return finished
+
+    def drain(self):
+        if self.num_workers > 0:
+            while self.pending:
+                self._collect(block=True)
+        return self.poll()
+
+    def close(self):
+        if self.num_workers == 0:
+            return
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
@@ -25,7 +25,7 @@ def rollout_model(args, predict_env, agent, model_pool, env_pool, rollout_length
         action = agent.select_action(state)
         next_states, rewards, terminals, info = predict_env.step(state, action, reward_penalty=args.penalty,
                                                                 algo=args.algo)
-        model_pool.push_batch([(state[j], action[j], rewards[j], next_states[j], terminals[j]) for j in range(state.shape[0])])
+        model_pool.push_batch((state, action, rewards, next_states, terminals))
         nonterm_mask = ~terminals.squeeze(-1)
         if nonterm_mask.sum() == 0:
             break
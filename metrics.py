@@ -0,0 +1,173 @@
+import csv
+import json
+import os
+import queue
+import sys
+import threading
+import traceback
+
+_wandb_lock = threading.Lock()
+
+
+class JsonlSink(object):
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, 'a')
+
+    def write(self, step, values):
+        self.file.write(json.dumps(dict(step=step, **values)) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CsvSink(object):
+    """Long-format CSV (step, key, value), so new keys never change the header."""
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        new_file = not os.path.exists(path)
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if new_file:
+            self.writer.writerow(['step', 'key', 'value'])
+
+    def write(self, step, values):
+        self.writer.writerows([step, key, value] for key, value in values.items())
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class WandbSink(object):
+    """
+    Logs at the record's step. wandb drops records behind the run's current
+    step, such as evaluations that finish after later training steps were
+    logged, so those are logged at the current step with their step as a value.
+    All sinks log to the one global wandb run, so the per-seed sinks of a
+    stacked run take _wandb_lock around the step check and the log call.
+    """
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+
+    def write(self, step, values):
+        import wandb
+        values = {self.prefix + key: value for key, value in values.items()}
+        with _wandb_lock:
+            if step is not None and wandb.run is not None and step < wandb.run.step:
+                values['step'] = step
+                step = None
+            wandb.log(values, step=step)
+
+    def close(self):
+        pass
+
+
+class MetricsLogger(object):
+    """
+    Aggregates scalars in memory and writes them out on a background thread.
+
+    Aggregated values are summarised over windows of `window` log() calls as
+    `key` (mean), `key/min` and `key/max`. log(..., aggregate=False) bypasses
+    the window for values that are already summaries, e.g. evaluation returns.
+    A sink that raises is reported on stderr, with a traceback the first time,
+    and the worker keeps writing to the other sinks.
+    """
+    def __init__(self, sinks, window=100):
+        self.sinks = sinks
+        self.window = window
+        self.stats = {}
+        self.calls = 0
+        self.step = None
+        self.errors = {}
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            step, values = record
+            for sink in self.sinks:
+                try:
+                    sink.write(step, values)
+                except Exception:
+                    self._report(sink, f'write at step {step}')
+
+    def _report(self, sink, action):
+        name = type(sink).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+        print(f'metrics: {name} failed to {action} ({self.errors[name]} errors)', file=sys.stderr)
+        if self.errors[name] == 1:
+            traceback.print_exc()
+
+    def log(self, values, step=None, aggregate=True):
+        if not aggregate:
+            self.queue.put((step, {key: float(value) for key, value in values.items()}))
+            return
+        for key, value in values.items():
+            value = float(value)
+            if key in self.stats:
+                total, count, low, high = self.stats[key]
+                self.stats[key] = (total + value, count + 1, min(low, value), max(high, value))
+            else:
+                self.stats[key] = (value, 1, value, value)
+        self.step = step
+        self.calls += 1
+        if self.calls >= self.window:
+            self.flush()
+
+    def flush(self):
+        if self.stats:
+            values = {}
+            for key, (total, count, low, high) in self.stats.items():
+                values[key] = total / count
+                values[f'{key}/min'] = low
+                values[f'{key}/max'] = high
+            self.queue.put((self.step, values))
+        self.stats = {}
+        self.calls = 0
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception:
+                self._report(sink, 'close')
+
+
+class SeedMetricsLogger(object):
+    """
+    One MetricsLogger per seed of a stacked multi-seed agent. log() sends
+    element s of every list value, such as the per-seed losses returned by
+    read_losses(), to loggers[s] and scalar values to all of them.
+    """
+    def __init__(self, loggers):
+        self.loggers = loggers
+
+    def log(self, values, step=None, aggregate=True):
+        for seed, logger in enumerate(self.loggers):
+            logger.log({key: value[seed] if isinstance(value, (list, tuple)) else value
+                        for key, value in values.items()}, step=step, aggregate=aggregate)
+
+    def close(self):
+        for logger in self.loggers:
+            logger.close()
+
+
+def make_metrics_logger(args, run_name, wandb_prefix=''):
+    sinks = []
+    for name in args.metrics_sinks.split(','):
+        if name == 'jsonl':
+            sinks.append(JsonlSink(os.path.join(args.metrics_dir, args.env, f'{run_name}.jsonl')))
+        elif name == 'csv':
+            sinks.append(CsvSink(os.path.join(args.metrics_dir, args.env, f'{run_name}.csv')))
+    if args.wandb:
+        sinks.append(WandbSink(wandb_prefix))
+    return MetricsLogger(sinks, window=args.metrics_window)
@@ -9,8 +9,6 @@ from torch.utils.data import TensorDataset, DataLoader
 
 import wandb
 
-device = torch.device('cuda')
-
 def swish(x):
     return x * torch.sigmoid(x)
 
@@ -77,7 +75,13 @@ class ProbEnsemble(nn.Module):
 
         return lin0_decays + lin1_decays + lin2_decays + lin3_decays + lin4_decays
 
-    def fit_input_stats(self, data, device='cuda'):
+    @property
+    def device(self):
+        return self.lin0_w.device
+
+    def fit_input_stats(self, data, device=None):
+        if device is None:
+            device = self.device
         self.fit_input = True
         mu = np.mean(data, axis=0, keepdims=True)
         sigma = np.std(data, axis=0, keepdims=True)
@@ -172,8 +176,8 @@ class ProbEnsemble(nn.Module):
         holdout_inputs = np.tile(holdout_inputs[None], [self.num_nets, 1, 1])
         holdout_targets = np.tile(holdout_targets[None], [self.num_nets, 1, 1])
 
-        input_val = torch.from_numpy(holdout_inputs).float().to(device)
-        target_val = torch.from_numpy(holdout_targets).float().to(device)
+        input_val = torch.from_numpy(holdout_inputs).float().to(self.device)
+        target_val = torch.from_numpy(holdout_targets).float().to(self.device)
 
         idxs = np.random.randint(inputs.shape[0], size=[self.num_nets, inputs.shape[0]])
 
@@ -187,8 +191,8 @@ class ProbEnsemble(nn.Module):
             for batch_num in range(int(np.ceil(idxs.shape[-1] / batch_size))):
                 batch_idxs = idxs[:, batch_num * batch_size:(batch_num + 1) * batch_size]
 
-                input = torch.from_numpy(inputs[batch_idxs]).float().to(device)
-                target = torch.from_numpy(targets[batch_idxs]).float().to(device)
+                input = torch.from_numpy(inputs[batch_idxs]).float().to(self.device)
+                target = torch.from_numpy(targets[batch_idxs]).float().to(self.device)
                 train_loss = 0.01 * (self.max_logvar.sum() - self.min_logvar.sum())
                 train_loss += self.compute_decays()
                 mean, logvar = self(input, ret_logvar=True)
@@ -239,7 +243,7 @@ class ProbEnsemble(nn.Module):
         ensemble_var = np.zeros((self.network_size, inputs.shape[0], self.state_size + self.reward_size))
         with torch.no_grad():
             for i in range(0, inputs.shape[0], batch_size):
-                input = torch.from_numpy(inputs[i:min(i + batch_size, inputs.shape[0])]).float().to(device)
+                input = torch.from_numpy(inputs[i:min(i + batch_size, inputs.shape[0])]).float().to(self.device)
 
                 pred_2d_mean, pred_2d_var = self(input, ret_logvar=False)
                 ensemble_mean[:, i:min(i + batch_size, inputs.shape[0]), :] = pred_2d_mean.detach().cpu().numpy()
@@ -248,10 +252,10 @@ class ProbEnsemble(nn.Module):
         return ensemble_mean, ensemble_var
 
     def compute_log_prob(self, input, target):
-        ensemble_mu, ensemble_var = self(input.to(device))
+        ensemble_mu, ensemble_var = self(input.to(self.device))
 
         dist = torch.distributions.Normal(loc=ensemble_mu, scale=ensemble_var.sqrt())
-        log_prob = dist.log_prob(target.to(device))
+        log_prob = dist.log_prob(target.to(self.device))
         log_prob = log_prob.mean(dim=-1, keepdim=True).mean(dim=0)
 
         return log_prob
@@ -0,0 +1,72 @@
+import torch
+
+
+class Batch(object):
+    """
+    Preallocated training batch of float32 tensors on one device.
+    reward and mask are stored as (B, 1) columns; mask is 1 - done.
+    Batches for prioritized replay also carry importance `weights` (B, 1)
+    and the sampled row `indices` (B,), otherwise both are None.
+    """
+    def __init__(self, batch_size, state_dim, action_dim, device='cpu', pin_memory=False, prioritized=False):
+        shapes = [(batch_size, state_dim), (batch_size, action_dim), (batch_size, 1),
+                  (batch_size, state_dim), (batch_size, 1)]
+        self.state, self.action, self.reward, self.next_state, self.mask = [
+            torch.empty(shape, dtype=torch.float32, device=device, pin_memory=pin_memory) for shape in shapes]
+        self.weights = self.indices = None
+        if prioritized:
+            self.weights = torch.empty((batch_size, 1), dtype=torch.float32, device=device, pin_memory=pin_memory)
+            self.indices = torch.empty((batch_size,), dtype=torch.int64, device=device, pin_memory=pin_memory)
+
+    @classmethod
+    def from_tensors(cls, state, action, reward, next_state, mask, weights=None, indices=None):
+        batch = cls.__new__(cls)
+        batch.state, batch.action, batch.reward, batch.next_state, batch.mask = state, action, reward, next_state, mask
+        batch.weights, batch.indices = weights, indices
+        return batch
+
+    @classmethod
+    def from_numpy(cls, memory, device='cpu'):
+        """Adapter for the (state, action, reward, next_state, mask) tuple of arrays used by sample_batch."""
+        state, action, reward, next_state, mask = [torch.as_tensor(x, dtype=torch.float32, device=device) for x in memory]
+        return cls.from_tensors(state, action, reward.view(-1, 1), next_state, mask.view(-1, 1))
+
+    def __iter__(self):
+        return iter((self.state, self.action, self.reward, self.next_state, self.mask))
+
+    def __len__(self):
+        return self.state.shape[0]
+
+    def _map(self, fn):
+        extra = [None if t is None else fn(t) for t in (self.weights, self.indices)]
+        return Batch.from_tensors(*[fn(t) for t in self], *extra)
+
+    def narrow(self, n):
+        if n == len(self):
+            return self
+        return self._map(lambda t: t[:n])
+
+    def split_seeds(self, num_seeds):
+        """View the rows as (num_seeds, B / num_seeds, ...), one block of independently sampled rows per seed."""
+        return self._map(lambda t: t.view(num_seeds, -1, *t.shape[1:]))
+
+    def numpy(self):
+        """NumPy views of a host batch, for writing samples in place."""
+        return tuple(t.numpy() for t in self)
+
+    def empty_like(self, device):
+        return self._map(lambda t: torch.empty_like(t, device=device))
+
+    def copy_(self, other, non_blocking=False):
+        for t, o in zip((*self, self.weights, self.indices), (*other, other.weights, other.indices)):
+            if t is not None:
+                t.copy_(o, non_blocking=non_blocking)
+        return self
+
+
+def as_batch(memory, device='cpu', num_seeds=None):
+    if not isinstance(memory, Batch):
+        memory = Batch.from_numpy(memory, device)
+    if num_seeds is not None:
+        memory = memory.split_seeds(num_seeds)
+    return memory
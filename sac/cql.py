@@ -3,11 +3,12 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from torch.optim import Adam
-from sac.utils import soft_update, hard_update
+from sac.utils import soft_update, hard_update, MultiStepUpdater, stack_losses, seed_mean, resolve_device
 from sac.model import GaussianPolicy, QNetwork, DeterministicPolicy
+from sac.batch import as_batch
 
 
-class CQL(object):
+class CQL(MultiStepUpdater):
     def __init__(self, num_inputs, action_space,
                  ## SAC
                  gamma=0.99, tau=0.005, alpha=0.2,
@@ -29,7 +30,8 @@ class CQL(object):
                  lagrange_thresh=10.0,
                  policy_lr=3e-5,
                  policy_eval_start=0,
-                 device='cuda'):
+                 device='auto',
+                 num_seeds=None):
 
         ## SAC
         self.gamma = gamma
@@ -50,11 +52,14 @@ class CQL(object):
         self.deterministic_backup = deterministic_backup
         self.num_random = num_random
 
-        self.device = device
+        self.device = resolve_device(device)
+        self.num_seeds = num_seeds
+        if num_seeds is not None and self.policy_type != "Gaussian":
+            raise ValueError('num_seeds requires the Gaussian policy')
 
-        self.critic = QNetwork(num_inputs, action_space.shape[0], hidden_size).to(self.device)
+        self.critic = QNetwork(num_inputs, action_space.shape[0], hidden_size, num_seeds).to(self.device)
         self.critic_optim = Adam(self.critic.parameters(), lr=lr)
-        self.critic_target = QNetwork(num_inputs, action_space.shape[0], hidden_size).to(self.device)
+        self.critic_target = QNetwork(num_inputs, action_space.shape[0], hidden_size, num_seeds).to(self.device)
         hard_update(self.critic_target, self.critic)
 
         if self.policy_type == "Gaussian":
@@ -63,10 +68,12 @@ class CQL(object):
                 self.target_entropy = -torch.prod(torch.Tensor(action_space.shape).to(self.device)).item()
                 if self.target_entropy != 'auto':
                     self.target_entropy = target_entropy
-                self.log_alpha = torch.zeros(1, requires_grad=True, device=self.device)
+                alpha_shape = (1,) if num_seeds is None else (num_seeds, 1, 1)
+                self.log_alpha = torch.zeros(alpha_shape, requires_grad=True, device=self.device)
                 self.alpha_optim = Adam([self.log_alpha], lr=policy_lr)
 
-            self.policy = GaussianPolicy(num_inputs, action_space.shape[0], hidden_size, action_space).to(self.device)
+            self.policy = GaussianPolicy(num_inputs, action_space.shape[0], hidden_size, action_space,
+                                         num_seeds).to(self.device)
             self.policy_optim = Adam(self.policy.parameters(), lr=policy_lr)
 
         else:
@@ -79,24 +86,28 @@ class CQL(object):
         self.with_lagrange = with_lagrange
         if self.with_lagrange:
             self.target_action_gap = lagrange_thresh
-            self.log_alpha_prime = torch.zeros(1, device=self.device, requires_grad=True)
+            self.log_alpha_prime = torch.zeros(num_seeds or 1, device=self.device, requires_grad=True)
             self.alpha_prime_optimizer = Adam([self.log_alpha_prime], lr=lr)
 
+    @staticmethod
+    def _repeat_rows(obs, num_repeat):
+        # (..., N, D) -> (..., N * num_repeat, D), each row repeated num_repeat times
+        return obs.unsqueeze(-2).expand(*obs.shape[:-1], num_repeat, obs.shape[-1]).reshape(
+            *obs.shape[:-2], obs.shape[-2] * num_repeat, obs.shape[-1])
+
     def _get_tensor_values(self, obs, actions, network=None):
-        action_shape = actions.shape[0]
-        obs_shape = obs.shape[0]
-        num_repeat = int(action_shape / obs_shape)
-        obs_temp = obs.unsqueeze(1).repeat(1, num_repeat, 1).view(obs.shape[0] * num_repeat, obs.shape[1])
+        num_repeat = actions.shape[-2] // obs.shape[-2]
+        obs_temp = self._repeat_rows(obs, num_repeat)
         pred1, pred2 = network(obs_temp, actions)
-        pred1 = pred1.view(obs.shape[0], num_repeat, 1)
-        pred2 = pred2.view(obs.shape[0], num_repeat, 1)
+        pred1 = pred1.view(*obs.shape[:-1], num_repeat, 1)
+        pred2 = pred2.view(*obs.shape[:-1], num_repeat, 1)
 
         return pred1, pred2
 
     def _get_policy_actions(self, obs, num_actions, network=None):
-        obs_temp = obs.unsqueeze(1).repeat(1, num_actions, 1).view(obs.shape[0] * num_actions, obs.shape[1])
+        obs_temp = self._repeat_rows(obs, num_actions)
         new_obs_actions, new_obs_log_pi, _ = network.sample(obs_temp)
-        return new_obs_actions.detach(), new_obs_log_pi.view(obs.shape[0], num_actions, 1).detach()
+        return new_obs_actions.detach(), new_obs_log_pi.view(*obs.shape[:-1], num_actions, 1).detach()
 
     def select_action(self, state, eval=False):
         state = torch.FloatTensor(state).to(self.device).unsqueeze(0)
@@ -107,33 +118,30 @@ class CQL(object):
         return action.detach().cpu().numpy()[0]
 
     def update_parameters(self, memory, batch_size, updates):
+        return tuple(stack_losses(self._update(memory, updates), self.num_seeds).tolist())
+
+    def _update(self, memory, updates):
         # Sample a batch from memory
         # state_batch, action_batch, reward_batch, next_state_batch, mask_batch = memory.sample(batch_size=batch_size)
-        state_batch, action_batch, reward_batch, next_state_batch, mask_batch = memory
-
-        obs = torch.FloatTensor(state_batch).to(self.device)
-        next_obs = torch.FloatTensor(next_state_batch).to(self.device)
-        actions= torch.FloatTensor(action_batch).to(self.device)
-        rewards = torch.FloatTensor(reward_batch).to(self.device).unsqueeze(1)
-        masks = torch.FloatTensor(mask_batch).to(self.device).unsqueeze(1)
+        obs, actions, rewards, next_obs, masks = as_batch(memory, self.device, self.num_seeds)
 
         """
         Policy and Alpha Loss
         """
         new_obs_actions, log_pi, _ = self.policy.sample(obs)
         if self.automatic_entropy_tuning:
-            alpha_loss = -(self.log_alpha * (log_pi + self.target_entropy).detach()).mean()
+            alpha_loss = -seed_mean(self.log_alpha * (log_pi + self.target_entropy).detach(), self.num_seeds)
             self.alpha_optim.zero_grad()
-            alpha_loss.backward()
+            alpha_loss.sum().backward()
             self.alpha_optim.step()
             self.alpha = self.log_alpha.exp()
             alpha_tlogs = self.alpha.clone()
         else:
-            alpha_loss = torch.tensor(0.).to(self.device)
-            alpha_tlogs = torch.tensor(self.alpha)
+            alpha_loss = torch.tensor(0., device=self.device)
+            alpha_tlogs = torch.tensor(self.alpha, device=self.device)
 
         q_new_actions = torch.min(*self.critic(obs, new_obs_actions))
-        policy_loss = (self.alpha * log_pi - q_new_actions).mean()
+        policy_loss = seed_mean(self.alpha * log_pi - q_new_actions, self.num_seeds)
 
         if self.updates < self.policy_eval_start:
             """
@@ -143,7 +151,7 @@ class CQL(object):
             """
             self.updates += 1
             policy_log_prob = self.policy.log_prob(obs, actions)
-            policy_loss = (self.alpha * log_pi - policy_log_prob).mean()
+            policy_loss = seed_mean(self.alpha * log_pi - policy_log_prob, self.num_seeds)
 
         """
         QF Loss
@@ -167,11 +175,11 @@ class CQL(object):
         q_target = rewards + masks * self.gamma * target_q_values
         q_target = q_target.detach()
 
-        qf1_loss = F.mse_loss(q1_pred, q_target)
-        qf2_loss = F.mse_loss(q2_pred, q_target)
+        qf1_loss = seed_mean(F.mse_loss(q1_pred, q_target, reduction='none'), self.num_seeds)
+        qf2_loss = seed_mean(F.mse_loss(q2_pred, q_target, reduction='none'), self.num_seeds)
 
         ## CQL
-        random_actions_tensor = torch.FloatTensor(q2_pred.shape[0] * self.num_random, actions.shape[-1]).uniform_(-1,1).to(self.device)
+        random_actions_tensor = torch.FloatTensor(*q2_pred.shape[:-2], q2_pred.shape[-2] * self.num_random, actions.shape[-1]).uniform_(-1,1).to(self.device)
 
         curr_actions_tensor, curr_log_pis = self._get_policy_actions(obs, num_actions=self.num_random,
                                                                      network=self.policy)
@@ -183,10 +191,10 @@ class CQL(object):
 
         # when is this ever used?
         cat_q1 = torch.cat(
-            [q1_rand, q1_pred.unsqueeze(1), q1_next_actions, q1_curr_actions], 1
+            [q1_rand, q1_pred.unsqueeze(-2), q1_next_actions, q1_curr_actions], -2
         )
         cat_q2 = torch.cat(
-            [q2_rand, q2_pred.unsqueeze(1), q2_next_actions, q2_curr_actions], 1
+            [q2_rand, q2_pred.unsqueeze(-2), q2_next_actions, q2_curr_actions], -2
         )
         # std_q1 = torch.std(cat_q1, dim=1)
         # std_q2 = torch.std(cat_q2, dim=1)
@@ -196,19 +204,19 @@ class CQL(object):
             random_density = np.log(0.5 ** curr_actions_tensor.shape[-1])
             cat_q1 = torch.cat(
                 [q1_rand - random_density, q1_next_actions - new_log_pis.detach(),
-                 q1_curr_actions - curr_log_pis.detach()], 1
+                 q1_curr_actions - curr_log_pis.detach()], -2
             )
             cat_q2 = torch.cat(
                 [q2_rand - random_density, q2_next_actions - new_log_pis.detach(),
-                 q2_curr_actions - curr_log_pis.detach()], 1
+                 q2_curr_actions - curr_log_pis.detach()], -2
             )
 
-        min_qf1_loss = torch.logsumexp(cat_q1 / self.temp, dim=1, ).mean() * self.min_q_weight * self.temp
-        min_qf2_loss = torch.logsumexp(cat_q2 / self.temp, dim=1, ).mean() * self.min_q_weight * self.temp
+        min_qf1_loss = seed_mean(torch.logsumexp(cat_q1 / self.temp, dim=-2, ), self.num_seeds) * self.min_q_weight * self.temp
+        min_qf2_loss = seed_mean(torch.logsumexp(cat_q2 / self.temp, dim=-2, ), self.num_seeds) * self.min_q_weight * self.temp
 
         """Subtract the log likelihood of data"""
-        min_qf1_loss = min_qf1_loss - q1_pred.mean() * self.min_q_weight
-        min_qf2_loss = min_qf2_loss - q2_pred.mean() * self.min_q_weight
+        min_qf1_loss = min_qf1_loss - seed_mean(q1_pred, self.num_seeds) * self.min_q_weight
+        min_qf2_loss = min_qf2_loss - seed_mean(q2_pred, self.num_seeds) * self.min_q_weight
 
         if self.with_lagrange:
             alpha_prime = torch.clamp(self.log_alpha_prime.exp(), min=0.0, max=1000000.0)
@@ -217,7 +225,7 @@ class CQL(object):
 
             self.alpha_prime_optimizer.zero_grad()
             alpha_prime_loss = (-min_qf1_loss - min_qf2_loss) * 0.5
-            alpha_prime_loss.backward(retain_graph=True)
+            alpha_prime_loss.sum().backward(retain_graph=True)
             self.alpha_prime_optimizer.step()
 
         qf1_loss = qf1_loss + min_qf1_loss
@@ -226,28 +234,30 @@ class CQL(object):
 
 
         self.policy_optim.zero_grad()
-        policy_loss.backward(retain_graph=False)
+        policy_loss.sum().backward(retain_graph=False)
         self.policy_optim.step()
 
         self.critic_optim.zero_grad()
-        qf_loss.backward(retain_graph=True)
+        qf_loss.sum().backward(retain_graph=True)
         self.critic_optim.step()
 
 
         if updates % self.target_update_interval == 0:
             soft_update(self.critic_target, self.critic, self.tau)
 
-        return qf1_loss.item(), qf2_loss.item(), policy_loss.item(), alpha_loss.item(), alpha_tlogs.item()
+        return qf1_loss, qf2_loss, policy_loss, alpha_loss, alpha_tlogs
 
     # Save model parameters
+    def model_state_dicts(self, path):
+        return {path + '-actor.pt': self.policy.state_dict(),
+                path + '-critic.pt': self.critic.state_dict()}
+
     def save_model(self, path):
         if not os.path.exists('saved_policies/'):
             os.makedirs('saved_policies/')
 
-        actor_path = path+'-actor.pt'
-        critic_path = path + '-critic.pt'
-        torch.save(self.policy.state_dict(), actor_path)
-        torch.save(self.critic.state_dict(), critic_path)
+        for model_path, state_dict in self.model_state_dicts(path).items():
+            torch.save(state_dict, model_path)
 
     # Load model parameters
     def load_model(self, path):
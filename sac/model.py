@@ -14,6 +14,31 @@ def weights_init_(m):
         torch.nn.init.constant_(m.bias, 0)
 
 
+class StackedLinear(nn.Module):
+    """
+    num_seeds independent linear layers with weights stacked as (S, in, out),
+    as in models/ensemble.py::ProbEnsemble. Inputs are (S, ..., in) and every
+    seed's rows go through its own layer in one batched matmul. Each layer is
+    initialized like weights_init_.
+    """
+    def __init__(self, in_features, out_features, num_seeds):
+        super().__init__()
+        self.weight = nn.Parameter(torch.empty(num_seeds, in_features, out_features))
+        self.bias = nn.Parameter(torch.zeros(num_seeds, 1, out_features))
+        for weight in self.weight.data:
+            torch.nn.init.xavier_uniform_(weight, gain=1)
+
+    def forward(self, x):
+        out = torch.baddbmm(self.bias, x.reshape(x.shape[0], -1, x.shape[-1]), self.weight)
+        return out.view(*x.shape[:-1], -1)
+
+
+def linear(in_features, out_features, num_seeds=None):
+    if num_seeds is None:
+        return nn.Linear(in_features, out_features)
+    return StackedLinear(in_features, out_features, num_seeds)
+
+
 class ValueNetwork(nn.Module):
     def __init__(self, num_inputs, hidden_dim):
         super(ValueNetwork, self).__init__()
@@ -32,23 +57,23 @@ class ValueNetwork(nn.Module):
 
 
 class QNetwork(nn.Module):
-    def __init__(self, num_inputs, num_actions, hidden_dim):
+    def __init__(self, num_inputs, num_actions, hidden_dim, num_seeds=None):
         super(QNetwork, self).__init__()
 
         # Q1 architecture
-        self.linear1 = nn.Linear(num_inputs + num_actions, hidden_dim)
-        self.linear2 = nn.Linear(hidden_dim, hidden_dim)
-        self.linear3 = nn.Linear(hidden_dim, 1)
+        self.linear1 = linear(num_inputs + num_actions, hidden_dim, num_seeds)
+        self.linear2 = linear(hidden_dim, hidden_dim, num_seeds)
+        self.linear3 = linear(hidden_dim, 1, num_seeds)
 
         # Q2 architecture
-        self.linear4 = nn.Linear(num_inputs + num_actions, hidden_dim)
-        self.linear5 = nn.Linear(hidden_dim, hidden_dim)
-        self.linear6 = nn.Linear(hidden_dim, 1)
+        self.linear4 = linear(num_inputs + num_actions, hidden_dim, num_seeds)
+        self.linear5 = linear(hidden_dim, hidden_dim, num_seeds)
+        self.linear6 = linear(hidden_dim, 1, num_seeds)
 
         self.apply(weights_init_)
 
     def forward(self, state, action):
-        xu = torch.cat([state, action], 1)
+        xu = torch.cat([state, action], -1)
         
         x1 = F.relu(self.linear1(xu))
         x1 = F.relu(self.linear2(x1))
@@ -61,7 +86,7 @@ class QNetwork(nn.Module):
         return x1, x2
 
     def penultimate_layer(self, state, action):
-        xu = torch.cat([state, action], 1)
+        xu = torch.cat([state, action], -1)
 
         x1 = F.relu(self.linear1(xu))
         x1 = F.relu(self.linear2(x1))
@@ -72,14 +97,16 @@ class QNetwork(nn.Module):
 
 
 class GaussianPolicy(nn.Module):
-    def __init__(self, num_inputs, num_actions, hidden_dim, action_space=None):
+    def __init__(self, num_inputs, num_actions, hidden_dim, action_space=None, num_seeds=None):
         super(GaussianPolicy, self).__init__()
+        # enough to rebuild one seed in select_seed; the action space itself is not kept
+        self.init_args = (num_inputs, num_actions, hidden_dim)
         
-        self.linear1 = nn.Linear(num_inputs, hidden_dim)
-        self.linear2 = nn.Linear(hidden_dim, hidden_dim)
+        self.linear1 = linear(num_inputs, hidden_dim, num_seeds)
+        self.linear2 = linear(hidden_dim, hidden_dim, num_seeds)
 
-        self.mean_linear = nn.Linear(hidden_dim, num_actions)
-        self.log_std_linear = nn.Linear(hidden_dim, num_actions)
+        self.mean_linear = linear(hidden_dim, num_actions, num_seeds)
+        self.log_std_linear = linear(hidden_dim, num_actions, num_seeds)
 
         self.apply(weights_init_)
 
@@ -111,10 +138,24 @@ class GaussianPolicy(nn.Module):
         log_prob = normal.log_prob(x_t)
         # Enforcing Action Bound
         log_prob -= torch.log(self.action_scale * (1 - y_t.pow(2)) + epsilon)
-        log_prob = log_prob.sum(1, keepdim=True)
+        log_prob = log_prob.sum(-1, keepdim=True)
         mean = torch.tanh(mean) * self.action_scale + self.action_bias
         return action, log_prob, mean
 
+    def select_seed(self, seed):
+        """A plain GaussianPolicy with the weights of one seed of a stacked policy."""
+        policy = GaussianPolicy(*self.init_args)
+        policy.action_scale = self.action_scale.clone()
+        policy.action_bias = self.action_bias.clone()
+        policy.to(self.action_scale.device)
+        with torch.no_grad():
+            for name, module in self.named_modules():
+                if isinstance(module, StackedLinear):
+                    layer = policy.get_submodule(name)
+                    layer.weight.copy_(module.weight[seed].t())
+                    layer.bias.copy_(module.bias[seed, 0])
+        return policy
+
     def log_prob(self, state, action):
         mean, log_std = self.forward(state)
         std = log_std.exp()
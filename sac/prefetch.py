@@ -0,0 +1,118 @@
+import queue
+import threading
+import torch
+
+
+class BatchPrefetcher(object):
+    """
+    Prepares upcoming training batches on a worker thread.
+
+    make_batch(pin_memory=...) allocates a host sac.batch.Batch and
+    fill_fn(batch) samples into it in place, returning the filled batch (or a
+    narrowed view of it). Each of the num_batches + 1 reusable slots holds a
+    host batch (pinned when the device is CUDA) and its device copy, moved on
+    a side stream, so sampling and collation overlap with the update that
+    consumes the previous batch. A batch handed out by get() is only refilled
+    after the following get() call. With num_batches=0 batches are filled
+    inline into a single slot.
+
+    fill_fn should sample from generators of its own (see
+    ReplaySampler.set_rng), not the global RNGs the learner draws from, or
+    the interleaving of the two threads decides who gets which numbers. The
+    worker runs ahead of the learner, so reset() stops it and drops the
+    batches sampled ahead before the sampling state is recorded for a
+    checkpoint; a resumed run then samples the same batches. The same goes
+    for anything that writes to the sampled buffers.
+    """
+    def __init__(self, fill_fn, make_batch, device='cpu', num_batches=2):
+        self.fill_fn = fill_fn
+        self.make_batch = make_batch
+        self.device = torch.device(device)
+        self.pin_memory = self.device.type == 'cuda'
+        self.num_batches = num_batches
+        self.stream = None
+        self.slots = [None] * (num_batches + 1)
+        self.free = queue.Queue()
+        self.ready = queue.Queue()
+        self.in_use = None
+        self.thread = None
+
+    def _start(self):
+        if self.pin_memory:
+            self.stream = torch.cuda.Stream(self.device)
+        for i in range(len(self.slots)):
+            self.free.put(i)
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        while True:
+            i = self.free.get()
+            if i is None:
+                return
+            try:
+                self._fill(i)
+            except BaseException as e:
+                self.ready.put(e)
+                return
+            self.ready.put(i)
+
+    def _fill(self, i):
+        slot = self.slots[i]
+        if slot is None:
+            host = self.make_batch(pin_memory=self.pin_memory)
+            tensors = host.empty_like(self.device) if self.pin_memory else host
+            slot = self.slots[i] = {'host': host, 'tensors': tensors, 'out': None, 'released': None}
+        filled = self.fill_fn(slot['host'])
+        if not self.pin_memory:
+            slot['out'] = filled
+            return
+        out = slot['tensors'].narrow(len(filled))
+        if self.stream is None:
+            out.copy_(filled)
+        else:
+            # wait until the learner is done with the previous contents of this slot
+            if slot['released'] is not None:
+                self.stream.wait_event(slot['released'])
+            with torch.cuda.stream(self.stream):
+                out.copy_(filled, non_blocking=True)
+            self.stream.synchronize()
+        slot['out'] = out
+
+    def get(self):
+        if self.num_batches == 0:
+            self._fill(0)
+            return self.slots[0]['out']
+        if self.thread is None:
+            self._start()
+        if self.in_use is not None:
+            slot = self.slots[self.in_use]
+            if self.stream is not None:
+                slot['released'] = torch.cuda.Event()
+                slot['released'].record(torch.cuda.current_stream(self.device))
+            self.free.put(self.in_use)
+        item = self.ready.get()
+        if isinstance(item, BaseException):
+            raise item
+        self.in_use = item
+        return self.slots[item]['out']
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.get()
+
+    def close(self):
+        if self.thread is not None:
+            self.free.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def reset(self):
+        """Stop the worker and drop the prefetched batches; the next get() starts over."""
+        self.close()
+        for q in (self.free, self.ready):
+            while not q.empty():
+                q.get_nowait()
+        self.in_use = None
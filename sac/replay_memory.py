@@ -1,58 +1,532 @@
+import json
+import os
 import random
+import shutil
 import numpy as np
-from operator import itemgetter
 
-class ReplayMemory:
+from sac.sum_tree import SumTree
+
+FIELDS = ('observations', 'actions', 'rewards', 'next_observations', 'terminals')
+
+
+def save_store(dataset, path, chunk_size=100000):
+    """
+    Write a d4rl-style dataset dict as an on-disk replay store.
+
+    Layout: `path/` holds one float32 `<field>.npy` file per entry of FIELDS
+    (observations.npy, actions.npy, rewards.npy, next_observations.npy,
+    terminals.npy), all with the same leading length. The store is built in a
+    temporary sibling directory and renamed into place, so concurrent writers
+    are safe and a partially written store is never visible.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = f'{os.path.abspath(path)}.tmp-{os.getpid()}'
+    os.makedirs(tmp_path, exist_ok=True)
+    for key in FIELDS:
+        source = dataset[key]
+        array = np.lib.format.open_memmap(os.path.join(tmp_path, f'{key}.npy'), mode='w+',
+                                          dtype=np.float32, shape=np.shape(source))
+        for start in range(0, len(source), chunk_size):
+            array[start:start + chunk_size] = source[start:start + chunk_size]
+        array.flush()
+        del array
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process finished converting the same store first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.exists(path):
+            raise
+
+
+def load_store(path, mmap_mode='r'):
+    """
+    Open a store written by save_store. Fields are memory-mapped, so rows are
+    read from the page cache on demand and shared between processes.
+    """
+    return {key: np.load(os.path.join(path, f'{key}.npy'), mmap_mode=mmap_mode) for key in FIELDS}
+
+
+def read_manifest(path):
+    manifest_path = os.path.join(path, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return {'capacity': None, 'segments': [], 'epochs': {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def append_segment(path, dataset, epoch, capacity=None, dropped=0):
+    """
+    Append the transitions in `dataset` to the segmented export at `path`.
+
+    Layout: `path/segment-<k>/` are replay stores (see save_store) holding
+    consecutive runs of transitions, and `path/manifest.json` lists them with
+    their sizes and maps each exported epoch to the number of segments that
+    make up the data collected by then. `capacity` is the size of the
+    producing replay buffer; load_segments keeps only that many of the newest
+    transitions, like the buffer did. `dropped` counts the transitions
+    collected before `dataset` that were overwritten before this export; it
+    is recorded with the segment, which then holds a full buffer, so earlier
+    segments fall outside the newest `capacity` transitions anyway. The
+    manifest is replaced atomically after the segment is complete.
+    """
+    manifest = read_manifest(path)
+    if capacity is not None:
+        manifest['capacity'] = int(capacity)
+    n = len(dataset[FIELDS[0]])
+    if n > 0:
+        name = f'segment-{len(manifest["segments"]):05d}'
+        segment_path = os.path.join(path, name)
+        if os.path.exists(segment_path):
+            # left over from a run that stopped before updating the manifest
+            shutil.rmtree(segment_path)
+        save_store(dataset, segment_path)
+        manifest['segments'].append({'name': name, 'size': n, 'dropped': int(dropped)})
+    manifest['epochs'][str(epoch)] = len(manifest['segments'])
+    write_manifest(path, manifest)
+
+
+def write_manifest(path, manifest):
+    os.makedirs(path, exist_ok=True)
+    tmp_path = os.path.join(path, f'manifest.json.tmp-{os.getpid()}')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, os.path.join(path, 'manifest.json'))
+
+
+def truncate_segments(path, size):
+    """
+    Drop the segments that are not entirely within the first `size`
+    collected transitions, e.g. after resuming the producing run from an
+    earlier checkpoint. Returns the number of collected transitions the
+    remaining segments cover, counting the dropped ones.
+    """
+    manifest = read_manifest(path)
+    kept, end = 0, 0
+    for segment in manifest['segments']:
+        covered = segment.get('dropped', 0) + segment['size']
+        if end + covered > size:
+            break
+        end += covered
+        kept += 1
+    for segment in manifest['segments'][kept:]:
+        shutil.rmtree(os.path.join(path, segment['name']), ignore_errors=True)
+    manifest['segments'] = manifest['segments'][:kept]
+    manifest['epochs'] = {epoch: count for epoch, count in manifest['epochs'].items() if count <= kept}
+    write_manifest(path, manifest)
+    return end
+
+
+class SegmentedArray(object):
+    """
+    Read-only rows of one field across consecutive segments, without
+    concatenating them. Row i is row i + skip of the segments laid end to
+    end; it is found by (segment, offset) from the segment start rows, so
+    memory-mapped segments are only read where rows are indexed. Supports
+    len(), integer, slice and index-array indexing and np.take.
+    """
+    def __init__(self, arrays, skip=0):
+        self.arrays = arrays
+        sizes = [len(array) for array in arrays]
+        self.starts = np.cumsum([0] + sizes[:-1])
+        self.skip = skip
+        self.shape = (sum(sizes) - skip,) + arrays[0].shape[1:]
+        self.dtype = arrays[0].dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _gather(self, idxes, out=None):
+        rows = idxes + self.skip
+        segment = np.searchsorted(self.starts, rows, side='right') - 1
+        if out is None:
+            out = np.empty((len(rows),) + self.shape[1:], dtype=self.dtype)
+        for k in np.unique(segment):
+            select = segment == k
+            out[select] = self.arrays[k][rows[select] - self.starts[k]]
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self._gather(np.arange(start, stop, step))
+            parts = []
+            for array, first in zip(self.arrays, self.starts):
+                lo, hi = max(start + self.skip - first, 0), min(stop + self.skip - first, len(array))
+                if lo < hi:
+                    parts.append(array[lo:hi])
+            if not parts:
+                return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+            return np.concatenate(parts)
+        if np.isscalar(key):
+            key = int(key) % len(self)
+            return self._gather(np.array([key]))[0]
+        return self._gather(np.asarray(key, dtype=np.int64) % max(len(self), 1))
+
+    def take(self, idxes, axis=0, out=None, mode='raise'):
+        assert axis == 0
+        idxes = np.asarray(idxes, dtype=np.int64)
+        if mode == 'clip':
+            idxes = np.clip(idxes, 0, len(self) - 1)
+        return self._gather(idxes, out)
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[:]
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+
+def load_segments(path, epoch=None, mmap_mode='r'):
+    """
+    Dataset dict as of `epoch` (default: the latest) from a segmented export.
+    Only the segments needed are memory-mapped, and every field is a lazy
+    SegmentedArray over them. An export without segments gives empty fields.
+    """
+    manifest = read_manifest(path)
+    count = len(manifest['segments']) if epoch is None else manifest['epochs'][str(epoch)]
+    segments = manifest['segments'][:count]
+    skip = 0
+    if manifest['capacity'] is not None:
+        skip = max(0, sum(segment['size'] for segment in segments) - manifest['capacity'])
+    while segments and segments[0]['size'] <= skip:
+        skip -= segments[0]['size']
+        segments = segments[1:]
+    if not segments:
+        return {key: np.empty((0, 0) if key in ('observations', 'actions', 'next_observations') else (0,),
+                              dtype=np.float32) for key in FIELDS}
+    stores = [load_store(os.path.join(path, segment['name']), mmap_mode) for segment in segments]
+    return {key: SegmentedArray([store[key] for store in stores], skip) for key in FIELDS}
+
+
+class ReplaySampler(object):
+    """
+    Sampling shared by the replay buffers: uniform or prioritized indices
+    into the first `size` rows, which subclasses read with _gather(idxes)
+    and sample_into(batch, ...). `total` counts every transition ever stored.
+
+    After set_seed_streams(seeds), a sample is split into one equal block per
+    seed, as expected by Batch.split_seeds, and each block is drawn from that
+    seed's own numpy Generator, so the rows a stacked seed trains on do not
+    depend on how many other seeds share the pool.
+
+    After set_rng(seed), indices are drawn from the buffer's own numpy
+    Generator instead of the global RNGs, so a prefetch thread sampling the
+    buffer does not interleave its draws with the learner's.
+
+    After set_prioritized() transitions are sampled in proportion to
+    (loss + eps) ** alpha, kept in a SumTree; new transitions get the largest
+    priority seen so far, and batches sampled with sample_into carry the
+    importance weights (N * P(i)) ** -beta, normalized by their maximum.
+    """
     def __init__(self, capacity):
-        self.capacity = capacity
-        self.buffer = []
+        self.capacity = int(capacity)
+        self.size = 0
+        self.total = 0
+        self.tree = None
+        self.seed_rngs = None
+        self.rng = None
+        # (indices, losses) of trained batches not yet written to the tree, see batch_utils.flush_priorities
+        self.pending_priorities = []
+
+    def set_prioritized(self, alpha=0.6, beta=0.4, eps=1e-6):
+        self.tree = SumTree(self.capacity)
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.max_priority = 1.0
+        self.tree.update(np.arange(self.size), self.max_priority)
+
+    def set_seed_streams(self, seeds):
+        self.seed_rngs = [np.random.default_rng(seed) for seed in seeds]
+
+    def set_rng(self, seed):
+        self.rng = np.random.default_rng(seed)
+
+    def update_priorities(self, idxes, losses):
+        """Set the priorities of rows `idxes` from their losses; negative indices are skipped."""
+        keep = idxes >= 0
+        priorities = (np.asarray(losses, dtype=np.float64)[keep] + self.eps) ** self.alpha
+        self.tree.update(idxes[keep], priorities)
+        if len(priorities) > 0:
+            self.max_priority = max(self.max_priority, priorities.max())
+
+    def _sample_idxes(self, batch_size, replace=False):
+        if self.tree is not None:
+            return np.minimum(self.tree.sample(int(batch_size), self.rng), self.size - 1)
+        if self.seed_rngs is not None:
+            n = int(batch_size) // len(self.seed_rngs)
+            return np.concatenate([rng.integers(0, self.size, n) if replace else rng.choice(self.size, n, replace=False)
+                                   for rng in self.seed_rngs])
+        if batch_size > self.size and not replace:
+            batch_size = self.size
+        if self.rng is not None:
+            if replace:
+                return self.rng.integers(0, self.size, batch_size)
+            return self.rng.choice(self.size, int(batch_size), replace=False)
+        if replace:
+            return np.random.randint(0, self.size, batch_size)
+        return np.array(random.sample(range(self.size), int(batch_size)), dtype=np.int64)
+
+    def sample(self, batch_size):
+        return self._gather(self._sample_idxes(batch_size))
+
+    def sample_all_batch(self, batch_size):
+        return self._gather(self._sample_idxes(batch_size, replace=True))
+
+    def _write_weights(self, batch, idxes, start):
+        """Importance weights and row indices for batches that carry them (uniform rows: 1 and -1)."""
+        if batch.weights is None:
+            return
+        n = len(idxes)
+        weights = batch.weights.numpy()[start:start + n, 0]
+        indices = batch.indices.numpy()[start:start + n]
+        if self.tree is None:
+            weights[:] = 1
+            indices[:] = -1
+            return
+        with self.tree.lock:
+            probs = self.tree.get(idxes) / self.tree.total()
+        w = (self.size * probs) ** -self.beta
+        weights[:] = w / w.max()
+        indices[:] = idxes
+
+    def sampler_state_dict(self):
+        """Sampling state for checkpoints: the priorities of the stored rows and the buffer's own RNG states."""
+        state = {}
+        if self.tree is not None:
+            with self.tree.lock:
+                state['priorities'] = self.tree.get(np.arange(self.size))
+            state['max_priority'] = self.max_priority
+        if self.seed_rngs is not None:
+            state['seed_rngs'] = [rng.bit_generator.state for rng in self.seed_rngs]
+        if self.rng is not None:
+            state['rng'] = self.rng.bit_generator.state
+        return state
+
+    def load_sampler_state_dict(self, state):
+        if self.tree is not None and 'priorities' in state:
+            priorities = state['priorities']
+            self.tree.update(np.arange(len(priorities)), priorities)
+            self.max_priority = state['max_priority']
+            self.pending_priorities = []
+        if self.seed_rngs is not None and 'seed_rngs' in state:
+            for rng, rng_state in zip(self.seed_rngs, state['seed_rngs']):
+                rng.bit_generator.state = rng_state
+        if self.rng is not None and 'rng' in state:
+            self.rng.bit_generator.state = state['rng']
+
+    def as_dataset(self):
+        """d4rl-style dict of the stored transitions (views, not copies)."""
+        return dict(zip(FIELDS, self.return_all()))
+
+    def save_buffer(self, path='dataset/'):
+        np.save(path, self.as_dataset())
+
+    def __len__(self):
+        return self.size
+
+
+class ReplayMemory(ReplaySampler):
+    """
+    Ring buffer storing one preallocated float32 array per field.
+    Field shapes are taken from the first transition that is pushed.
+    """
+    def __init__(self, capacity):
+        super().__init__(capacity)
+        self.storage = None
         self.position = 0
 
+    @classmethod
+    def from_arrays(cls, dataset):
+        """
+        Build a full buffer that adopts the arrays of a d4rl-style dataset dict.
+        Arrays that are already float32, including the lazy SegmentedArrays
+        of load_segments, are used as-is without copying.
+        """
+        arrays = [dataset[key] if isinstance(dataset[key], SegmentedArray) and dataset[key].dtype == np.float32
+                  else np.asarray(dataset[key], dtype=np.float32) for key in FIELDS]
+        n = arrays[0].shape[0]
+        assert all(array.shape[0] == n for array in arrays)
+        memory = cls(n)
+        memory.storage = arrays
+        memory.size = n
+        memory.total = n
+        return memory
+
+    @classmethod
+    def from_store(cls, path):
+        """Read-only buffer backed by the memory-mapped fields of a replay store."""
+        return cls.from_arrays(load_store(path))
+
+    def _allocate(self, transition):
+        self.storage = [np.empty((self.capacity,) + np.shape(x), dtype=np.float32) for x in transition]
+
     def push(self, state, action, reward, next_state, done):
-        if len(self.buffer) < self.capacity:
-            self.buffer.append(None)
-        self.buffer[self.position] = (state, action, reward, next_state, done)
+        if self.storage is None:
+            self._allocate((state, action, reward, next_state, done))
+        for array, x in zip(self.storage, (state, action, reward, next_state, done)):
+            array[self.position] = x
+        if self.tree is not None:
+            self.tree.update([self.position], self.max_priority)
         self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.total += 1
 
     def push_batch(self, batch):
-        if len(self.buffer) < self.capacity:
-            append_len = min(self.capacity - len(self.buffer), len(batch))
-            self.buffer.extend([None] * append_len)
-
-        if self.position + len(batch) < self.capacity:
-            self.buffer[self.position : self.position + len(batch)] = batch
-            self.position += len(batch)
-        else:
-            self.buffer[self.position : len(self.buffer)] = batch[:len(self.buffer) - self.position]
-            self.buffer[:len(batch) - len(self.buffer) + self.position] = batch[len(self.buffer) - self.position:]
-            self.position = len(batch) - len(self.buffer) + self.position
+        """
+        batch: list of (state, action, reward, next_state, done) tuples, or a
+               tuple of five arrays with a leading batch dimension
+        """
+        if isinstance(batch, list):
+            if len(batch) == 0:
+                return
+            batch = [np.stack(x) for x in zip(*batch)]
+        n = len(batch[0])
+        if n == 0:
+            return
+        if self.storage is None:
+            self._allocate([x[0] for x in batch])
+        self.total += n
+        if n > self.capacity:
+            # only the most recent `capacity` transitions would survive anyway
+            batch = [x[n - self.capacity:] for x in batch]
+            n = self.capacity
 
-    def sample(self, batch_size):
-        if batch_size > len(self.buffer):
-            batch_size = len(self.buffer)
-        batch = random.sample(self.buffer, int(batch_size))
-        state, action, reward, next_state, done = map(np.stack, zip(*batch))
-        return state, action, reward, next_state, done
+        first = min(n, self.capacity - self.position)
+        for array, x in zip(self.storage, batch):
+            array[self.position:self.position + first] = x[:first]
+            array[:n - first] = x[first:]
+        if self.tree is not None:
+            self.tree.update((self.position + np.arange(n)) % self.capacity, self.max_priority)
+        self.position = (self.position + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
 
-    def sample_all_batch(self, batch_size):
-        idxes = np.random.randint(0, len(self.buffer), batch_size)
-        batch = list(itemgetter(*idxes)(self.buffer))
-        state, action, reward, next_state, done = map(np.stack, zip(*batch))
-        return state, action, reward, next_state, done
+    def _gather(self, idxes):
+        return tuple(array[idxes] for array in self.storage)
+
+    def sample_into(self, batch, batch_size, start=0, replace=False):
+        """
+        Gather a sample straight into rows [start, start + n) of a host
+        sac.batch.Batch, storing mask = 1 - done. Returns the number of rows n.
+        """
+        idxes = self._sample_idxes(int(batch_size), replace=replace)
+        n = len(idxes)
+        outs = batch.numpy()
+        for out, array in zip(outs, self.storage):
+            np.take(array, idxes, axis=0, out=out[start:start + n].reshape((n,) + array.shape[1:]), mode='clip')
+        mask = outs[-1][start:start + n]
+        np.subtract(1, mask, out=mask)
+        self._write_weights(batch, idxes, start)
+        return n
 
     def return_all(self):
-        state, action, reward, next_state, done = map(np.stack, zip(*self.buffer))
-        return state, action, reward, next_state, done
+        return tuple(array[:self.size] for array in self.storage)
 
-    def save_buffer(self, path='dataset/'):
-        state, action, reward, next_state, done = map(np.stack, zip(*self.buffer))
-        dataset = {}
-        dataset['observations'] = state
-        dataset['actions'] = action
-        dataset['rewards'] = reward
-        dataset['next_observations'] = next_state
-        dataset['terminals'] = done
-        np.save(path, dataset)
+    def state_dict(self):
+        """Stored transitions and the write cursor, for checkpoints."""
+        storage = [array[:self.size] for array in self.storage] if self.size > 0 else None
+        return {'capacity': self.capacity, 'position': self.position, 'size': self.size, 'total': self.total,
+                'storage': storage, 'sampler': self.sampler_state_dict()}
 
-    def __len__(self):
-        return len(self.buffer)
+    def load_state_dict(self, state):
+        assert state['capacity'] == self.capacity
+        if state['storage'] is not None:
+            self._allocate([array[0] for array in state['storage']])
+            for array, saved in zip(self.storage, state['storage']):
+                array[:state['size']] = saved
+        self.position = state['position']
+        self.size = state['size']
+        self.total = state.get('total', self.size)
+        self.load_sampler_state_dict(state.get('sampler', {}))
+
+    def transitions_since(self, total):
+        """
+        d4rl-style dict of the transitions pushed after the first `total`
+        ones, oldest first. Those that have been overwritten already are left
+        out, at most the `size` stored transitions are returned.
+        """
+        n = min(self.total - total, self.size)
+        if self.storage is None:
+            return {key: np.empty((0, 0) if key in ('observations', 'actions', 'next_observations') else (0,),
+                              dtype=np.float32) for key in FIELDS}
+        assert n >= 0
+        idxes = np.arange(self.position - n, self.position) % self.capacity
+        return dict(zip(FIELDS, self._gather(idxes)))
+
+
+def encode_observations(x, dtype):
+    """float32 -> storage dtype; bfloat16 is kept as the upper 16 bits in uint16 (round to nearest even)."""
+    x = np.asarray(x, dtype=np.float32)
+    if dtype == 'bfloat16':
+        bits = x.view(np.uint32)
+        return ((bits + 0x7FFF + ((bits >> 16) & 1)) >> 16).astype(np.uint16)
+    return x.astype(dtype)
+
+
+def decode_observations(x, dtype):
+    if dtype == 'bfloat16':
+        return (x.astype(np.uint32) << 16).view(np.float32)
+    return x.astype(np.float32)
+
+
+class CompactReplayMemory(ReplaySampler):
+    """
+    Read-only buffer for trajectory-ordered datasets with a smaller footprint.
+
+    Observations are stored once: next_observations[i] is observations[i + 1]
+    except at episode boundaries, whose next observations go to extra rows
+    appended after the dataset, and next_idx holds the row of every next
+    observation. Observations can be kept in float16 or bfloat16 and are
+    upcast to float32 when sampled; done flags are stored as uint8.
+    """
+    def __init__(self, capacity, obs_dtype='float16'):
+        super().__init__(capacity)
+        self.obs_dtype = obs_dtype
+
+    @classmethod
+    def from_arrays(cls, dataset, obs_dtype='float16'):
+        observations = np.asarray(dataset['observations'], dtype=np.float32)
+        next_observations = np.asarray(dataset['next_observations'], dtype=np.float32)
+        n = observations.shape[0]
+        follows = np.zeros(n, dtype=bool)
+        follows[:-1] = np.all(next_observations[:-1] == observations[1:], axis=1)
+        extra = np.flatnonzero(~follows)
+        index_dtype = np.int32 if n + len(extra) < 2 ** 31 else np.int64
+        next_idx = np.arange(1, n + 1, dtype=index_dtype)
+        next_idx[extra] = n + np.arange(len(extra), dtype=index_dtype)
+
+        memory = cls(n, obs_dtype)
+        memory.observations = np.concatenate([encode_observations(observations, obs_dtype),
+                                              encode_observations(next_observations[extra], obs_dtype)])
+        memory.next_idx = next_idx
+        memory.actions = np.asarray(dataset['actions'], dtype=np.float32)
+        memory.rewards = np.asarray(dataset['rewards'], dtype=np.float32)
+        memory.terminals = np.asarray(dataset['terminals']).astype(np.uint8)
+        memory.size = memory.total = n
+        return memory
+
+    @classmethod
+    def from_store(cls, path, obs_dtype='float16'):
+        return cls.from_arrays(load_store(path), obs_dtype)
+
+    def _gather(self, idxes):
+        return (decode_observations(self.observations[idxes], self.obs_dtype),
+                self.actions[idxes],
+                self.rewards[idxes],
+                decode_observations(self.observations[self.next_idx[idxes]], self.obs_dtype),
+                self.terminals[idxes].astype(np.float32))
+
+    def sample_into(self, batch, batch_size, start=0, replace=False):
+        idxes = self._sample_idxes(int(batch_size), replace=replace)
+        n = len(idxes)
+        outs = [out[start:start + n] for out in batch.numpy()]
+        for out, values in zip(outs, self._gather(idxes)):
+            out[...] = values.reshape(out.shape)
+        np.subtract(1, outs[-1], out=outs[-1])
+        self._write_weights(batch, idxes, start)
+        return n
+
+    def return_all(self):
+        return self._gather(np.arange(self.size))
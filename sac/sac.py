@@ -2,11 +2,12 @@ import os
 import torch
 import torch.nn.functional as F
 from torch.optim import Adam
-from sac.utils import soft_update, hard_update
+from sac.utils import soft_update, hard_update, MultiStepUpdater, stack_losses, seed_mean, resolve_device
 from sac.model import GaussianPolicy, QNetwork, DeterministicPolicy
+from sac.batch import as_batch
 
 
-class SAC(object):
+class SAC(MultiStepUpdater):
     def __init__(self, num_inputs, action_space,
                  gamma=0.99, tau=0.005, alpha=0.2,
                  policy='Gaussian',
@@ -15,7 +16,8 @@ class SAC(object):
                  target_entropy=-3,
                  hidden_size=256,
                  lr=0.0003,
-                 device='cuda'):
+                 device='auto',
+                 num_seeds=None):
 
         self.gamma = gamma
         self.tau = tau
@@ -25,11 +27,14 @@ class SAC(object):
         self.target_update_interval = target_update_interval
         self.automatic_entropy_tuning = automatic_entropy_tuning
 
-        self.device = device
+        self.device = resolve_device(device)
+        self.num_seeds = num_seeds
+        if num_seeds is not None and self.policy_type != "Gaussian":
+            raise ValueError('num_seeds requires the Gaussian policy')
 
-        self.critic = QNetwork(num_inputs, action_space.shape[0], hidden_size).to(self.device)
+        self.critic = QNetwork(num_inputs, action_space.shape[0], hidden_size, num_seeds).to(self.device)
         self.critic_optim = Adam(self.critic.parameters(), lr=lr)
-        self.critic_target = QNetwork(num_inputs, action_space.shape[0], hidden_size).to(self.device)
+        self.critic_target = QNetwork(num_inputs, action_space.shape[0], hidden_size, num_seeds).to(self.device)
         hard_update(self.critic_target, self.critic)
 
         if self.policy_type == "Gaussian":
@@ -38,11 +43,13 @@ class SAC(object):
                 self.target_entropy = -torch.prod(torch.Tensor(action_space.shape).to(self.device)).item()
                 if self.target_entropy != 'auto':
                     self.target_entropy = target_entropy
-                self.log_alpha = torch.zeros(1, requires_grad=True, device=self.device)
+                alpha_shape = (1,) if num_seeds is None else (num_seeds, 1, 1)
+                self.log_alpha = torch.zeros(alpha_shape, requires_grad=True, device=self.device)
                 self.alpha_optim = Adam([self.log_alpha], lr=lr)
             else:
                 self.alpha = alpha
-            self.policy = GaussianPolicy(num_inputs, action_space.shape[0], hidden_size, action_space).to(self.device)
+            self.policy = GaussianPolicy(num_inputs, action_space.shape[0], hidden_size, action_space,
+                                         num_seeds).to(self.device)
             self.policy_optim = Adam(self.policy.parameters(), lr=lr)
 
         else:
@@ -60,15 +67,12 @@ class SAC(object):
         return action.detach().cpu().numpy()[0]
 
     def update_parameters(self, memory, batch_size, updates):
+        return tuple(stack_losses(self._update(memory, updates), self.num_seeds).tolist())
+
+    def _update(self, memory, updates):
         # Sample a batch from memory
         # state_batch, action_batch, reward_batch, next_state_batch, mask_batch = memory.sample(batch_size=batch_size)
-        state_batch, action_batch, reward_batch, next_state_batch, mask_batch = memory
-
-        state_batch = torch.FloatTensor(state_batch).to(self.device)
-        next_state_batch = torch.FloatTensor(next_state_batch).to(self.device)
-        action_batch = torch.FloatTensor(action_batch).to(self.device)
-        reward_batch = torch.FloatTensor(reward_batch).to(self.device).unsqueeze(1)
-        mask_batch = torch.FloatTensor(mask_batch).to(self.device).unsqueeze(1)
+        state_batch, action_batch, reward_batch, next_state_batch, mask_batch = as_batch(memory, self.device, self.num_seeds)
 
         with torch.no_grad():
             next_state_action, next_state_log_pi, _ = self.policy.sample(next_state_batch)
@@ -77,14 +81,14 @@ class SAC(object):
             next_q_value = reward_batch + mask_batch * self.gamma * (min_qf_next_target)
 
         qf1, qf2 = self.critic(state_batch, action_batch)  # Two Q-functions to mitigate positive bias in the policy improvement step
-        qf1_loss = F.mse_loss(qf1, next_q_value) # JQ = 𝔼(st,at)~D[0.5(Q1(st,at) - r(st,at) - γ(𝔼st+1~p[V(st+1)]))^2]
-        qf2_loss = F.mse_loss(qf2, next_q_value) # JQ = 𝔼(st,at)~D[0.5(Q1(st,at) - r(st,at) - γ(𝔼st+1~p[V(st+1)]))^2]
+        qf1_loss = seed_mean(F.mse_loss(qf1, next_q_value, reduction='none'), self.num_seeds) # JQ = 𝔼(st,at)~D[0.5(Q1(st,at) - r(st,at) - γ(𝔼st+1~p[V(st+1)]))^2]
+        qf2_loss = seed_mean(F.mse_loss(qf2, next_q_value, reduction='none'), self.num_seeds) # JQ = 𝔼(st,at)~D[0.5(Q1(st,at) - r(st,at) - γ(𝔼st+1~p[V(st+1)]))^2]
         # qf1_loss = qf1_loss.clamp_max(5000.)
         # qf2_loss = qf2_loss.clamp_max(5000.)
         qf_loss = qf1_loss + qf2_loss
 
         self.critic_optim.zero_grad()
-        qf_loss.backward()
+        qf_loss.sum().backward()
         self.critic_optim.step()
 
         pi, log_pi, _ = self.policy.sample(state_batch)
@@ -92,7 +96,7 @@ class SAC(object):
         qf1_pi, qf2_pi = self.critic(state_batch, pi)
         min_qf_pi = torch.min(qf1_pi, qf2_pi)
 
-        policy_loss = ((self.alpha * log_pi) - min_qf_pi).mean() # Jπ = 𝔼st∼D,εt∼N[α * logπ(f(εt;st)|st) − Q(st,f(εt;st))]
+        policy_loss = seed_mean((self.alpha * log_pi) - min_qf_pi, self.num_seeds) # Jπ = 𝔼st∼D,εt∼N[α * logπ(f(εt;st)|st) − Q(st,f(εt;st))]
         from IPython.core.debugger import set_trace
 
 
@@ -105,37 +109,39 @@ class SAC(object):
         # self.critic_optim.step()
 
         self.policy_optim.zero_grad()
-        policy_loss.backward()
+        policy_loss.sum().backward()
         self.policy_optim.step()
 
         if self.automatic_entropy_tuning:
-            alpha_loss = -(self.log_alpha * (log_pi + self.target_entropy).detach()).mean()
+            alpha_loss = -seed_mean(self.log_alpha * (log_pi + self.target_entropy).detach(), self.num_seeds)
 
             self.alpha_optim.zero_grad()
-            alpha_loss.backward()
+            alpha_loss.sum().backward()
             self.alpha_optim.step()
 
             self.alpha = self.log_alpha.exp()
             alpha_tlogs = self.alpha.clone() # For TensorboardX logs
         else:
-            alpha_loss = torch.tensor(0.).to(self.device)
-            alpha_tlogs = torch.tensor(self.alpha) # For TensorboardX logs
+            alpha_loss = torch.tensor(0., device=self.device)
+            alpha_tlogs = torch.tensor(self.alpha, device=self.device) # For TensorboardX logs
 
 
         if updates % self.target_update_interval == 0:
             soft_update(self.critic_target, self.critic, self.tau)
 
-        return qf1_loss.item(), qf2_loss.item(), policy_loss.item(), alpha_loss.item(), alpha_tlogs.item()
+        return qf1_loss, qf2_loss, policy_loss, alpha_loss, alpha_tlogs
 
     # Save model parameters
+    def model_state_dicts(self, path):
+        return {path + '-actor.pt': self.policy.state_dict(),
+                path + '-critic.pt': self.critic.state_dict()}
+
     def save_model(self, path):
         if not os.path.exists('saved_policies/'):
             os.makedirs('saved_policies/')
 
-        actor_path = path+'-actor.pt'
-        critic_path = path + '-critic.pt'
-        torch.save(self.policy.state_dict(), actor_path)
-        torch.save(self.critic.state_dict(), critic_path)
+        for model_path, state_dict in self.model_state_dicts(path).items():
+            torch.save(state_dict, model_path)
 
     # Load model parameters
     def load_model(self, path):
@@ -0,0 +1,56 @@
+import threading
+import numpy as np
+
+
+class SumTree(object):
+    """
+    Array-based binary sum-tree over `capacity` non-negative priorities.
+
+    Node i has children 2i and 2i + 1, the root is node 1 and leaf j is node
+    leaves + j, where leaves is capacity rounded up to a power of two. update
+    and sample work on whole batches, touching one vectorized slice of nodes
+    per level, so both are O(log N) per element.
+    """
+    def __init__(self, capacity):
+        self.leaves = 1 << int(np.ceil(np.log2(max(int(capacity), 1))))
+        self.nodes = np.zeros(2 * self.leaves, dtype=np.float64)
+        # the prefetch thread samples while the learner updates priorities
+        self.lock = threading.Lock()
+
+    def total(self):
+        return self.nodes[1]
+
+    def get(self, idxes):
+        return self.nodes[np.asarray(idxes) + self.leaves]
+
+    def update(self, idxes, priorities):
+        nodes = np.asarray(idxes, dtype=np.int64) + self.leaves
+        if len(nodes) == 0:
+            return
+        with self.lock:
+            self.nodes[nodes] = priorities
+            while nodes[0] > 1:
+                nodes = np.unique(nodes // 2)
+                self.nodes[nodes] = self.nodes[2 * nodes] + self.nodes[2 * nodes + 1]
+
+    def find(self, values):
+        """Leaf index of every prefix-sum value in [0, total())."""
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        while nodes[0] < self.leaves:
+            left = 2 * nodes
+            right = values >= self.nodes[left]
+            values -= self.nodes[left] * right
+            nodes = left + right
+        return nodes - self.leaves
+
+    def sample(self, n, rng=None):
+        """
+        n leaf indices drawn proportionally to priority, one from each of n
+        equal slices of the total, using `rng` (a numpy Generator) if given.
+        """
+        offsets = np.random.rand(n) if rng is None else rng.random(n)
+        with self.lock:
+            total = self.total()
+            values = (np.arange(n) + offsets) * (total / n)
+            return self.find(np.minimum(values, np.nextafter(total, 0)))
@@ -20,9 +20,133 @@ def logsumexp(inputs, dim=None, keepdim=False):
     return outputs
 
 def soft_update(target, source, tau):
-    for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(target_param.data * (1.0 - tau) + param.data * tau)
+    """target <- (1 - tau) * target + tau * source, in place and without temporaries."""
+    with torch.no_grad():
+        target_params = list(target.parameters())
+        params = list(source.parameters())
+        if hasattr(torch, '_foreach_lerp_'):
+            # one fused kernel per dtype/device group instead of one per parameter
+            torch._foreach_lerp_(target_params, params, tau)
+        else:
+            for target_param, param in zip(target_params, params):
+                target_param.lerp_(param, tau)
+
+def resolve_device(device='auto'):
+    """'auto' picks the default CUDA device when there is one and the CPU otherwise."""
+    if device is None or device == 'auto':
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(device)
+
+def fused_adam_kwargs(device):
+    """
+    Adam options that update all parameters of the optimizer in one (or a
+    few) kernels: the fused kernel on CUDA, the multi-tensor foreach path on
+    the CPU. Used where one optimizer steps a whole ensemble together with
+    other learned tensors, e.g. CODAC version 3.
+    """
+    if torch.device(device).type == 'cuda':
+        return {'fused': True}
+    return {'foreach': True}
 
 def hard_update(target, source):
     for target_param, param in zip(target.parameters(), source.parameters()):
         target_param.data.copy_(param.data)
+
+
+LOSS_NAMES = ('critic1_loss', 'critic2_loss', 'policy_loss', 'entropy_loss', 'alpha')
+# agents with a critic ensemble of any size report the mean loss of its members
+ENSEMBLE_LOSS_NAMES = ('critic_loss', 'policy_loss', 'entropy_loss', 'alpha')
+TRAIN_COUNTERS = ('_n_train_steps_total', 'updates')
+# optimized tensors that are not module parameters
+LEARNER_TENSORS = ('log_alpha', 'log_alpha_prime')
+
+
+def stack_losses(losses, num_seeds=None):
+    """(len(losses),) losses, or (len(losses), num_seeds) for a stacked multi-seed agent."""
+    if num_seeds is None:
+        return torch.stack([loss.detach().reshape(()) for loss in losses])
+    return torch.stack([loss.detach().reshape(-1).expand(num_seeds) for loss in losses])
+
+
+def seed_mean(x, num_seeds=None):
+    """
+    Mean of x, or the (num_seeds,) per-seed means of an x whose leading dim
+    is the seed dim of a stacked multi-seed agent. Seeds never share
+    gradients, so the losses of all seeds are summed for the backward pass.
+    """
+    if num_seeds is None:
+        return x.mean()
+    return x.reshape(num_seeds, -1).mean(1)
+
+
+class MultiStepUpdater(object):
+    """
+    Base for agents whose _update(batch, updates) returns the scalar loss
+    tensors named in loss_names (LOSS_NAMES by default), or (num_seeds,) losses when the agent
+    trains num_seeds stacked replicas (see seed_mean). update_many runs k
+    gradient steps back to back, summing the losses into an on-device
+    accumulator instead of reading them back; read_losses() returns their
+    running means with a single sync, as lists of per-seed means for
+    stacked agents.
+    priority_fn(batch, self.priorities), if given, is called after each step
+    by agents that set per-sample priorities.
+
+    state_dict()/load_state_dict() capture the full learner state: every
+    network and optimizer attribute, the tensors in LEARNER_TENSORS and the
+    step counters in TRAIN_COUNTERS. Per-step values such as the last losses
+    and priorities are not saved, and loading resets the loss accumulator.
+    """
+    _loss_sum = None
+    _loss_count = 0
+    num_seeds = None
+    loss_names = LOSS_NAMES
+
+    def update_many(self, batches, k, updates=0, priority_fn=None):
+        batches = iter(batches)
+        for i in range(k):
+            batch = next(batches)
+            losses = stack_losses(self._update(batch, updates + i), self.num_seeds)
+            if priority_fn is not None:
+                priority_fn(batch, self.priorities)
+            if self._loss_sum is None:
+                self._loss_sum = torch.zeros_like(losses)
+            self._loss_sum += losses
+            self._loss_count += 1
+        return k
+
+    def read_losses(self, reset=True):
+        if self._loss_count == 0:
+            return None
+        means = (self._loss_sum / self._loss_count).tolist()
+        if reset:
+            self._loss_sum.zero_()
+            self._loss_count = 0
+        return dict(zip(self.loss_names, means))
+
+    def state_dict(self):
+        state = {}
+        for name, value in vars(self).items():
+            if isinstance(value, (torch.nn.Module, torch.optim.Optimizer)):
+                state[name] = value.state_dict()
+            elif name in LEARNER_TENSORS:
+                state[name] = value.detach().clone()
+            elif name in TRAIN_COUNTERS:
+                state[name] = value
+        return state
+
+    def load_state_dict(self, state):
+        for name, value in state.items():
+            current = getattr(self, name, None)
+            if isinstance(current, (torch.nn.Module, torch.optim.Optimizer)):
+                current.load_state_dict(value)
+            elif name in LEARNER_TENSORS:
+                # optimized in place, the optimizer keeps a reference to it
+                with torch.no_grad():
+                    current.copy_(value)
+            elif name in TRAIN_COUNTERS:
+                setattr(self, name, value)
+        if 'log_alpha' in state:
+            # the tuned temperature is always exp(log_alpha) after an update
+            self.alpha = self.log_alpha.exp()
+        self._loss_sum = None
+        self._loss_count = 0
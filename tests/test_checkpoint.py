@@ -0,0 +1,55 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+import numpy as np
+
+import distributional.tau_samplers as tau_samplers
+from checkpoint import save_checkpoint, load_checkpoint
+from distributional.codac import CODAC
+
+
+class Box(object):
+    def __init__(self, dim):
+        self.shape = (dim,)
+        self.high = np.ones(dim, dtype=np.float32)
+        self.low = -np.ones(dim, dtype=np.float32)
+
+
+def random_batches(k, n=16, state_dim=3, action_dim=2):
+    rng = np.random.RandomState(0)
+    return [(rng.randn(n, state_dim).astype(np.float32),
+             rng.uniform(-1, 1, (n, action_dim)).astype(np.float32),
+             rng.randn(n).astype(np.float32),
+             rng.randn(n, state_dim).astype(np.float32),
+             (rng.rand(n) > 0.1).astype(np.float32)) for _ in range(k)]
+
+
+def make_agent(tau_type):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    return CODAC(3, Box(2), tau_type=tau_type, hidden_size=32, num_quantiles=8, device='cpu')
+
+
+@pytest.mark.parametrize('tau_type', ['iqn', 'sobol'])
+def test_resume_matches_uninterrupted_run(tau_type, tmp_path):
+    batches = random_batches(6)
+    path = str(tmp_path / 'checkpoint.pt')
+
+    tau_samplers._sobol_engines.clear()
+    agent = make_agent(tau_type)
+    agent.update_many(batches[:3], 3)
+    save_checkpoint(path, agent, 1, 3)
+    agent.update_many(batches[3:], 3)
+
+    # a new process: fresh sequences, other RNG states and a newly initialized agent
+    tau_samplers._sobol_engines.clear()
+    resumed = make_agent(tau_type)
+    torch.manual_seed(1)
+    np.random.seed(1)
+    assert load_checkpoint(path, resumed) == (1, 3)
+    resumed.update_many(batches[3:], 3)
+
+    for name, param in agent.policy.named_parameters():
+        assert torch.equal(param, dict(resumed.policy.named_parameters())[name]), name
+    for name, param in agent.zf.named_parameters():
+        assert torch.equal(param, dict(resumed.zf.named_parameters())[name]), name
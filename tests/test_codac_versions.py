@@ -0,0 +1,42 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+import numpy as np
+
+from distributional.codac import CODAC
+
+
+class Box(object):
+    def __init__(self, dim):
+        self.shape = (dim,)
+        self.high = np.ones(dim, dtype=np.float32)
+        self.low = -np.ones(dim, dtype=np.float32)
+
+
+def random_batch(n=16, state_dim=3, action_dim=2):
+    rng = np.random.RandomState(0)
+    return (rng.randn(n, state_dim).astype(np.float32),
+            rng.uniform(-1, 1, (n, action_dim)).astype(np.float32),
+            rng.randn(n).astype(np.float32),
+            rng.randn(n, state_dim).astype(np.float32),
+            (rng.rand(n) > 0.1).astype(np.float32))
+
+
+def one_update(version):
+    torch.manual_seed(0)
+    agent = CODAC(3, Box(2), version=version, hidden_size=32, num_quantiles=8, device='cpu')
+    torch.manual_seed(1)
+    np.random.seed(1)
+    agent._update(random_batch(), 0)
+    return agent
+
+
+def test_version3_matches_version2():
+    # log_alpha_prime.grad differs by design: version 2 leaves the critic loss' gradient in it after its step
+    v2, v3 = one_update(2), one_update(3)
+    for (name, p2), p3 in zip(v2.zf.named_parameters(), v3.zf.parameters()):
+        assert torch.allclose(p2.grad, p3.grad, rtol=1e-4, atol=1e-6), name
+        assert torch.allclose(p2, p3, rtol=1e-4, atol=1e-6), name
+    assert torch.allclose(v2.log_alpha_prime, v3.log_alpha_prime, rtol=1e-4, atol=1e-6)
+    for p2, p3 in zip(v2.policy.parameters(), v3.policy.parameters()):
+        assert torch.allclose(p2, p3, rtol=1e-4, atol=1e-6)
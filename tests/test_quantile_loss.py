@@ -0,0 +1,48 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+import torch.nn.functional as F
+
+from distributional.dsac import QuantileHuberLoss, quantile_regression_loss
+
+
+def dense_quantile_loss(input, target, tau, weight):
+    """Per-sample losses (..., N) of the unchunked implementation, with every (N, T, T) term materialized."""
+    diff = input.unsqueeze(-1) - target.unsqueeze(-2)
+    L = F.smooth_l1_loss(diff, torch.zeros_like(diff), reduction='none')
+    sign = torch.sign(diff) / 2. + 0.5
+    rho = torch.abs(tau.unsqueeze(-1) - sign) * L * weight.unsqueeze(-2)
+    return rho.sum(dim=-1).mean(dim=-1)
+
+
+def quantile_inputs(E=2, N=5, T=7, dtype=torch.float64):
+    gen = torch.Generator().manual_seed(0)
+    input = 2 * torch.randn(E, N, T, dtype=dtype, generator=gen)
+    target = 2 * torch.randn(N, T, dtype=dtype, generator=gen)
+    tau = torch.rand(N, T, dtype=dtype, generator=gen).sort(dim=-1)[0]
+    weight = torch.softmax(torch.randn(N, T, dtype=dtype, generator=gen), dim=-1)
+    return input, target, tau, weight
+
+
+def test_gradcheck():
+    input, target, tau, weight = quantile_inputs()
+    input.requires_grad_()
+    assert torch.autograd.gradcheck(lambda x: QuantileHuberLoss.apply(x, target, tau, weight, 3), (input,))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 16])
+def test_chunked_matches_unchunked(chunk_size):
+    input, target, tau, weight = quantile_inputs()
+    chunked = input.clone().requires_grad_()
+    dense = input.clone().requires_grad_()
+
+    losses = quantile_regression_loss(chunked, target, tau, weight, reduction='none', chunk_size=chunk_size)
+    expected = dense_quantile_loss(dense, target, tau, weight)
+    assert torch.allclose(losses, expected)
+    assert torch.allclose(quantile_regression_loss(input, target, tau, weight, chunk_size=chunk_size),
+                          expected.mean())
+
+    grad_output = torch.rand_like(losses)
+    losses.backward(grad_output)
+    expected.backward(grad_output)
+    assert torch.allclose(chunked.grad, dense.grad)
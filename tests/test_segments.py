@@ -0,0 +1,37 @@
+import numpy as np
+
+from sac.replay_memory import (ReplayMemory, FIELDS, append_segment, load_segments, read_manifest,
+                               truncate_segments)
+
+
+def push_transitions(memory, start, count):
+    for i in range(start, start + count):
+        memory.push(np.full(2, i), np.full(1, i), float(i), np.full(2, i + 1), 0.)
+
+
+def test_export_after_the_buffer_wraps(tmp_path):
+    path = str(tmp_path / 'export')
+    memory = ReplayMemory(10)
+    push_transitions(memory, 0, 4)
+    append_segment(path, memory.transitions_since(0), 1, memory.capacity)
+    exported = memory.total
+
+    # 25 transitions between two exports overwrite the whole buffer
+    push_transitions(memory, 4, 25)
+    transitions = memory.transitions_since(exported)
+    assert len(transitions['rewards']) == 10
+    dropped = memory.total - exported - len(transitions['rewards'])
+    append_segment(path, transitions, 2, memory.capacity, dropped)
+
+    assert [segment['dropped'] for segment in read_manifest(path)['segments']] == [0, 15]
+    dataset = load_segments(path)
+    for key, stored in zip(FIELDS, memory.return_all()):
+        assert np.array_equal(np.asarray(dataset[key]), np.roll(stored, -memory.position, axis=0))
+    assert np.array_equal(np.asarray(dataset['rewards']), np.arange(19, 29))
+    assert np.array_equal(np.asarray(load_segments(path, 1)['rewards']), np.arange(4))
+
+    assert truncate_segments(path, memory.total) == memory.total
+    # resuming from a checkpoint taken between the exports keeps only the first segment
+    assert truncate_segments(path, 20) == 4
+    assert truncate_segments(path, 4) == 4
+    assert len(read_manifest(path)['segments']) == 1
@@ -5,9 +5,14 @@ import os
 from d4rl.infos import REF_MIN_SCORE, REF_MAX_SCORE
 
 import wandb
+from functools import partial
 from sac import SAC, CQL, ReplayMemory
+from sac.replay_memory import CompactReplayMemory, load_store
 from models import ProbEnsemble, PredictEnv
 from batch_utils import *
+from metrics import make_metrics_logger, SeedMetricsLogger
+from eval_pool import EvalPool, PolicyActor
+from checkpoint import CheckpointWriter, checkpoint_path, save_checkpoint, load_checkpoint
 from mbrl_utils import *
 from utils import *
 
@@ -23,8 +28,17 @@ def readParser():
         help='Mujoco Gym environment (default: hopper-medium-replay-v0)')
     parser.add_argument('--algo', default="codac")
     parser.add_argument('--version', type=int, default=2,
-        help='CODAC policy update version')
-    parser.add_argument('--tau_type', default="iqn")
+        help='CODAC update version: 2 (default) or 3, which fuses the critic and Lagrange updates into one backward and one Adam step')
+    parser.add_argument('--tau_type', default="iqn",
+                    help='quantile fractions: iqn, fix, or the equally weighted stratified, sobol or antithetic samplers')
+    parser.add_argument('--num_quantiles', type=int, default=32,
+                    help='quantile fractions per sample in the critic passes (default: 32)')
+    parser.add_argument('--multi_head_critic', action='store_true',
+                    help='with --tau_type fix, predict all quantiles from one critic head (QR-DQN style)')
+    parser.add_argument('--num_critics', type=int, default=2,
+                    help='quantile critics in the codac ensemble (default: 2)')
+    parser.add_argument('--num_target_critics', type=int, default=2,
+                    help='critics in the random subset whose min is the bootstrap target, REDQ style when below --num_critics (default: 2)')
     parser.add_argument('--dist_penalty_type', default="uniform")
     parser.add_argument('--entropy', default="false")
     parser.add_argument('--lag', type=float, default=10.0)
@@ -45,6 +59,11 @@ def readParser():
                         help='rollout length')
     parser.add_argument('--seed', type=int, default=0, metavar='N',
         help='random seed (default: 0)')
+    parser.add_argument('--num_seeds', type=int, default=1, metavar='N',
+        help='train seeds seed, seed + 1, ... in one process with their weights stacked (sac, cql, codac); '
+             'only faster than one process per seed when those would share CPU cores, and least for codac '
+             '(compare with bench_stacked_seeds.py); stacked seeds share one torch RNG stream, so seed s of a '
+             'stacked run is not the same experiment as --seed s')
 
     parser.add_argument('--replay_size', type=int, default=2000000, metavar='N',
                     help='size of replay buffer (default: 10000000)')
@@ -59,6 +78,8 @@ def readParser():
     parser.add_argument('--num_epoch', type=int, default=1000, metavar='A',
                     help='total number of epochs')
     parser.add_argument('--dataset_epoch', type=int, default=100)
+    parser.add_argument('--replay_dir', default='dataset_cache',
+        help='cache directory of converted, memory-mapped datasets (empty: load dataset into memory)')
     parser.add_argument('--real_ratio', type=float, default=0.05, metavar='A',
                     help='ratio of env samples / model samples')
     parser.add_argument('--init_exploration_steps', type=int, default=5000, metavar='A',
@@ -73,74 +94,156 @@ def readParser():
                     help='max training times per step')
     parser.add_argument('--policy_train_batch_size', type=int, default=256, metavar='A',
                     help='batch size for training policy')
+    parser.add_argument('--log_interval', type=int, default=1, metavar='N',
+                    help='steps between readbacks of the accumulated training losses')
+    parser.add_argument('--metrics_dir', default='logs',
+                    help='directory for local metric files')
+    parser.add_argument('--metrics_sinks', default='jsonl',
+                    help='comma-separated local metric sinks: jsonl, csv (wandb is added with --wandb)')
+    parser.add_argument('--metrics_window', type=int, default=100, metavar='N',
+                    help='training log calls aggregated into one metrics record')
+    parser.add_argument('--eval_envs', type=int, default=0, metavar='N',
+                    help='environment copies stepped together during evaluation (default: 0, one per CPU core, at most one per episode)')
+    parser.add_argument('--eval_workers', type=int, default=0, metavar='N',
+                    help='worker processes evaluating policy snapshots during training (default: 0, evaluate inline)')
+    parser.add_argument('--checkpoint_dir', default='checkpoints',
+                    help='directory for full training-state checkpoints')
+    parser.add_argument('--checkpoint_interval', type=int, default=None, metavar='N',
+                    help='epochs between training-state checkpoints (default: a tenth of the epochs, 0 disables them); '
+                         'each one copies the whole model pool on the training thread and writes it to disk')
+    parser.add_argument('--resume', action='store_true',
+                    help='continue from the latest checkpoint of this run if there is one')
+    parser.add_argument('--compact_replay', default='', choices=['', 'float32', 'float16', 'bfloat16'],
+                    help='keep the dataset pool in the compact layout with observations in this dtype')
+    parser.add_argument('--prioritized_replay', action='store_true',
+                    help='sample the dataset in proportion to the per-sample quantile loss (codac only)')
+    parser.add_argument('--priority_alpha', type=float, default=0.6,
+                    help='priority exponent of prioritized replay')
+    parser.add_argument('--priority_beta', type=float, default=0.4,
+                    help='importance-weight exponent of prioritized replay')
+    parser.add_argument('--prefetch_batches', type=int, default=0, metavar='K',
+                    help='batches prepared ahead on a background thread (default: 0, sample inline)')
     parser.add_argument('--model_type', default='pytorch', metavar='A',
                     help='predict model -- pytorch or tensorflow')
     parser.add_argument('--pre_trained', type=bool, default=False,
                     help='flag for whether dynamics model pre-trained')
-    parser.add_argument('--device', default='cuda:0',
-                    help='run on CUDA (default: True)')
+    parser.add_argument('--device', default='auto',
+                    help='auto (CUDA when available), cpu or cuda:N (default: auto)')
+    parser.add_argument('--num_threads', type=int, default=0, metavar='N',
+                    help='intra-op CPU threads (default: 0, the torch default)')
     return parser.parse_args()
 
 
-def train(args, env_sampler, predict_env, agent, env_pool, model_pool):
+def evaluation_actors(agent):
+    """(seed index, actor) pairs to evaluate: the agent, or one CPU policy per seed of a stacked agent."""
+    if agent.num_seeds is None:
+        return [(None, agent)]
+    return [(seed, PolicyActor(agent.policy.select_seed(seed).to('cpu'))) for seed in range(agent.num_seeds)]
+
+
+def report_evaluation(args, metrics, epoch_step, total_step, rewards, seed=None):
+    prefix = ''
+    if seed is not None:
+        metrics = metrics.loggers[seed]
+        prefix = f'Seed {args.seed + seed} '
+    rewards_avg, rewards_std, cvar = summarize_returns(rewards)
+    if args.d4rl:
+        env_name = args.env
+        min_score = REF_MIN_SCORE[env_name]
+        max_score = REF_MAX_SCORE[env_name]
+        normalized_score = 100 * (rewards_avg - min_score) / (max_score - min_score)
+    else:
+        normalized_score = rewards_avg
+
+    print("")
+    print(f'{prefix}Epoch {epoch_step} Eval_Reward {rewards_avg:.2f} Eval_Cvar {cvar:.2f} Eval_Std {rewards_std:.2f} Normalized_Score {normalized_score:.2f}')
+    metrics.log({'epoch': epoch_step,
+                 'eval_reward': rewards_avg,
+                 'normalized_score': normalized_score,
+                 'eval_cvar0.1': cvar,
+                 'reward_std': rewards_std}, step=total_step, aggregate=False)
+
+
+def train(args, env_sampler, predict_env, agent, env_pool, model_pool, metrics):
+    eval_actors = evaluation_actors(agent)
+    evaluator = EvalPool(args, eval_actors[0][1], args.eval_n_episodes, num_workers=args.eval_workers,
+                         num_slots=2 * len(eval_actors))
+    writer = CheckpointWriter()
     total_step = 0
     reward_sum = 0
     rollout_length = args.rollout_length
 
     save_interval = int(args.num_epoch / 1)
     eval_interval = int(args.num_epoch / 100)
-    for epoch_step in tqdm(range(args.num_epoch)):
+    if args.checkpoint_interval is None:
+        args.checkpoint_interval = max(args.num_epoch // 10, 1)
+    state_size = np.prod(env_sampler.env.observation_space.shape)
+    action_size = np.prod(env_sampler.env.action_space.shape)
+    prefetcher = make_batch_prefetcher(args, env_pool, model_pool, agent, state_size, action_size,
+                                       num_batches=args.prefetch_batches)
+
+    # the dataset pool is rebuilt from the dataset, only model rollouts are checkpointed
+    pools = {'model_pool': model_pool}
+    checkpoint_file = checkpoint_path(args)
+    start_epoch = 0
+    if args.resume and os.path.exists(checkpoint_file):
+        start_epoch, total_step = load_checkpoint(checkpoint_file, agent, pools, samplers={'env_pool': env_pool})
+        print(f'Resuming from {checkpoint_file} at epoch {start_epoch}')
+
+    try:
+        for epoch_step in tqdm(range(start_epoch, args.num_epoch)):
         
-        if (epoch_step+1) % save_interval == 0:
-            agent_path = f'saved_policies/{args.env}/{args.dataset}/{args.run_name}-epoch{epoch_step+1}'
-            # agent_path = f'saved_policies/{args.env}-{args.run_name}-epoch{epoch_step+1}'
-            agent.save_model(agent_path)
-
-        start_step = total_step
-        train_policy_steps = 0
-        for i in range(args.epoch_length):
-            cur_step = total_step - start_step
-
-            # epoch_length = 1000, min_pool_size = 1000
-            if cur_step >= args.epoch_length:
-                break
-
-            if cur_step % args.model_train_freq == 0 and args.real_ratio < 1.0:
-                assert(args.algo not in MODEL_FREE)
-                rollout_model(args, predict_env, agent, model_pool, env_pool, rollout_length)
-
-            # train policy
-            train_policy_steps += train_policy_repeats(args, total_step, train_policy_steps, cur_step, env_pool, model_pool, agent)
-            total_step += 1
+            if (epoch_step+1) % save_interval == 0:
+                agent_path = f'saved_policies/{args.env}/{args.dataset}/{args.run_name}-epoch{epoch_step+1}'
+                # agent_path = f'saved_policies/{args.env}-{args.run_name}-epoch{epoch_step+1}'
+                for model_path, state_dict in agent.model_state_dicts(agent_path).items():
+                    writer.submit(model_path, state_dict)
+
+            start_step = total_step
+            train_policy_steps = 0
+            for i in range(args.epoch_length):
+                cur_step = total_step - start_step
+
+                # epoch_length = 1000, min_pool_size = 1000
+                if cur_step >= args.epoch_length:
+                    break
+
+                if cur_step % args.model_train_freq == 0 and args.real_ratio < 1.0:
+                    assert(args.algo not in MODEL_FREE)
+                    # the prefetch thread must not sample model_pool while the rollouts are pushed
+                    prefetcher.reset()
+                    rollout_model(args, predict_env, agent, model_pool, env_pool, rollout_length)
+
+                # train policy
+                train_policy_steps += train_policy_repeats(args, total_step, train_policy_steps, cur_step, env_pool, model_pool, agent,
+                                                           prefetcher=prefetcher, metrics=metrics)
+                total_step += 1
         
-        if epoch_step % eval_interval == 0:
-            
-            rewards = [evaluate_policy(args, env_sampler, agent, args.epoch_length) for _ in range(args.eval_n_episodes)]
-            rewards = np.array(rewards)
-            rewards_avg = np.mean(rewards, axis=0)
-            rewards_std = np.std(rewards, axis=0)
-            sorted_rewards = np.sort(rewards)
-            cvar = sorted_rewards[:int(0.1 * sorted_rewards.shape[0])].mean()
-            if args.d4rl:
-                env_name = args.env
-                min_score = REF_MIN_SCORE[env_name]
-                max_score = REF_MAX_SCORE[env_name]
-                normalized_score = 100 * (rewards_avg - min_score) / (max_score - min_score)
-            else:
-                normalized_score = rewards_avg
-
-            print("")
-            print(f'Epoch {epoch_step} Eval_Reward {rewards_avg:.2f} Eval_Cvar {cvar:.2f} Eval_Std {rewards_std:.2f} Normalized_Score {normalized_score:.2f}')
-            if args.wandb:
-                wandb.log({'epoch': epoch_step,
-                           'eval_reward': rewards_avg,
-                           'normalized_score': normalized_score,
-                           'eval_cvar0.1': cvar,
-                           'reward_std': rewards_std})
+            if epoch_step % eval_interval == 0:
+                for seed, actor in evaluation_actors(agent):
+                    evaluator.submit((epoch_step, total_step, seed), actor)
+            for (eval_epoch, eval_step, seed), rewards in evaluator.poll():
+                report_evaluation(args, metrics, eval_epoch, eval_step, rewards, seed)
+
+            if args.checkpoint_interval > 0 and (epoch_step + 1) % args.checkpoint_interval == 0:
+                prefetcher.reset()
+                flush_priorities(env_pool)
+                save_checkpoint(checkpoint_file, agent, epoch_step + 1, total_step, pools, writer=writer,
+                                samplers={'env_pool': env_pool})
+
+        for (eval_epoch, eval_step, seed), rewards in evaluator.drain():
+            report_evaluation(args, metrics, eval_epoch, eval_step, rewards, seed)
+    finally:
+        # the writer goes last, it re-raises errors of queued writes
+        prefetcher.close()
+        evaluator.close()
+        metrics.close()
+        writer.close()
 
 
 def main():
     args = readParser()
+    args.device = str(setup_device(args.device, args.num_threads))
 
     if args.env == 'riskymass' or args.env == 'AntObstacle-v0':
         run_name = f"offline-{args.risk_prob}-{args.risk_penalty}-{args.algo}-{args.dist_penalty_type}-{args.risk_type}{args.risk_param}-E{args.entropy}-{args.seed}"
@@ -172,59 +275,41 @@ def main():
     args.d4rl = False
     if args.env == "riskymass":
         args.entropy_tuning = False
-        from env.risky_pointmass import PointMass
-        env = PointMass(risk_prob=args.risk_prob, risk_penalty=args.risk_penalty)
+        env = make_env(args.env, args.risk_prob, args.risk_penalty)
         args.epoch_length = 100
         args.num_epoch = 100
         args.eval_n_episodes = 100
         dataset_name = f'online-{args.risk_prob}-{args.risk_penalty}-codac-neutral0.1-Etrue-0-epoch{args.dataset_epoch}'
         print(f'Dataset used: {dataset_name}')
-        dataset = np.load(f'dataset/{args.env}/{dataset_name}.npy', allow_pickle=True).item()
+        dataset_source, load_dataset = online_dataset(f'dataset/{args.env}/{dataset_name.rsplit("-epoch", 1)[0]}',
+                                                      args.dataset_epoch)
         args.dataset = dataset_name
     elif args.env == 'AntObstacle-v0':
-        import env
-        env = gym.make(args.env)
-        env.set_risk(args.risk_prob, args.risk_penalty)
+        env = make_env(args.env, args.risk_prob, args.risk_penalty)
         args.epoch_length = 200
         args.num_epoch = 5000
         args.eval_n_episodes = 100
         dataset_name = f'online-{args.risk_prob}-{args.risk_penalty}-codac-neutral0.1-Etrue-0-epoch{args.dataset_epoch}'
         print(f'Dataset used: {dataset_name}')
-        dataset = np.load(f'dataset/{args.env}/{dataset_name}.npy', allow_pickle=True).item()
+        dataset_source, load_dataset = online_dataset(f'dataset/{args.env}/{dataset_name.rsplit("-epoch", 1)[0]}',
+                                                      args.dataset_epoch)
         args.dataset = dataset_name
     elif args.env == 'kitchen':
         dataset_name = 'kitchen'
-        import h5py
         args.dataset = dataset_name
-        f = h5py.File('kitchen_microwave_kettle_light_slider-v0.hdf5', 'r')
-        dataset = {}
-        dataset['observations'] = np.array(f['observations'][:])
-        dataset['actions'] = np.array(f['actions'][:])
-        dataset['rewards'] = np.array(f['rewards'][:])
-        dataset['terminals'] = np.array(f['terminals'][:])
-        dataset['timeouts'] = np.array(f['timeouts'][:])
-        
-        from d4rl.kitchen import KitchenMicrowaveKettleLightSliderV0
-        env = KitchenMicrowaveKettleLightSliderV0()
-        dataset = d4rl.qlearning_dataset(env, dataset)
+        env = make_env(args.env)
+        dataset_source = 'kitchen_microwave_kettle_light_slider-v0.hdf5'
+        load_dataset = partial(load_hdf5_dataset, dataset_source, env)
     elif args.env == "flow":
         args.entropy_tuning = False
-        from env.flowenv import FlowMergeEnv
-        env = FlowMergeEnv()
+        env = make_env(args.env)
         args.epoch_length = 100
         args.num_epoch = 100
         args.eval_n_episodes = 100
         dataset_name = 'flow'
         args.dataset = dataset_name
-        import h5py
-        f = h5py.File('flow-merge-v0-random.hdf5', 'r')
-        dataset = {}
-        dataset['observations'] = np.array(f['observations'][:])
-        dataset['actions'] = np.array(f['actions'][:])
-        dataset['rewards'] = np.array(f['rewards'][:])
-        dataset['terminals'] = np.array(f['terminals'][:])
-        dataset['timeouts'] = np.array(f['timeouts'][:])
-        dataset = d4rl.qlearning_dataset(env, dataset)
+        dataset_source = 'flow-merge-v0-random.hdf5'
+        load_dataset = partial(load_hdf5_dataset, dataset_source, env)
         
         import sys
         sys.path.append('flow')
@@ -322,12 +407,14 @@ def main():
         initial=InitialConfig()
         
         # network = MergeNetwork('merge', vehicles, net, initial)
-        env = FlowMergeEnv()
+        env = make_env(args.env)
 
     else:
         env_type, dataset_type = args.env.split('-')[0], args.env.split('-')[-2]
-        env, dataset = load_d4rl_dataset(args.env)
+        env = make_env(args.env)
         # dict_keys(['observations', 'actions', 'next_observations', 'rewards', 'terminals'])
+        load_dataset = partial(d4rl.qlearning_dataset, env)
+        dataset_source = getattr(env, 'dataset_filepath', None)
         args.dataset = args.env
         args.d4rl = True
 
@@ -338,6 +425,15 @@ def main():
         args.real_ratio = 1.0
 
     args.run_name = run_name
+    num_seeds = None
+    if args.num_seeds > 1:
+        assert args.algo in MODEL_FREE, 'stacked seeds are only supported for sac, cql and codac'
+        assert not args.prioritized_replay, 'stacked seeds share one pool and cannot use per-seed priorities'
+        num_seeds = args.num_seeds
+        # checkpoints and saved models hold all seeds, metrics are written per seed under <run_name>/seed<s>
+        args.run_name = f'{run_name}to{args.seed + num_seeds - 1}'
+        # every batch holds policy_train_batch_size independently sampled rows per seed, see Batch.split_seeds
+        args.policy_train_batch_size *= num_seeds
 
     # Set random seed
     torch.manual_seed(args.seed)
@@ -347,18 +443,23 @@ def main():
 
     if args.algo == 'sac':
         agent = SAC(env.observation_space.shape[0], env.action_space,
-                    automatic_entropy_tuning=args.entropy_tuning)
+                    automatic_entropy_tuning=args.entropy_tuning, device=args.device,
+                    num_seeds=num_seeds)
     elif args.algo == 'codac':
         from distributional.codac import CODAC
         agent = CODAC(env.observation_space.shape[0], env.action_space,
                       version=args.version,
                       tau_type=args.tau_type, use_bc=args.use_bc,
+                      num_quantiles=args.num_quantiles,
+                      multi_head_critic=args.multi_head_critic,
+                      num_critics=args.num_critics,
+                      num_target_critics=args.num_target_critics,
                       min_z_weight=args.min_z_weight, actor_lr=args.actor_lr,
                       risk_type=args.risk_type, risk_param=args.risk_param,
                       dist_penalty_type=args.dist_penalty_type,
                       lagrange_thresh=args.lag,
                       use_automatic_entropy_tuning=args.entropy_tuning,
-                      device=args.device)
+                      device=args.device, num_seeds=num_seeds)
     elif args.algo == 'cql':
         from sac.cql import CQL
         args.dist_penalty_type = 'none'
@@ -366,7 +467,7 @@ def main():
                     min_q_weight=args.min_z_weight, policy_lr=args.actor_lr,
                     lagrange_thresh=args.lag,
                     automatic_entropy_tuning=args.entropy_tuning,
-                    device=args.device)
+                    device=args.device, num_seeds=num_seeds)
 
     # initial ensemble model
     state_size = np.prod(env.observation_space.shape)
@@ -383,19 +484,27 @@ def main():
     env_sampler = EnvSampler(env, max_path_length=args.epoch_length)
 
     # Initial replay buffer for env
-    if dataset is not None:
-        n = dataset['observations'].shape[0]
-        print(f"dataset name: {args.dataset}")
-        print(f"{args.env} dataset size {n}")
-        env_pool = ReplayMemory(n)
-        for i in range(n):
-            state, action, reward, next_state, done = dataset['observations'][i], dataset['actions'][i], dataset['rewards'][
-                i], dataset['next_observations'][i], dataset['terminals'][i]
-            env_pool.push(state, action, reward, next_state, done)
+    if args.replay_dir and not is_segment_manifest(dataset_source):
+        # convert once, then every run memory-maps the same store; segmented exports are stores already
+        store_path = cached_dataset_store(load_dataset, os.path.join(args.env, args.dataset),
+                                          source=dataset_source, cache_dir=args.replay_dir)
+        dataset = load_store(store_path)
     else:
-        env_pool = ReplayMemory(args.init_exploration_steps)
-        exploration_before_start(args, env_sampler, env_pool, agent,
-                                 init_exploration_steps=args.init_exploration_steps)
+        dataset = load_dataset()
+    if args.compact_replay:
+        env_pool = CompactReplayMemory.from_arrays(dataset, obs_dtype=args.compact_replay)
+    else:
+        env_pool = ReplayMemory.from_arrays(dataset)
+    del dataset
+    if args.prioritized_replay:
+        assert args.algo == 'codac', 'prioritized replay needs per-sample quantile losses'
+        env_pool.set_prioritized(alpha=args.priority_alpha, beta=args.priority_beta)
+    if num_seeds is not None:
+        # every stacked seed draws its rows from its own stream
+        env_pool.set_seed_streams(range(args.seed, args.seed + num_seeds))
+    n = len(env_pool)
+    print(f"dataset name: {args.dataset}")
+    print(f"{args.env} dataset size {n}")
 
     # Initial pool for model
     rollouts_per_epoch = args.rollout_batch_size * args.epoch_length / args.model_train_freq
@@ -406,11 +515,18 @@ def main():
     if args.wandb:
         wandb.init(project='codac_final2',
                    group=args.env,
-                   name=args.env+run_name,
+                   name=args.env+args.run_name,
                    config=args)
 
+    if num_seeds is None:
+        metrics = make_metrics_logger(args, run_name)
+    else:
+        metrics = SeedMetricsLogger([make_metrics_logger(args, f'{args.run_name}/seed{args.seed + seed}',
+                                                         wandb_prefix=f'seed{args.seed + seed}/')
+                                     for seed in range(num_seeds)])
+
     # Train
-    train(args, env_sampler, predict_env, agent, env_pool, model_pool)
+    train(args, env_sampler, predict_env, agent, env_pool, model_pool, metrics)
 
 
 if __name__ == '__main__':
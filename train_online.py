@@ -4,9 +4,13 @@ from d4rl.infos import REF_MIN_SCORE, REF_MAX_SCORE
 
 import wandb
 from sac import SAC, CQL, ReplayMemory
+from sac.replay_memory import append_segment, truncate_segments
 from models import ProbEnsemble, PredictEnv
 
 from batch_utils import *
+from metrics import make_metrics_logger
+from eval_pool import EvalPool
+from checkpoint import CheckpointWriter, checkpoint_path, save_checkpoint, load_checkpoint
 from mbrl_utils import *
 from utils import *
 
@@ -31,6 +35,10 @@ def readParser():
     parser.add_argument('--risk_penalty', type=float, default=200)
     parser.add_argument('--pretrained', dest='pretrained', action='store_true')
     parser.set_defaults(pretrained=False)
+    parser.add_argument('--num_critics', type=int, default=2,
+                        help='quantile critics in the codac ensemble (default: 2)')
+    parser.add_argument('--num_target_critics', type=int, default=2,
+                        help='critics in the random subset whose min is the bootstrap target, REDQ style when below --num_critics (default: 2)')
     parser.add_argument('--dist_penalty_type', default="none")
     parser.add_argument('--penalty', type=float, default=1.0,
                         help='reward penalty')
@@ -66,72 +74,129 @@ def readParser():
                         help='max training times per step')
     parser.add_argument('--policy_train_batch_size', type=int, default=256, metavar='A',
                         help='batch size for training policy')
+    parser.add_argument('--log_interval', type=int, default=1, metavar='N',
+                        help='steps between readbacks of the accumulated training losses')
+    parser.add_argument('--metrics_dir', default='logs',
+                        help='directory for local metric files')
+    parser.add_argument('--metrics_sinks', default='jsonl',
+                        help='comma-separated local metric sinks: jsonl, csv (wandb is added with --wandb)')
+    parser.add_argument('--metrics_window', type=int, default=100, metavar='N',
+                        help='training log calls aggregated into one metrics record')
+    parser.add_argument('--checkpoint_dir', default='checkpoints',
+                        help='directory for full training-state checkpoints')
+    parser.add_argument('--checkpoint_interval', type=int, default=10, metavar='N',
+                        help='epochs between training-state checkpoints (0 disables them)')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the latest checkpoint of this run if there is one')
+    parser.add_argument('--eval_envs', type=int, default=0, metavar='N',
+                        help='environment copies stepped together during evaluation (default: 0, one per CPU core, at most one per episode)')
+    parser.add_argument('--eval_workers', type=int, default=0, metavar='N',
+                        help='worker processes evaluating policy snapshots during training (default: 0, evaluate inline)')
 
     parser.add_argument('--model_type', default='pytorch', metavar='A',
                         help='predict model -- pytorch or tensorflow')
     parser.add_argument('--pre_trained', type=bool, default=False,
                         help='flag for whether dynamics model pre-trained')
-    parser.add_argument('--cuda', default=True, action="store_true",
-                        help='run on CUDA (default: True)')
+    parser.add_argument('--device', default='auto',
+                        help='auto (CUDA when available), cpu or cuda:N (default: auto)')
+    parser.add_argument('--num_threads', type=int, default=0, metavar='N',
+                        help='intra-op CPU threads (default: 0, the torch default)')
     return parser.parse_args()
 
 
-def train(args, env_sampler, predict_env, agent, env_pool, model_pool):
+def report_evaluation(args, metrics, epoch_step, total_step, rewards):
+    rewards_avg, rewards_std, cvar = summarize_returns(rewards)
+    print("")
+    print(f'Epoch {epoch_step} Eval_Reward {rewards_avg:.2f} Eval_Cvar {cvar:.2f} Eval_Std {rewards_std:.2f}')
+    metrics.log({'epoch': epoch_step,
+                 'eval_reward': rewards_avg,
+                 'eval_cvar0.1': cvar,
+                 'reward_std': rewards_std}, step=total_step, aggregate=False)
+
+
+def train(args, env_sampler, predict_env, agent, env_pool, model_pool, metrics):
+    evaluator = EvalPool(args, agent, args.eval_n_episodes, num_workers=args.eval_workers)
+    writer = CheckpointWriter()
     total_step = 0
     reward_sum = 0
     rollout_length = args.rollout_length
     state_size = np.prod(env_sampler.env.observation_space.shape)
     qvel_size = int((state_size + 1) / 2)
 
-    exploration_before_start(args, env_sampler, env_pool, agent, init_exploration_steps=1000)
+    pools = {'env_pool': env_pool, 'model_pool': model_pool}
+    checkpoint_file = checkpoint_path(args)
+    start_epoch = 0
+    # collected transitions are exported incrementally as numbered segments (see append_segment)
+    export_dir = f'dataset/{args.env}/{args.run_name}'
+    if args.resume and os.path.exists(checkpoint_file):
+        start_epoch, total_step = load_checkpoint(checkpoint_file, agent, pools)
+        exported = truncate_segments(export_dir, env_pool.total)
+        print(f'Resuming from {checkpoint_file} at epoch {start_epoch}')
+    else:
+        if os.path.exists(export_dir):
+            raise FileExistsError(f'{export_dir} holds the export of an earlier run; '
+                                  'pass --resume to continue it or remove it to start over')
+        exported = 0
+        exploration_before_start(args, env_sampler, env_pool, agent, init_exploration_steps=1000)
+    prefetcher = make_batch_prefetcher(args, env_pool, model_pool, agent, state_size,
+                                       np.prod(env_sampler.env.action_space.shape))
     save_interval = int(args.num_epoch / 10)
     eval_interval = int(args.num_epoch / 100)
 
-    for epoch_step in tqdm(range(args.num_epoch)):
-        # save buffer for offline learning
-        if (epoch_step+1) % save_interval == 0:
-            buffer_path = f'dataset/{args.env}/{args.run_name}-epoch{epoch_step+1}.npy'
-            env_pool.save_buffer(buffer_path)
-            agent_path = f'saved_policies/{args.env}/online/{args.run_name}-epoch{epoch_step+1}'
-            agent.save_model(agent_path)
-
-        start_step = total_step
-        train_policy_steps = 0
-        env_sampler.current_state = None
-        env_sampler.path_length = 0
-        for i in range(args.epoch_length):
-            cur_step = total_step - start_step
-
-            if cur_step >= args.epoch_length:
-                break
-
-            # step in real environment
-            state, action, next_state, reward, done, info = env_sampler.sample(agent)
-            env_pool.push(state, action, reward, next_state, done)
-
-            # train policy
-            if len(env_pool) > 1000:
-                train_policy_steps += train_policy_repeats(args, total_step, train_policy_steps, cur_step, env_pool, model_pool, agent)
-            total_step += 1
-
-        if epoch_step % eval_interval == 0:
-            rewards = [evaluate_policy(args, env_sampler, agent, args.epoch_length) for _ in range(args.eval_n_episodes)]
-            rewards = np.array(rewards)
-            rewards_avg = np.mean(rewards, axis=0)
-            rewards_std = np.std(rewards, axis=0)
-            sorted_rewards = np.sort(rewards)
-            cvar = sorted_rewards[:int(0.1*sorted_rewards.shape[0])].mean()
-            print("")
-            print(f'Epoch {epoch_step} Eval_Reward {rewards_avg:.2f} Eval_Cvar {cvar:.2f} Eval_Std {rewards_std:.2f}')
-            if args.wandb:
-                wandb.log({'epoch':epoch_step,
-                           'eval_reward': rewards_avg,
-                           'eval_cvar0.1': cvar,
-                           'reward_std': rewards_std})
+    try:
+        for epoch_step in tqdm(range(start_epoch, args.num_epoch)):
+            # save buffer for offline learning
+            if (epoch_step+1) % save_interval == 0:
+                transitions = env_pool.transitions_since(exported)
+                dropped = env_pool.total - exported - len(transitions['rewards'])
+                writer.run(append_segment, export_dir, transitions, epoch_step+1, env_pool.capacity, dropped)
+                exported = env_pool.total
+                agent_path = f'saved_policies/{args.env}/online/{args.run_name}-epoch{epoch_step+1}'
+                for model_path, state_dict in agent.model_state_dicts(agent_path).items():
+                    writer.submit(model_path, state_dict)
+
+            start_step = total_step
+            train_policy_steps = 0
+            env_sampler.current_state = None
+            env_sampler.path_length = 0
+            for i in range(args.epoch_length):
+                cur_step = total_step - start_step
+
+                if cur_step >= args.epoch_length:
+                    break
+
+                # step in real environment
+                state, action, next_state, reward, done, info = env_sampler.sample(agent)
+                env_pool.push(state, action, reward, next_state, done)
+
+                # train policy
+                if len(env_pool) > 1000:
+                    train_policy_steps += train_policy_repeats(args, total_step, train_policy_steps, cur_step, env_pool, model_pool, agent,
+                                                               prefetcher=prefetcher, metrics=metrics)
+                total_step += 1
+
+            if epoch_step % eval_interval == 0:
+                evaluator.submit((epoch_step, total_step), agent)
+            for (eval_epoch, eval_step), rewards in evaluator.poll():
+                report_evaluation(args, metrics, eval_epoch, eval_step, rewards)
+
+            if args.checkpoint_interval > 0 and (epoch_step + 1) % args.checkpoint_interval == 0:
+                prefetcher.reset()
+                save_checkpoint(checkpoint_file, agent, epoch_step + 1, total_step, pools, writer=writer)
+
+        for (eval_epoch, eval_step), rewards in evaluator.drain():
+            report_evaluation(args, metrics, eval_epoch, eval_step, rewards)
+    finally:
+        # the writer goes last, it re-raises errors of queued writes
+        prefetcher.close()
+        evaluator.close()
+        metrics.close()
+        writer.close()
 
 
 def main():
     args = readParser()
+    args.device = str(setup_device(args.device, args.num_threads))
 
     if args.env == "riskymass" or args.env == 'AntObstacle-v0':
         if args.algo == 'codac':
@@ -153,14 +218,11 @@ def main():
         args.entropy_tuning = True
    
     if args.env == "riskymass":
-        from env.risky_pointmass import PointMass
-        env = PointMass(risk_prob=args.risk_prob, risk_penalty=args.risk_penalty)
+        env = make_env(args.env, args.risk_prob, args.risk_penalty)
         args.epoch_length = 100
         args.num_epoch = 100
     elif args.env == 'AntObstacle-v0':
-        import env
-        env = gym.make(args.env)
-        env.set_risk(args.risk_prob, args.risk_penalty)
+        env = make_env(args.env, args.risk_prob, args.risk_penalty)
         args.epoch_length = 200
         args.num_epoch = 5000
         args.eval_n_episodes = 100
@@ -190,15 +252,18 @@ def main():
 
     if args.algo == 'sac':
         agent = SAC(env.observation_space.shape[0], env.action_space,
-                    automatic_entropy_tuning=False)
+                    automatic_entropy_tuning=False, device=args.device)
     elif args.algo == 'codac':
         from distributional.codac import CODAC
         agent = CODAC(env.observation_space.shape[0], env.action_space,
                       risk_type=args.risk_type, risk_param=args.risk_param,
-                      dist_penalty_type=args.dist_penalty_type)
+                      dist_penalty_type=args.dist_penalty_type,
+                      num_critics=args.num_critics,
+                      num_target_critics=args.num_target_critics,
+                      device=args.device)
     elif args.algo == 'cql':
         from sac.cql import CQL
-        agent = CQL(env.observation_space.shape[0], env.action_space)
+        agent = CQL(env.observation_space.shape[0], env.action_space, device=args.device)
 
 
     # Replay Buffer
@@ -212,8 +277,10 @@ def main():
     # Sampler Environment
     env_sampler = EnvSampler(env, max_path_length=args.epoch_length)
 
+    metrics = make_metrics_logger(args, run_name)
+
     # Train
-    train(args, env_sampler, predict_env, agent, env_pool, model_pool)
+    train(args, env_sampler, predict_env, agent, env_pool, model_pool, metrics)
 
 
 if __name__ == '__main__':
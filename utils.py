@@ -1,9 +1,53 @@
+import hashlib
+import inspect
+import json
+import os
 import d4rl
 import gym
 import numpy as np
 import torch
 
+from functools import partial
 from torch.utils.data import TensorDataset, DataLoader
+from sac.replay_memory import save_store, load_segments
+from sac.utils import resolve_device
+import distributional.rlkit_pytorch_utils as ptu
+
+
+def setup_device(device='auto', num_threads=0):
+    """
+    Resolve the --device flag ('auto': CUDA when available, else CPU) and
+    point the rlkit tensor helpers at it, so agents, models and ptu agree.
+    num_threads > 0 sets the intra-op threads, e.g. one per physical core on
+    CPU nodes. On CPU denormals are flushed to zero, since tiny activations
+    and gradients otherwise hit the slow denormal path in float32 matmuls.
+    """
+    device = resolve_device(device)
+    ptu.set_gpu_mode(device.type == 'cuda', device.index or 0)
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if device.type == 'cpu':
+        torch.set_flush_denormal(True)
+    return device
+
+
+def make_env(env_name, risk_prob=0.8, risk_penalty=200):
+    """Build a fresh instance of a training environment, e.g. for evaluation copies."""
+    if env_name == 'riskymass':
+        from env.risky_pointmass import PointMass
+        return PointMass(risk_prob=risk_prob, risk_penalty=risk_penalty)
+    if env_name == 'AntObstacle-v0':
+        import env  # registers AntObstacle-v0
+        ant = gym.make(env_name)
+        ant.set_risk(risk_prob, risk_penalty)
+        return ant
+    if env_name == 'kitchen':
+        from d4rl.kitchen import KitchenMicrowaveKettleLightSliderV0
+        return KitchenMicrowaveKettleLightSliderV0()
+    if env_name == 'flow':
+        from env.flowenv import FlowMergeEnv
+        return FlowMergeEnv()
+    return gym.make(env_name)
 
 
 def combine_d4rl_dataset(env_name='hopper', threshold=250000):
@@ -29,6 +73,111 @@ def load_d4rl_dataset(env_name='halfcheetah-expert-v0'):
     dataset = d4rl.qlearning_dataset(env)
     return env, dataset
 
+def load_npy_dataset(path):
+    return np.load(path, allow_pickle=True).item()
+
+
+def online_dataset(run_dir, epoch):
+    """
+    (source file, loader) for the data an online run had collected by `epoch`:
+    its segmented export `run_dir/` if there is one, otherwise the older
+    full snapshot `<run_dir>-epoch<epoch>.npy`.
+    """
+    manifest = os.path.join(run_dir, 'manifest.json')
+    if os.path.exists(manifest):
+        return manifest, partial(load_segments, run_dir, epoch)
+    source = f'{run_dir}-epoch{epoch}.npy'
+    return source, partial(load_npy_dataset, source)
+
+
+def is_segment_manifest(source):
+    """Whether `source` (see online_dataset) is the manifest of a segmented export."""
+    return source is not None and os.path.basename(source) == 'manifest.json'
+
+
+def load_hdf5_dataset(path, env):
+    import h5py
+    dataset = {}
+    with h5py.File(path, 'r') as f:
+        for key in ['observations', 'actions', 'rewards', 'terminals', 'timeouts']:
+            dataset[key] = f[key][:]
+    return d4rl.qlearning_dataset(env, dataset)
+
+
+def file_digest(path, chunk_size=1 << 20, index=None):
+    """
+    Content hash of the file at `path`. With an `index` json file, digests
+    are remembered by (path, size, mtime) and the file is only read again
+    when one of those changes.
+    """
+    stat = os.stat(path)
+    key, stamp = os.path.abspath(path), [stat.st_size, stat.st_mtime_ns]
+    entries = {}
+    if index is not None and os.path.exists(index):
+        with open(index) as f:
+            entries = json.load(f)
+        if key in entries and entries[key]['stamp'] == stamp:
+            return entries[key]['digest']
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()[:16]
+    if index is not None:
+        entries[key] = {'stamp': stamp, 'digest': digest}
+        os.makedirs(os.path.dirname(os.path.abspath(index)), exist_ok=True)
+        tmp_path = f'{index}.tmp-{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, index)
+    return digest
+
+
+def loader_digest(load_dataset):
+    """
+    Hash of a dataset loader without a source file: the code of the function
+    (unwrapping functools.partial) and its plain arguments, so editing the
+    generator gives a new cache entry.
+    """
+    func, args, kwargs = load_dataset, (), {}
+    if isinstance(load_dataset, partial):
+        func, args, kwargs = load_dataset.func, load_dataset.args, load_dataset.keywords
+    sha = hashlib.sha1(f'{func.__module__}.{func.__qualname__}'.encode())
+    code = getattr(func, '__code__', None)
+    if code is not None:
+        sha.update(code.co_code)
+        sha.update(repr([c for c in code.co_consts if not inspect.iscode(c)]).encode())
+    for value in list(args) + sorted(kwargs.items()):
+        plain = isinstance(value, (str, int, float, bool, tuple))
+        sha.update((repr(value) if plain else type(value).__name__).encode())
+    return sha.hexdigest()[:16]
+
+
+def cached_dataset_store(load_dataset, name, source=None, cache_dir='dataset_cache'):
+    """
+    Return the path of the replay store holding the converted dataset `name`,
+    calling load_dataset() only when the cache has no entry for it yet.
+    Entries are `cache_dir/<name>-<digest>`, where digest is a content hash of
+    the raw `source` file, so a changed or re-downloaded dataset gets a new
+    entry. The hash is only recomputed when the file's size or mtime change.
+    Without a source file the digest is that of the loader (see loader_digest).
+    """
+    dataset = None
+    if source is not None and not os.path.exists(source):
+        # d4rl downloads the raw file on first use
+        dataset = load_dataset()
+    if source is not None and os.path.exists(source):
+        name = f'{name}-{file_digest(source, index=os.path.join(cache_dir, "digests.json"))}'
+    else:
+        name = f'{name}-{loader_digest(load_dataset)}'
+    path = os.path.join(cache_dir, name)
+    if not os.path.exists(path):
+        if dataset is None:
+            dataset = load_dataset()
+        save_store(dataset, path)
+    return path
+
+
 def load_normalized_dataset(env_name='hopper', dataset_name='medium-replay-v0'):
     x_train, y_train, x_test, y_test = np.load(f'data/{env_name}-{dataset_name}-normalized-data.npy', allow_pickle=True)
     return x_train,y_train,x_test, y_test